@@ -0,0 +1,163 @@
+import os
+
+ACCOUNT_DELETION_BATCH = int(os.getenv("ACCOUNT_DELETION_BATCH", 500))  # rows (orders for the orders step) per transaction
+ACCOUNT_DELETION_POLL = float(os.getenv("ACCOUNT_DELETION_POLL", 30))  # seconds between idle polls
+ACCOUNT_DELETION_STALE = 300  # seconds without progress before a running job is taken over
+ACCOUNT_DELETION_MAX_ATTEMPTS = 5
+ACCOUNT_DELETION_RETRY_DELAY = 60  # seconds, multiplied by the attempt number
+
+# Run in order; each statement deletes at most %(batch)s rows (or a single row) of
+# the user's data and is repeated until it deletes fewer. The account row goes last.
+DELETION_STEPS = (
+    ("reviews", """
+        DELETE FROM product_reviews
+        WHERE id IN (SELECT id FROM product_reviews WHERE user_id = %(user_id)s LIMIT %(batch)s)
+    """),
+    # Items and their orders go in the same statement, a batch of orders at a time
+    ("orders", """
+        WITH batch AS (
+            SELECT id, order_id FROM orders WHERE customer = %(user_id)s LIMIT %(batch)s
+        ), items AS (
+            -- order_items.order_id holds the business order id (orders.order_id), not orders.id
+            DELETE FROM order_items WHERE order_id IN (SELECT order_id FROM batch)
+        )
+        DELETE FROM orders WHERE id IN (SELECT id FROM batch)
+    """),
+    ("cart", "DELETE FROM carts WHERE user_id = %(user_id)s"),
+    ("user_addresses", """
+        DELETE FROM user_addresses
+        WHERE id IN (SELECT id FROM user_addresses WHERE user_id = %(user_id)s LIMIT %(batch)s)
+    """),
+    ("addresses", """
+        DELETE FROM addresses
+        WHERE id IN (SELECT id FROM addresses WHERE user_id = %(user_id)s LIMIT %(batch)s)
+    """),
+    ("b2b_applications", """
+        DELETE FROM b2b_applications
+        WHERE id IN (SELECT id FROM b2b_applications WHERE user_id = %(user_id)s LIMIT %(batch)s)
+    """),
+    ("b2c_applications", "DELETE FROM b2c_applications WHERE id = %(user_id)s"),
+    ("account", "DELETE FROM auth_users WHERE id = %(user_id)s"),
+)
+STEP_NAMES = [name for name, _ in DELETION_STEPS]
+
+JOB_COLUMNS = ("id", "user_id", "status", "step", "progress", "attempts", "last_error",
+               "requested_at", "next_attempt_at", "heartbeat_at", "completed_at")
+
+
+def _row(cursor, columns):
+    row = cursor.fetchone()
+    if row is None or isinstance(row, dict):
+        return row
+    return dict(zip(columns, row))
+
+
+def request_deletion(cursor, user_id):
+    """
+    Revokes the account (get_current_user and login stop accepting it) and queues
+    its deletion, in the caller's transaction. Asking again returns the same job.
+    """
+    cursor.execute("UPDATE auth_users SET deleted_at = NOW() WHERE id = %s AND deleted_at IS NULL", (user_id,))
+    cursor.execute("""
+        INSERT INTO account_deletions (user_id) VALUES (%s)
+        ON CONFLICT (user_id) DO UPDATE SET user_id = EXCLUDED.user_id
+        RETURNING id, status
+    """, (str(user_id),))
+    return _row(cursor, ("id", "status"))
+
+
+def job_status(cursor, job_id):
+    cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM account_deletions WHERE id::text = %s", (job_id,))
+    job = _row(cursor, JOB_COLUMNS)
+    if job is None:
+        return None
+    job["steps"] = STEP_NAMES
+    return job
+
+
+def claim_job(conn):
+    """Takes the oldest pending job, or a running one whose worker went quiet."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE account_deletions
+            SET status = 'running', attempts = attempts + 1, heartbeat_at = NOW()
+            WHERE id = (
+                SELECT id FROM account_deletions
+                WHERE (status = 'pending' AND next_attempt_at <= NOW())
+                   OR (status = 'running' AND heartbeat_at < NOW() - make_interval(secs => %s))
+                ORDER BY requested_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, step, attempts
+        """, (ACCOUNT_DELETION_STALE,))
+        job = _row(cursor, ("id", "user_id", "step", "attempts"))
+        conn.commit()
+        return job
+    finally:
+        cursor.close()
+
+
+def run_job(conn, job, batch_size=ACCOUNT_DELETION_BATCH):
+    """
+    Works through the steps from where the job left off. Every batch commits with
+    the job's progress, so a crash loses at most one batch and re-running a step
+    only finds what's left. Returns the rows deleted by this run.
+    """
+    cursor = conn.cursor()
+    params = {"user_id": job["user_id"], "batch": batch_size}
+    start = STEP_NAMES.index(job["step"]) if job["step"] in STEP_NAMES else 0
+    total = 0
+    try:
+        for name, sql in DELETION_STEPS[start:]:
+            while True:
+                cursor.execute(sql, params)
+                deleted = cursor.rowcount
+                cursor.execute("""
+                    UPDATE account_deletions
+                    SET step = %s,
+                        progress = jsonb_set(progress, ARRAY[%s],
+                                             to_jsonb(COALESCE((progress ->> %s)::bigint, 0) + %s)),
+                        heartbeat_at = NOW()
+                    WHERE id = %s
+                """, (name, name, name, deleted, job["id"]))
+                conn.commit()
+                total += deleted
+                if deleted < batch_size:
+                    break
+
+        cursor.execute("""
+            UPDATE account_deletions
+            SET status = 'done', step = NULL, last_error = NULL, completed_at = NOW(), heartbeat_at = NOW()
+            WHERE id = %s
+        """, (job["id"],))
+        conn.commit()
+        return total
+    except Exception as e:
+        conn.rollback()
+        gave_up = job["attempts"] >= ACCOUNT_DELETION_MAX_ATTEMPTS
+        cursor.execute("""
+            UPDATE account_deletions
+            SET status = %s, last_error = %s, next_attempt_at = NOW() + make_interval(secs => %s)
+            WHERE id = %s
+        """, ("failed" if gave_up else "pending", str(e)[:1000],
+              ACCOUNT_DELETION_RETRY_DELAY * job["attempts"], job["id"]))
+        conn.commit()
+        raise
+    finally:
+        cursor.close()
+
+
+def drain_account_deletions(conn, batch_size=ACCOUNT_DELETION_BATCH):
+    """Runs jobs until none is due. Returns the number of jobs finished."""
+    finished = 0
+    while True:
+        job = claim_job(conn)
+        if job is None:
+            return finished
+        try:
+            run_job(conn, job, batch_size)
+            finished += 1
+        except Exception as e:
+            print(f"Account deletion {job['id']} failed (attempt {job['attempts']}): {e}")
@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import json
+import os
+import time
+import urllib.parse
+
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 10))
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", 10))  # seconds for the whole batch
+BATCH_METHODS = ("GET",)  # reads only: concurrent sub-requests must not depend on each other
+
+# (bearer token, user id) verified once by /batch; get_current_user trusts it for
+# sub-requests carrying the same token instead of looking the user up again
+batch_identity = contextvars.ContextVar("batch_identity", default=None)
+
+
+class BatchError(Exception):
+    """Rejected batch; `status_code` is what the endpoint should answer with."""
+
+    def __init__(self, message, status_code=400):
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def validate_items(items):
+    if not items:
+        raise BatchError("Batch is empty")
+    if len(items) > BATCH_MAX_REQUESTS:
+        raise BatchError(f"At most {BATCH_MAX_REQUESTS} requests per batch", status_code=413)
+
+
+def _item_error(status, detail):
+    return status, json.dumps({"detail": detail}).encode()
+
+
+async def call_app(app, outer_scope, method, path, authorization):
+    """
+    Runs one sub-request through the ASGI app in-process (middleware, routing,
+    dependencies and all) and returns (status, body bytes, content type).
+    """
+    parts = urllib.parse.urlsplit(path)
+    headers = [(b"accept", b"application/json")]
+    if authorization:
+        headers.append((b"authorization", authorization))
+    scope = {
+        "type": "http",
+        "asgi": outer_scope.get("asgi", {"version": "3.0"}),
+        "http_version": outer_scope.get("http_version", "1.1"),
+        "method": method,
+        "scheme": outer_scope.get("scheme", "http"),
+        "path": urllib.parse.unquote(parts.path),
+        "raw_path": parts.path.encode(),
+        "root_path": outer_scope.get("root_path", ""),
+        "query_string": parts.query.encode(),
+        "headers": headers,
+        "client": outer_scope.get("client"),
+        "server": outer_scope.get("server"),
+    }
+    if "state" in outer_scope:
+        scope["state"] = dict(outer_scope["state"])
+
+    sent_request = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal sent_request
+        if not sent_request:
+            sent_request = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()  # only streaming responses get here; they're cancelled at the deadline
+        return {"type": "http.disconnect"}
+
+    response = {"status": 500, "content_type": b"", "body": []}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            for name, value in message.get("headers", []):
+                if name.lower() == b"content-type":
+                    response["content_type"] = value
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return response["status"], b"".join(response["body"]), response["content_type"]
+
+
+async def run_batch(app, outer_scope, items, authorization, timeout=BATCH_TIMEOUT):
+    """
+    Runs the sub-requests concurrently under one deadline. Returns the
+    {"responses": [...]} body as bytes, one entry per item in request order;
+    bodies are spliced in as the sub-responses' own JSON bytes.
+    """
+    validate_items(items)
+    started = time.monotonic()
+
+    tasks = {}
+    results = {}
+    for index, item in enumerate(items):
+        method = item.method.upper()
+        if method not in BATCH_METHODS:
+            results[index] = _item_error(405, f"Only {', '.join(BATCH_METHODS)} requests can be batched")
+        elif not item.path.startswith("/") or urllib.parse.urlsplit(item.path).path.rstrip("/") == "/batch":
+            results[index] = _item_error(400, "Invalid path")
+        else:
+            tasks[index] = asyncio.create_task(call_app(app, outer_scope, method, item.path, authorization))
+
+    if tasks:
+        _, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        for index, task in tasks.items():
+            if task in pending:
+                results[index] = _item_error(504, "Timed out")
+            elif task.exception() is not None:
+                print(f"Batch sub-request {items[index].path} failed: {task.exception()}")
+                results[index] = _item_error(500, "Internal Server Error")
+            else:
+                status, body, content_type = task.result()
+                if not content_type.startswith(b"application/json") or not body:
+                    body = json.dumps(body.decode("utf-8", "replace")).encode()
+                results[index] = status, body
+
+    entries = []
+    for index, item in enumerate(items):
+        status, body = results[index]
+        head = json.dumps({"id": item.id if item.id is not None else str(index), "status": status})
+        entries.append(head[:-1].encode() + b',"body":' + body + b"}")
+    elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+    return b'{"responses":[' + b",".join(entries) + b'],"elapsed_ms":' + str(elapsed_ms).encode() + b"}"
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from psycopg2.extras import RealDictCursor
+
+from pricing import resolve_price
+
+BOOTSTRAP_PRODUCTS = int(os.getenv("BOOTSTRAP_PRODUCTS", 20))  # newest published products on the home screen
+
+
+# ============================ SECTION LOADERS ============================
+# Each loader takes a cursor and returns the section's JSON-ready data; the standalone
+# endpoints (/hero-banners, ...) use the same loaders so both always agree.
+
+def load_hero_banners(cursor):
+    cursor.execute("""
+        SELECT id, title, image, position, created_at
+        FROM cms_banners
+        WHERE position = 'Hero Slider'
+          AND status = 'Active'
+        ORDER BY id ASC
+    """)
+    return [
+        {
+            "id": banner["id"],
+            "title": banner["title"],
+            "image_url": banner["image"],
+            "position": banner["position"],
+            "created_at": banner["created_at"].isoformat() if banner["created_at"] else None
+        }
+        for banner in cursor.fetchall()
+    ]
+
+
+def load_category_banners(cursor):
+    cursor.execute("""
+        SELECT id, category, image_url
+        FROM cms_category_banners
+        WHERE status = TRUE
+        ORDER BY id ASC
+    """)
+    return [
+        {"id": b["id"], "category": b["category"], "image_url": b["image_url"]}
+        for b in cursor.fetchall()
+    ]
+
+
+def load_cms_pages(cursor):
+    cursor.execute("""
+        SELECT id, title, slug, content, status, updated_at
+        FROM cms_pages
+        WHERE status = 'Published'
+        ORDER BY id ASC
+    """)
+    return [
+        {
+            "id": page["id"],
+            "title": page["title"],
+            "slug": page["slug"],
+            "content": page["content"],
+            "status": page["status"],
+            "updated_at": page["updated_at"].isoformat() if page["updated_at"] else None
+        }
+        for page in cursor.fetchall()
+    ]
+
+
+def load_new_products(cursor, limit=BOOTSTRAP_PRODUCTS):
+    """Newest published products with their review stats, unpriced (see price_products)."""
+    cursor.execute("""
+        SELECT
+            p.id, p.name, p.colors, p.brand_name, p.category, p.description, p.status, p.stock, p.image,
+            p.created_at, p.updated_at,
+            p.b2c_price, p.b2b_price,
+            p.b2c_active_offer, p.b2b_active_offer,
+            p.b2c_offer_price, p.b2b_offer_price,
+            p.b2c_discount, p.b2b_discount,
+            p.b2c_offer_start_date, p.b2c_offer_end_date, p.sgst,
+            p.cgst, p.b2b_offer_start_date, p.b2b_offer_end_date,
+            p.compare_at_price, p.info,
+            p.weight, p.length, p.breadth, p.return_policy, p.height, p.hsn,
+            r.review_count, r.avg_rating
+        FROM products p
+        LEFT JOIN LATERAL (
+            SELECT COUNT(*) AS review_count, AVG(rating) AS avg_rating
+            FROM product_reviews pr
+            WHERE pr.product_id = p.id
+        ) r ON TRUE
+        WHERE p.status = 'Published'
+        ORDER BY p.created_at DESC
+        LIMIT %s
+    """, (limit,))
+    return cursor.fetchall()
+
+
+def load_user_type(cursor, user_id):
+    cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM b2b_applications WHERE user_id::text = %s AND status = 'approved'
+        ) AS is_b2b
+    """, (str(user_id),))
+    row = cursor.fetchone()
+    return "b2b" if (row["is_b2b"] if isinstance(row, dict) else row[0]) else "b2c"
+
+
+def price_products(rows, user_type, normalize_dates, now=None):
+    """The /products response shape for one tier: current/original price, discount and rating."""
+    now = now or datetime.now()
+    products = []
+    for row in rows:
+        product = dict(row)
+        review_count = product.pop("review_count")
+        avg_rating = product.pop("avg_rating")
+        product["reviews"] = review_count or 0
+        product["rating"] = round(avg_rating, 2) if avg_rating else 0
+        normalize_dates(product)
+        current_price, original_price, discount = resolve_price(product, user_type, now)
+        product["current_price"] = current_price
+        product["original_price"] = original_price
+        product["discount_percentage"] = discount
+        products.append(product)
+    return products
+
+
+# ============================ VERSIONS ============================
+
+def section_version(data):
+    """Content hash of a section; the client sends it back to skip unchanged sections."""
+    encoded = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def parse_versions(raw):
+    """'hero_banners:ab12,cms_pages:cd34' -> {'hero_banners': 'ab12', 'cms_pages': 'cd34'}."""
+    versions = {}
+    for part in (raw or "").split(","):
+        name, _, version = part.strip().partition(":")
+        if name and version:
+            versions[name] = version
+    return versions
+
+
+def build_section(data, known_version=None, version=None):
+    version = version or section_version(data)
+    if version == known_version:
+        return {"version": version, "unchanged": True}
+    return {"version": version, "data": data}
+
+
+def with_connection(connect, loader, *args):
+    """Runs one loader on its own connection (sections are loaded in parallel threads)."""
+    conn = connect()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        result = loader(cursor, *args)
+        conn.commit()
+        return result
+    finally:
+        cursor.close()
+        conn.close()
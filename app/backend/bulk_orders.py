@@ -0,0 +1,353 @@
+import csv
+import io
+import json
+import os
+import re
+import time
+import uuid
+from datetime import datetime
+
+from psycopg2.extras import RealDictCursor, execute_values
+
+from pricing import resolve_price
+from shipping import calculate_mock_shipping, chargeable_weight
+from tax import TaxLine, compute_tax
+from inventory import InsufficientStock, reserve
+
+BULK_ORDER_MAX_LINES = int(os.getenv("BULK_ORDER_MAX_LINES", 5000))
+
+PRODUCT_ID_HEADERS = {"product_id", "productid", "product id", "sku", "id"}
+QUANTITY_HEADERS = {"quantity", "qty"}
+# Product ids (products.id is numeric) and quantities are whole numbers; spreadsheets
+# may hand them over as "42.0"
+WHOLE_NUMBER_PATTERN = re.compile(r"(\d+)(?:\.0+)?")
+
+
+class BulkOrderError(Exception):
+    """Raised when the uploaded file itself can't be read (not for bad lines)."""
+
+
+# ============================ PARSING ============================
+
+def _iter_csv_rows(fileobj):
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    try:
+        yield from csv.reader(text)
+    finally:
+        text.detach()  # leave the underlying upload open for FastAPI to clean up
+
+
+def _iter_xlsx_rows(fileobj):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise BulkOrderError("XLSX uploads need openpyxl installed on the server; upload a CSV instead")
+
+    # read_only mode streams rows from the sheet XML instead of building the whole workbook
+    workbook = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield ["" if cell is None else str(cell) for cell in row]
+    finally:
+        workbook.close()
+
+
+def iter_order_lines(fileobj, filename):
+    """
+    Yields (line_no, product_id, quantity, error) for every non-empty row.
+    Accepts an optional header row; without one the first two columns are product id and quantity.
+    """
+    is_xlsx = (filename or "").lower().endswith((".xlsx", ".xlsm"))
+    rows = _iter_xlsx_rows(fileobj) if is_xlsx else _iter_csv_rows(fileobj)
+
+    id_col, qty_col = 0, 1
+    count = 0
+    for line_no, row in enumerate(rows, start=1):
+        cells = [c.strip() for c in row]
+        if not any(cells):
+            continue
+
+        if line_no == 1:
+            header = [c.lower() for c in cells]
+            if any(h in PRODUCT_ID_HEADERS for h in header):
+                id_col = next(i for i, h in enumerate(header) if h in PRODUCT_ID_HEADERS)
+                qty_col = next((i for i, h in enumerate(header) if h in QUANTITY_HEADERS), 1)
+                continue
+
+        count += 1
+        if count > BULK_ORDER_MAX_LINES:
+            raise BulkOrderError(f"File has more than {BULK_ORDER_MAX_LINES} lines")
+
+        product_id = cells[id_col] if len(cells) > id_col else ""
+        raw_qty = cells[qty_col] if len(cells) > qty_col else ""
+
+        if not product_id:
+            yield line_no, product_id, 0, "Missing product id"
+            continue
+        # Checked here so a bad id is this line's error rather than a failed lookup for the whole file
+        match = WHOLE_NUMBER_PATTERN.fullmatch(product_id)
+        if not match:
+            yield line_no, product_id, 0, f"Invalid product id '{product_id}'"
+            continue
+        product_id = match.group(1)
+        match = WHOLE_NUMBER_PATTERN.fullmatch(raw_qty)
+        if not match:
+            yield line_no, product_id, 0, f"Invalid quantity '{raw_qty}'"
+            continue
+        quantity = int(match.group(1))
+        if quantity < 1:
+            yield line_no, product_id, quantity, "Quantity must be at least 1"
+            continue
+
+        yield line_no, product_id, quantity, None
+
+
+# ============================ VALIDATION ============================
+
+def fetch_products(cursor, product_ids):
+    """One batched lookup for every distinct product id in the file."""
+    if not product_ids:
+        return {}
+    cursor.execute("""
+        SELECT
+            id, name, image, status, stock, hsn, sgst, cgst,
+            weight, length, breadth, height,
+            b2c_price, b2b_price,
+            b2c_active_offer, b2b_active_offer,
+            b2c_offer_price, b2b_offer_price,
+            b2c_discount, b2b_discount,
+            b2c_offer_start_date, b2c_offer_end_date,
+            b2b_offer_start_date, b2b_offer_end_date
+        FROM products
+        WHERE id IN %s
+    """, (tuple(product_ids),))
+    return {str(row["id"]): row for row in cursor.fetchall()}
+
+
+def validate_lines(lines, products, user_type, normalize_dates):
+    """
+    Prices every line against the fetched products and checks stock on the summed
+    quantity per product. Returns the per-line report.
+    """
+    now = datetime.now()
+    requested = {}
+    for _, product_id, quantity, error in lines:
+        if not error:
+            requested[product_id] = requested.get(product_id, 0) + quantity
+
+    prices = {}
+    for product_id, product in products.items():
+        normalize_dates(product)
+        prices[product_id] = resolve_price(product, user_type, now)[0]
+
+    report = []
+    for line_no, product_id, quantity, error in lines:
+        entry = {"line": line_no, "product_id": product_id, "quantity": quantity}
+        product = products.get(product_id)
+
+        if not error:
+            if product is None:
+                error = "Unknown product"
+            elif product["status"] != "Published":
+                error = "Product is not available"
+            elif (product["stock"] or 0) < requested[product_id]:
+                error = f"Insufficient stock (available: {product['stock'] or 0}, requested: {requested[product_id]})"
+            elif prices[product_id] <= 0:
+                error = "Product has no price for this account type"
+
+        if error:
+            entry.update({"status": "error", "error": error})
+        else:
+            unit_price = prices[product_id]
+            entry.update({
+                "status": "ok",
+                "name": product["name"],
+                "unit_price": unit_price,
+                "line_total": round(unit_price * quantity, 2),
+            })
+        report.append(entry)
+
+    return report
+
+
+# ============================ ORDER CREATION ============================
+
+def create_bulk_order(cursor, customer, report, products, payment_method):
+    """
+    Inserts the order header and all order_items with batched statements.
+    `customer` is the row returned by load_bulk_customer.
+    """
+    ok_lines = [r for r in report if r["status"] == "ok"]
+    # The random suffix keeps two uploads in the same millisecond from sharing an id
+    order_id = f"BULK{int(time.time() * 1000)}{uuid.uuid4().hex[:6].upper()}"
+
+    subtotal = 0.0
+    tax_lines = []
+    shipping_items = []
+    for line in ok_lines:
+        product = products[line["product_id"]]
+        subtotal += line["line_total"]
+        tax_lines.append(TaxLine(product["hsn"], line["line_total"], product["sgst"], product["cgst"]))
+        shipping_items.append({
+            "quantity": line["quantity"],
+            "weight": product["weight"],
+            "length": product["length"],
+            "breadth": product["breadth"],
+            "height": product["height"],
+        })
+
+    weight = chargeable_weight(shipping_items)
+    shipping_fee = calculate_mock_shipping(weight)
+    tax = compute_tax(cursor, tax_lines, customer["state"])
+    total = round(subtotal + tax["total_tax"] + shipping_fee, 2)
+
+    cursor.execute("""
+        INSERT INTO orders (
+            order_id, customer, email, phone, amount, shipping_fee,
+            state_gst_amount, central_gst_amount, igst_amount, sgst_percentage, cgst_percentage,
+            items_count, customer_type, status, payment, payment_method, products, created_at,
+            address, weight, city, state, pincode, original_price, customer_name
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """, (
+        order_id,
+        customer["id"],
+        customer["email"],
+        customer["phone_number"],
+        total,
+        shipping_fee,
+        tax["sgst_amount"],
+        tax["cgst_amount"],
+        tax["igst_amount"],
+        tax["sgst_percentage"],
+        tax["cgst_percentage"],
+        len(ok_lines),
+        customer["user_type"],
+        "processing",
+        "pending",
+        payment_method,
+        "[]",
+        datetime.now(),
+        customer["address_text"],
+        weight,
+        customer["city"],
+        customer["state"],
+        customer["pincode"],
+        round(subtotal, 2),
+        customer["full_name"],
+    ))
+    db_order_id = cursor.fetchone()["id"]
+
+    item_ids = execute_values(cursor, """
+        INSERT INTO order_items (order_id, product_id, product_name, image, unit_price, quantity, item_total,
+                                 hsn, gst_rate)
+        VALUES %s
+        RETURNING id
+    """, [
+        (order_id, line["product_id"], line["name"], products[line["product_id"]]["image"],
+         line["unit_price"], line["quantity"], line["line_total"], line_tax["hsn"], line_tax["rate"])
+        for line, line_tax in zip(ok_lines, tax["lines"])
+    ], page_size=1000, fetch=True)
+
+    created_items = []
+    for line, item in zip(ok_lines, item_ids):
+        line["order_item_id"] = item["id"]
+        created_items.append({
+            "order_item_id": item["id"],
+            "product_id": line["product_id"],
+            "name": line["name"],
+            "imageUrl": products[line["product_id"]]["image"],
+            "price": line["unit_price"],
+            "quantity": line["quantity"],
+            "item_total": line["line_total"],
+            "hsnCode": products[line["product_id"]]["hsn"] or "",
+        })
+
+    # B2B bulk orders are invoiced, so the stock is taken outright rather than held
+    reserve(cursor, order_id, [(line["product_id"], line["quantity"]) for line in ok_lines])
+
+    cursor.execute("UPDATE orders SET products = %s WHERE id = %s", (json.dumps(created_items), db_order_id))
+
+    return {
+        "order_id": order_id,
+        "subtotal": round(subtotal, 2),
+        "state_gst_amount": tax["sgst_amount"],
+        "central_gst_amount": tax["cgst_amount"],
+        "igst_amount": tax["igst_amount"],
+        "tax_breakdown": tax["summary"],
+        "shipping_fee": shipping_fee,
+        "total": total,
+        "items_count": len(ok_lines),
+    }
+
+
+def load_bulk_customer(cursor, user_id, address_id=None):
+    """User, tier and shipping address (given one or the default) in a single query."""
+    cursor.execute("""
+        SELECT
+            au.id, au.email, au.full_name, au.phone_number,
+            b2b.status AS b2b_status,
+            a.address, a.city, a.state, a.pincode, a.country
+        FROM auth_users au
+        LEFT JOIN b2b_applications b2b ON b2b.user_id = au.id
+        LEFT JOIN LATERAL (
+            SELECT ad.*
+            FROM user_addresses ua JOIN addresses ad ON ad.id = ua.address_id
+            WHERE ua.user_id = au.id AND (ua.id::text = %s OR ad.id::text = %s OR %s IS NULL)
+            ORDER BY ua.is_default DESC, ua.created_at DESC
+            LIMIT 1
+        ) a ON TRUE
+        WHERE au.id = %s
+    """, (address_id, address_id, address_id, user_id))
+    row = cursor.fetchone()
+    if not row:
+        return None
+
+    customer = dict(row)
+    customer["user_type"] = "b2b" if row["b2b_status"] == "approved" else "b2c"
+    customer["address_text"] = ", ".join(
+        str(part) for part in (row["address"], row["city"], row["state"], row["pincode"], row["country"]) if part
+    )
+    return customer
+
+
+def process_bulk_order(conn, user_id, fileobj, filename, address_id, payment_method, allow_partial, normalize_dates):
+    """
+    Runs the whole upload: stream-parse, one product lookup, validate, batched insert.
+    Returns (created, response_body).
+    """
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        customer = load_bulk_customer(cursor, user_id, address_id)
+        if not customer:
+            raise BulkOrderError("User not found")
+        if not customer["address"]:
+            raise BulkOrderError("No shipping address found; add an address first")
+
+        # Lines are kept as small tuples so memory stays proportional to the line cap
+        lines = list(iter_order_lines(fileobj, filename))
+        if not lines:
+            raise BulkOrderError("File contains no order lines")
+
+        product_ids = {product_id for _, product_id, _, error in lines if not error}
+        products = fetch_products(cursor, product_ids)
+        report = validate_lines(lines, products, customer["user_type"], normalize_dates)
+
+        errors = sum(1 for r in report if r["status"] == "error")
+        summary = {"lines": len(report), "accepted": len(report) - errors, "rejected": errors}
+
+        if errors == len(report) or (errors and not allow_partial):
+            return False, {"success": False, "summary": summary, "lines": report}
+
+        try:
+            order = create_bulk_order(cursor, customer, report, products, payment_method)
+        except InsufficientStock as e:
+            # Stock moved between validation and the row locks
+            raise BulkOrderError(str(e))
+        conn.commit()
+        return True, {"success": True, "order": order, "summary": summary, "lines": report}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
@@ -0,0 +1,329 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from coupons import CouponError, evaluate_coupon
+from pricing import next_offer_boundary, resolve_price
+from shipping import calculate_mock_shipping, chargeable_weight
+from tax import TaxLine, compute_tax, tax_engine
+from variants import normalize_color
+
+# A priced snapshot is reused until the cart/products change, an offer window
+# opens or closes, or this many seconds pass (coupon usage and stock can move underneath).
+CART_PRICE_TTL = int(os.getenv("CART_PRICE_TTL", 300))
+CART_CACHE_SIZE = int(os.getenv("CART_CACHE_SIZE", 2048))
+
+_priced_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+# ============================ CART STATE ============================
+
+def get_cart_state(cursor, user_id):
+    """
+    Creates the cart on first use and returns its cache fingerprint inputs in one query:
+    version, coupon, pincode, tier, the default address' state (for the GST split),
+    the newest updated_at and the stock of the products in it, and the coupon's row.
+    """
+    query = """
+        WITH ins AS (
+            INSERT INTO carts (user_id)
+            SELECT %(user_id)s
+            WHERE NOT EXISTS (SELECT 1 FROM carts WHERE user_id = %(user_id)s)
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING id, version, coupon_code, delivery_pincode
+        ),
+        c AS (
+            SELECT id, version, coupon_code, delivery_pincode FROM carts WHERE user_id = %(user_id)s
+            UNION ALL
+            SELECT * FROM ins
+        )
+        SELECT
+            c.id, c.version, c.coupon_code, c.delivery_pincode,
+            CASE WHEN EXISTS (
+                SELECT 1 FROM b2b_applications b
+                WHERE b.user_id::text = %(user_id)s AND b.status = 'approved'
+            ) THEN 'b2b' ELSE 'b2c' END AS user_type,
+            lines.products_updated_at, lines.line_stock,
+            -- Redemptions and admin edits don't touch the cart, so the coupon row is part of the key
+            cp.used_count AS coupon_used_count, cp.status AS coupon_status, md5(cp::text) AS coupon_version,
+            (
+                SELECT a.state
+                FROM user_addresses ua JOIN addresses a ON a.id = ua.address_id
+                WHERE ua.user_id::text = %(user_id)s
+                ORDER BY ua.is_default DESC, ua.created_at DESC
+                LIMIT 1
+            ) AS customer_state
+        FROM c
+        LEFT JOIN LATERAL (
+            -- Stock moves with every checkout without touching products.updated_at
+            SELECT GREATEST(MAX(p.updated_at), MAX(v.updated_at)) AS products_updated_at,
+                   string_agg(p.stock || '/' || COALESCE(v.stock::text, ''), ',' ORDER BY ci.product_id, ci.color)
+                       AS line_stock
+            FROM cart_items ci
+            JOIN products p ON p.id::text = ci.product_id
+            LEFT JOIN product_variants v ON v.product_id = ci.product_id AND v.color = ci.color
+            WHERE ci.cart_id = c.id
+        ) lines ON TRUE
+        LEFT JOIN coupons cp ON cp.code = c.coupon_code
+    """
+    cursor.execute(query, {"user_id": user_id})
+    state = cursor.fetchone()
+    if state is None:
+        # Lost a create race with a concurrent request; the row is visible now
+        cursor.execute(query, {"user_id": user_id})
+        state = cursor.fetchone()
+    return state
+
+
+def _touch(cursor, cart_id):
+    cursor.execute("UPDATE carts SET version = version + 1, updated_at = NOW() WHERE id = %s", (cart_id,))
+
+
+def add_item(cursor, cart_id, product_id, quantity, color=None):
+    cursor.execute("""
+        INSERT INTO cart_items (cart_id, product_id, color, quantity)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (cart_id, product_id, color)
+        DO UPDATE SET quantity = cart_items.quantity + EXCLUDED.quantity
+    """, (cart_id, product_id, normalize_color(color), quantity))
+    _touch(cursor, cart_id)
+
+
+def set_item_quantity(cursor, cart_id, product_id, quantity, color=None):
+    """Sets an absolute quantity; 0 removes the line. Returns False if the line didn't exist."""
+    if quantity <= 0:
+        return remove_item(cursor, cart_id, product_id, color)
+    cursor.execute(
+        "UPDATE cart_items SET quantity = %s WHERE cart_id = %s AND product_id = %s AND color = %s",
+        (quantity, cart_id, product_id, normalize_color(color))
+    )
+    if cursor.rowcount == 0:
+        return False
+    _touch(cursor, cart_id)
+    return True
+
+
+def remove_item(cursor, cart_id, product_id, color=None):
+    cursor.execute(
+        "DELETE FROM cart_items WHERE cart_id = %s AND product_id = %s AND color = %s",
+        (cart_id, product_id, normalize_color(color))
+    )
+    if cursor.rowcount == 0:
+        return False
+    _touch(cursor, cart_id)
+    return True
+
+
+def clear_cart(cursor, cart_id):
+    cursor.execute("DELETE FROM cart_items WHERE cart_id = %s", (cart_id,))
+    cursor.execute("UPDATE carts SET coupon_code = NULL WHERE id = %s", (cart_id,))
+    _touch(cursor, cart_id)
+
+
+def set_coupon(cursor, cart_id, coupon_code):
+    cursor.execute("UPDATE carts SET coupon_code = %s WHERE id = %s", (coupon_code, cart_id))
+    _touch(cursor, cart_id)
+
+
+def set_pincode(cursor, cart_id, pincode):
+    cursor.execute("UPDATE carts SET delivery_pincode = %s WHERE id = %s", (pincode, cart_id))
+    _touch(cursor, cart_id)
+
+
+# ============================ PRICING ============================
+
+def _fetch_pricing_rows(cursor, cart_id):
+    """Every input the pricing pass needs (items, products, variants, coupon) in a single query."""
+    cursor.execute("""
+        SELECT
+            ci.product_id, ci.color, ci.quantity,
+            v.stock AS variant_stock, v.b2c_price AS variant_b2c_price, v.b2b_price AS variant_b2b_price,
+            EXISTS (
+                SELECT 1 FROM product_variants x WHERE x.product_id = ci.product_id
+            ) AS has_variants,
+            p.id AS found_product, p.name, p.image, p.status, p.stock, p.hsn, p.sgst, p.cgst,
+            p.weight, p.length, p.breadth, p.height,
+            p.b2c_price, p.b2b_price,
+            p.b2c_active_offer, p.b2b_active_offer,
+            p.b2c_offer_price, p.b2b_offer_price,
+            p.b2c_discount, p.b2b_discount,
+            p.b2c_offer_start_date, p.b2c_offer_end_date,
+            p.b2b_offer_start_date, p.b2b_offer_end_date,
+            cp.code AS coupon_code, cp.status AS coupon_status, cp.expiry AS coupon_expiry,
+            cp.used_count AS coupon_used_count, cp.usage_limit AS coupon_usage_limit,
+            cp.min_order_value AS coupon_min_order_value, cp.customer_type AS coupon_customer_type,
+            cp.discount_type AS coupon_discount_type, cp.discount_value AS coupon_discount_value
+        FROM carts c
+        LEFT JOIN cart_items ci ON ci.cart_id = c.id
+        LEFT JOIN products p ON p.id::text = ci.product_id
+        LEFT JOIN product_variants v ON v.product_id = ci.product_id AND v.color = ci.color
+        LEFT JOIN coupons cp ON cp.code = c.coupon_code
+        WHERE c.id = %s
+        ORDER BY ci.added_at
+    """, (cart_id,))
+    return cursor.fetchall()
+
+
+def price_cart(cursor, state, normalize_dates):
+    """
+    Single pricing pass: tier price per line, GST by HSN (tax.py) on the discounted value,
+    coupon discount and a shipping estimate from the chargeable weight.
+    """
+    rows = _fetch_pricing_rows(cursor, state["id"])
+    user_type = state["user_type"]
+    tier = "b2b" if user_type == "b2b" else "b2c"
+    now = datetime.now()
+    valid_until = now + timedelta(seconds=CART_PRICE_TTL)
+
+    items = []
+    priced = []
+    for row in rows:
+        if row["product_id"] is None:
+            continue  # empty cart still returns one row for the coupon join
+
+        item = {"product_id": row["product_id"], "color": row["color"], "quantity": row["quantity"], "available": True}
+        if row["found_product"] is None:
+            item.update({"available": False, "error": "Product no longer exists"})
+            items.append(item)
+            continue
+
+        product = dict(row)
+        normalize_dates(product)
+        boundary = next_offer_boundary(product, tier, now)
+        if boundary and boundary < valid_until:
+            valid_until = boundary
+
+        unit_price, original_price, discount_pct = resolve_price(product, user_type, now)
+        override = row[f"variant_{tier}_price"]
+        if override is not None:
+            unit_price = float(override)
+            discount_pct = round((original_price - unit_price) / original_price * 100, 2) if original_price > 0 else 0
+        item.update({
+            "name": row["name"],
+            "image": row["image"],
+            "hsn": row["hsn"] or "",
+            "unit_price": unit_price,
+            "original_price": original_price,
+            "discount_percentage": discount_pct,
+            "line_total": round(unit_price * row["quantity"], 2),
+        })
+
+        if row["status"] != "Published":
+            item.update({"available": False, "error": "Product is not available"})
+        elif (row["stock"] or 0) < row["quantity"]:
+            item.update({"available": False, "error": f"Only {row['stock'] or 0} left in stock"})
+        elif row["has_variants"] and row["color"]:
+            if row["variant_stock"] is None:
+                item.update({"available": False, "error": "Selected colour is not available"})
+            elif row["variant_stock"] < row["quantity"]:
+                item.update({"available": False, "error": f"Only {row['variant_stock']} left in this colour"})
+        items.append(item)
+        if item["available"]:
+            priced.append((item, row))
+
+    subtotal = round(sum(item["line_total"] for item, _ in priced), 2)
+
+    # ---------------- COUPON ----------------
+    coupon_info = None
+    discount = 0.0
+    first = rows[0] if rows else None
+    if first and state["coupon_code"]:
+        coupon_info = {"code": state["coupon_code"], "applied": False}
+        if first["coupon_code"] is None:
+            coupon_info["message"] = "Invalid coupon code"
+        else:
+            coupon = {
+                "status": first["coupon_status"],
+                "expiry": first["coupon_expiry"],
+                "used_count": first["coupon_used_count"],
+                "usage_limit": first["coupon_usage_limit"],
+                "customer_type": first["coupon_customer_type"],
+                "min_order_value": first["coupon_min_order_value"],
+                "discount_type": first["coupon_discount_type"],
+                "discount_value": first["coupon_discount_value"],
+            }
+            try:
+                discount = evaluate_coupon(coupon, subtotal, tier=tier)
+                coupon_info.update({"applied": True, "discount_amount": discount})
+            except CouponError as e:
+                coupon_info["message"] = str(e)
+
+    # ---------------- TAX (by HSN, on discounted value) ----------------
+    discount_ratio = (discount / subtotal) if subtotal else 0
+    tax = compute_tax(cursor, [
+        TaxLine(item["hsn"], item["line_total"] * (1 - discount_ratio), row["sgst"], row["cgst"])
+        for item, row in priced
+    ], state["customer_state"])
+    for (item, _), line in zip(priced, tax["lines"]):
+        item["gst_rate"] = line["rate"]
+
+    # ---------------- SHIPPING ESTIMATE ----------------
+    shipping_fee = 0.0
+    weight = 0.0
+    if priced:
+        weight = chargeable_weight([
+            {"quantity": item["quantity"], "weight": row["weight"], "length": row["length"],
+             "breadth": row["breadth"], "height": row["height"]}
+            for item, row in priced
+        ])
+        shipping_fee = calculate_mock_shipping(weight)
+
+    return {
+        "cart_id": str(state["id"]),
+        "version": state["version"],
+        "user_type": user_type,
+        "items": items,
+        "items_count": len(priced),
+        "subtotal": subtotal,
+        "coupon": coupon_info,
+        "discount_amount": discount,
+        "state_gst_amount": tax["sgst_amount"],
+        "central_gst_amount": tax["cgst_amount"],
+        "igst_amount": tax["igst_amount"],
+        "interstate": tax["interstate"],
+        "tax_breakdown": tax["summary"],
+        "delivery_pincode": state["delivery_pincode"],
+        "chargeable_weight": weight,
+        "shipping_fee": shipping_fee,
+        "total": round(subtotal - discount + tax["total_tax"] + shipping_fee, 2),
+        "priced_at": now.isoformat(),
+        "valid_until": valid_until,
+    }
+
+
+# ============================ SNAPSHOT CACHE ============================
+
+def _fingerprint(state):
+    return (state["version"], state["user_type"], state["products_updated_at"], state["line_stock"],
+            state["coupon_used_count"], state["coupon_status"], state["coupon_version"],
+            state["customer_state"], tax_engine.version)
+
+
+def get_priced_cart(cursor, user_id, normalize_dates):
+    """Returns the priced cart, re-running the pricing pass only when an input changed."""
+    state = get_cart_state(cursor, user_id)
+    tax_engine.refresh(cursor)
+    key = str(state["id"])
+    fingerprint = _fingerprint(state)
+
+    with _cache_lock:
+        cached = _priced_cache.get(key)
+        if cached and cached[0] == fingerprint and cached[1]["valid_until"] > datetime.now():
+            _priced_cache.move_to_end(key)
+            return cached[1]
+
+    snapshot = price_cart(cursor, state, normalize_dates)
+
+    with _cache_lock:
+        _priced_cache[key] = (fingerprint, snapshot)
+        _priced_cache.move_to_end(key)
+        while len(_priced_cache) > CART_CACHE_SIZE:
+            _priced_cache.popitem(last=False)
+    return snapshot
+
+
+def serialize_cart(snapshot):
+    """Response shape for the cart endpoints (valid_until is internal)."""
+    return {k: v for k, v in snapshot.items() if k != "valid_until"}
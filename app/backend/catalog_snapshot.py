@@ -0,0 +1,346 @@
+import json
+import math
+import mmap
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+
+# Read today only by /bootstrap's new-products section (main.py); every other catalogue
+# read still queries products, and nothing per-request (tier pricing, pincode) lives here.
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", ".catalog/catalog.snap")
+SNAPSHOT_CHECK_INTERVAL = 1.0  # seconds between stat() probes for a new generation
+SNAPSHOT_MIN_INTERVAL = int(os.getenv("SNAPSHOT_MIN_INTERVAL", 5))  # loader debounce after a change
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", 300))  # loader rebuilds at least this often (stock, reviews)
+
+# File layout (little-endian, every section 8-byte aligned):
+#   header     MAGIC, format, generation, created_at, rows, columns
+#   directory  one entry per column: name, kind, offset, length
+#   columns    INT/BOOL: int64[rows] | FLOAT/TIME: float64[rows]
+#              STR/JSON: uint8 valid[rows] (padded), int64 offsets[rows + 1], utf-8 blob
+# Rows are sorted by id (binary search); the _recent column lists row numbers newest first.
+MAGIC = b"SNCATLG\x00"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIQdII")
+DIRECTORY_ENTRY = struct.Struct("<24sB7xQQ")
+
+INT, FLOAT, BOOL, TIME, STR, JSON = range(6)
+INT_NULL = -2 ** 63
+
+CATALOG_COLUMNS = (
+    ("id", STR), ("name", STR), ("colors", JSON), ("brand_name", STR), ("category", STR),
+    ("description", STR), ("status", STR), ("stock", INT), ("image", STR),
+    ("created_at", TIME), ("updated_at", TIME),
+    ("b2c_price", FLOAT), ("b2b_price", FLOAT),
+    ("b2c_active_offer", BOOL), ("b2b_active_offer", BOOL),
+    ("b2c_offer_price", FLOAT), ("b2b_offer_price", FLOAT),
+    ("b2c_discount", FLOAT), ("b2b_discount", FLOAT),
+    ("b2c_offer_start_date", TIME), ("b2c_offer_end_date", TIME),
+    ("b2b_offer_start_date", TIME), ("b2b_offer_end_date", TIME),
+    ("sgst", FLOAT), ("cgst", FLOAT), ("compare_at_price", FLOAT), ("info", JSON),
+    ("weight", FLOAT), ("length", FLOAT), ("breadth", FLOAT), ("height", FLOAT),
+    ("return_policy", STR), ("hsn", STR),
+    ("review_count", INT), ("avg_rating", FLOAT),
+)
+
+
+# ============================ WRITER (loader process) ============================
+
+def _epoch(value):
+    if value is None:
+        return math.nan
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return math.nan
+
+
+def _pad(buf):
+    buf.extend(b"\x00" * (-len(buf) % 8))
+
+
+def _encode_column(kind, values):
+    buf = bytearray()
+    if kind in (INT, BOOL):
+        buf.extend(array("q", [INT_NULL if v is None else int(v) for v in values]).tobytes())
+    elif kind == FLOAT:
+        buf.extend(array("d", [math.nan if v is None else float(v) for v in values]).tobytes())
+    elif kind == TIME:
+        buf.extend(array("d", [_epoch(v) for v in values]).tobytes())
+    else:
+        encoded = [
+            None if v is None else (json.dumps(v, default=str) if kind == JSON else str(v)).encode()
+            for v in values
+        ]
+        buf.extend(bytes(0 if e is None else 1 for e in encoded))
+        _pad(buf)
+        offsets = array("q", [0])
+        for e in encoded:
+            offsets.append(offsets[-1] + len(e or b""))
+        buf.extend(offsets.tobytes())
+        for e in encoded:
+            buf.extend(e or b"")
+    _pad(buf)
+    return buf
+
+
+def write_snapshot(path, rows, generation, columns=CATALOG_COLUMNS):
+    """
+    Writes rows (dicts) as a new generation. The file is built next to `path` and moved
+    into place with os.replace, so readers see either the old file or the new one.
+    """
+    rows = sorted(rows, key=lambda r: str(r["id"]))
+    recent = sorted(range(len(rows)), key=lambda i: _epoch(rows[i].get("created_at")) or 0, reverse=True)
+    all_columns = (*columns, ("_recent", INT))
+
+    encoded = [_encode_column(kind, [r.get(name) for r in rows]) for name, kind in columns]
+    encoded.append(_encode_column(INT, recent))
+
+    data_start = HEADER.size + DIRECTORY_ENTRY.size * len(all_columns)
+    data_start += -data_start % 8
+    out = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, generation, time.time(), len(rows), len(all_columns)))
+    offset = data_start
+    for (name, kind), body in zip(all_columns, encoded):
+        out.extend(DIRECTORY_ENTRY.pack(name.encode(), kind, offset, len(body)))
+        offset += len(body)
+    _pad(out)
+    for body in encoded:
+        out.extend(body)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(out)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(out)
+
+
+def load_catalog_rows(cursor):
+    """Every product with its review stats, in the shape the snapshot stores."""
+    cursor.execute(f"""
+        SELECT {", ".join(f"p.{name}" for name, _ in CATALOG_COLUMNS if name not in ("review_count", "avg_rating"))},
+               COALESCE(r.review_count, 0) AS review_count, r.avg_rating
+        FROM products p
+        LEFT JOIN (
+            SELECT product_id, COUNT(*) AS review_count, AVG(rating) AS avg_rating
+            FROM product_reviews
+            GROUP BY product_id
+        ) r ON r.product_id::text = p.id::text
+    """)
+    return cursor.fetchall()
+
+
+def current_generation(path):
+    try:
+        with open(path, "rb") as f:
+            magic, _, generation, _, _, _ = HEADER.unpack(f.read(HEADER.size))
+        return generation if magic == MAGIC else 0
+    except (OSError, struct.error):
+        return 0
+
+
+def build_snapshot(conn, path=CATALOG_SNAPSHOT_PATH):
+    from psycopg2.extras import RealDictCursor
+
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        rows = load_catalog_rows(cursor)
+        conn.commit()
+    finally:
+        cursor.close()
+    generation = current_generation(path) + 1
+    size = write_snapshot(path, rows, generation)
+    return generation, len(rows), size
+
+
+# ============================ READER (API workers) ============================
+
+class CatalogSnapshot:
+    """
+    One generation, mapped read-only. Columns are memoryviews straight into the page
+    cache, so every worker mapping the same file shares one copy; opening costs a
+    header parse, not a load.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+        view = memoryview(self._map)
+        magic, version, self.generation, self.created_at, self.rows, ncols = HEADER.unpack_from(view)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a catalog snapshot (format {FORMAT_VERSION})")
+
+        self.kinds = {}
+        self._columns = {}
+        for i in range(ncols):
+            raw_name, kind, offset, length = DIRECTORY_ENTRY.unpack_from(view, HEADER.size + i * DIRECTORY_ENTRY.size)
+            name = raw_name.rstrip(b"\x00").decode()
+            self.kinds[name] = kind
+            section = view[offset:offset + length]
+            if kind in (INT, BOOL):
+                self._columns[name] = section[:self.rows * 8].cast("q")
+            elif kind in (FLOAT, TIME):
+                self._columns[name] = section[:self.rows * 8].cast("d")
+            else:
+                valid_len = self.rows + (-self.rows % 8)
+                offsets = section[valid_len:valid_len + (self.rows + 1) * 8].cast("q")
+                blob = section[valid_len + (self.rows + 1) * 8:]
+                self._columns[name] = (section[:self.rows], offsets, blob)
+
+    def __len__(self):
+        return self.rows
+
+    def value(self, name, i):
+        kind = self.kinds[name]
+        column = self._columns[name]
+        if kind in (STR, JSON):
+            valid, offsets, blob = column
+            if not valid[i]:
+                return None
+            text = bytes(blob[offsets[i]:offsets[i + 1]]).decode()
+            return json.loads(text) if kind == JSON else text
+        v = column[i]
+        if kind == INT:
+            return None if v == INT_NULL else v
+        if kind == BOOL:
+            return None if v == INT_NULL else bool(v)
+        if math.isnan(v):
+            return None
+        return datetime.fromtimestamp(v) if kind == TIME else v
+
+    def row(self, i):
+        return {name: self.value(name, i) for name, _ in CATALOG_COLUMNS}
+
+    def find(self, product_id):
+        """Row number for a product id, or None (binary search over the sorted id column)."""
+        product_id = str(product_id)
+        ids = _IdColumn(self)
+        i = bisect_left(ids, product_id)
+        return i if i < self.rows and ids[i] == product_id else None
+
+    def get(self, product_id):
+        i = self.find(product_id)
+        return None if i is None else self.row(i)
+
+    def recent(self, limit, status="Published"):
+        """Newest products first, optionally only those with `status`."""
+        order = self._columns["_recent"]
+        found = []
+        for i in order:
+            if status is None or self.value("status", i) == status:
+                found.append(self.row(i))
+                if len(found) >= limit:
+                    break
+        return found
+
+
+class _IdColumn:
+    """Sequence view of the id column for bisect."""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __len__(self):
+        return self._snapshot.rows
+
+    def __getitem__(self, i):
+        return self._snapshot.value("id", i)
+
+
+class CatalogStore:
+    """
+    The worker's handle on the current generation. current() re-stats the file at most
+    every SNAPSHOT_CHECK_INTERVAL seconds and maps the new generation when the loader
+    has replaced it; the swap is a single reference assignment, and requests still
+    holding the old generation keep reading it until they finish.
+    """
+
+    def __init__(self, path=CATALOG_SNAPSHOT_PATH):
+        self.path = path
+        self._snapshot = None
+        self._checked_at = 0.0
+
+    def current(self):
+        now = time.monotonic()
+        if now - self._checked_at >= SNAPSHOT_CHECK_INTERVAL:
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+                identity = (stat.st_ino, stat.st_mtime_ns)
+                if self._snapshot is None or self._snapshot.identity != identity:
+                    self._snapshot = CatalogSnapshot(self.path)
+            except (OSError, ValueError) as e:
+                if self._snapshot is None and not isinstance(e, FileNotFoundError):
+                    print(f"Catalog snapshot unavailable: {e}")
+        return self._snapshot
+
+    def status(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {"loaded": False, "path": self.path}
+        return {
+            "loaded": True,
+            "path": self.path,
+            "generation": snapshot.generation,
+            "rows": snapshot.rows,
+            "age_seconds": round(time.time() - snapshot.created_at, 1),
+        }
+
+
+catalog = CatalogStore()
+
+
+if __name__ == "__main__":
+    # Loader: python catalog_snapshot.py [--watch]
+    # With --watch it rebuilds after product_changed notifications (debounced) and at
+    # least every SNAPSHOT_MAX_AGE seconds.
+    import argparse
+    import select
+
+    import psycopg2.extensions
+
+    from database import get_db_connection
+
+    parser = argparse.ArgumentParser(description="Build the shared catalog snapshot")
+    parser.add_argument("--path", default=CATALOG_SNAPSHOT_PATH)
+    parser.add_argument("--watch", action="store_true")
+    args = parser.parse_args()
+
+    def build(conn):
+        started = time.perf_counter()
+        generation, count, size = build_snapshot(conn, args.path)
+        print(f"Generation {generation}: {count} products, {size / 1024:.0f} KiB "
+              f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    connection = get_db_connection()
+    build(connection)
+    if args.watch:
+        listener = get_db_connection()
+        listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        listener.cursor().execute("LISTEN product_changed")
+        last_build = time.monotonic()
+        dirty = False
+        while True:
+            if select.select([listener], [], [], SNAPSHOT_MIN_INTERVAL) != ([], [], []):
+                listener.poll()
+                if listener.notifies:
+                    listener.notifies.clear()
+                    dirty = True
+            since = time.monotonic() - last_build
+            if (dirty and since >= SNAPSHOT_MIN_INTERVAL) or since >= SNAPSHOT_MAX_AGE:
+                build(connection)
+                last_build = time.monotonic()
+                dirty = False
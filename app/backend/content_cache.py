@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+from bootstrap import section_version
+
+CONTENT_CHANGED_CHANNEL = "content_changed"
+CONTENT_CACHE_TTL = float(os.getenv("CONTENT_CACHE_TTL", 300))  # served as-is
+CONTENT_CACHE_STALE = float(os.getenv("CONTENT_CACHE_STALE", 3600))  # served while a refresh runs
+CONTENT_MAX_AGE = 60  # Cache-Control max-age for clients
+
+
+class CachedContent:
+    __slots__ = ("data", "version", "body", "etag", "fetched_at")
+
+    def __init__(self, data):
+        self.data = data
+        self.version = section_version(data)
+        # Pre-serialized once per refresh; handlers send these bytes as they are
+        self.body = json.dumps({"success": True, "data": data}, separators=(",", ":"), default=str).encode()
+        self.etag = f'"{self.version}"'
+        self.fetched_at = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+
+class ContentCache:
+    """
+    Static-ish content (banners, CMS pages) kept as ready-to-send JSON bytes.
+
+    - fresh (younger than ttl): served without touching the DB
+    - stale (within ttl + stale): served immediately, refreshed in the background
+    - older, missing or invalidated: refreshed inline, one refresh per section at a time
+    - a refresh that fails serves whatever copy there is, however old
+
+    Loaders are blocking callables returning JSON-ready data; they run in the threadpool.
+    """
+
+    def __init__(self, ttl=CONTENT_CACHE_TTL, stale=CONTENT_CACHE_STALE):
+        self.ttl = ttl
+        self.stale = stale
+        self._loaders = {}
+        self._entries = {}
+        self._refreshing = {}  # name -> Task
+        self._generations = {}  # name -> invalidation count, so a load racing an edit isn't kept as fresh
+
+    def register(self, name, loader):
+        self._loaders[name] = loader
+
+    def invalidate(self, name=None):
+        """Forces a refresh on the next read; the old copy is kept as the error fallback."""
+        for key in ([name] if name else list(self._loaders)):
+            self._generations[key] = self._generations.get(key, 0) + 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.fetched_at = float("-inf")
+
+    async def get(self, name):
+        entry = self._entries.get(name)
+        if entry is not None:
+            age = entry.age()
+            if age < self.ttl:
+                return entry
+            if age < self.ttl + self.stale:
+                self._refresh(name)
+                return entry
+
+        try:
+            return await asyncio.shield(self._refresh(name))
+        except Exception:
+            if entry is None:
+                raise
+            return entry  # the failure is logged by _done
+
+    def _refresh(self, name):
+        task = self._refreshing.get(name)
+        if task is None:
+            task = asyncio.create_task(self._load(name))
+            self._refreshing[name] = task
+            task.add_done_callback(lambda t: self._done(name, t))
+        return task
+
+    def _done(self, name, task):
+        self._refreshing.pop(name, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Content refresh for {name} failed: {task.exception()}")
+
+    async def _load(self, name):
+        generation = self._generations.get(name, 0)
+        entry = CachedContent(await run_in_threadpool(self._loaders[name]))
+        if generation != self._generations.get(name, 0):
+            entry.fetched_at = float("-inf")
+        self._entries[name] = entry
+        return entry
+
+    def on_notify(self, payload):
+        """content_changed NOTIFY handler: the payload names the section, empty means all."""
+        self.invalidate(payload or None)
@@ -0,0 +1,265 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+COUPONS_CHANGED_CHANNEL = "coupons_changed"
+# Safety net for a missed notification (e.g. while the LISTEN connection was down)
+COUPON_CACHE_TTL = float(os.getenv("COUPON_CACHE_TTL", 60))
+
+COUPON_FIELDS = (
+    "code", "status", "expiry", "min_order_value", "discount_type", "discount_value",
+    "used_count", "usage_limit", "customer_type", "per_user_limit",
+)
+COUPON_COLUMNS = ", ".join(COUPON_FIELDS)
+
+
+class CouponError(Exception):
+    """Coupon can't be used for this cart; the message is safe to show to the user."""
+
+
+def evaluate_coupon(coupon, subtotal, today=None, tier=None, user_uses=0):
+    """
+    Validates a coupons row against a cart subtotal and returns the discount amount.
+    `tier` ('b2c'/'b2b') and `user_uses` (this user's past redemptions) are only
+    checked when given. Raises CouponError with a user-facing message when the
+    coupon doesn't apply.
+    """
+    today = today or datetime.now(timezone.utc).date()
+
+    if coupon["status"] != "Active":
+        raise CouponError("Coupon is not active")
+
+    if coupon["expiry"] and coupon["expiry"] < today:
+        raise CouponError("Coupon has expired")
+
+    if coupon["used_count"] >= coupon["usage_limit"]:
+        raise CouponError("Coupon usage limit reached")
+
+    customer_type = (coupon.get("customer_type") or "").lower()
+    if tier and customer_type and customer_type != tier:
+        raise CouponError(f"Coupon is only for {customer_type.upper()} customers")
+
+    per_user_limit = coupon.get("per_user_limit")
+    if per_user_limit is not None and user_uses >= per_user_limit:
+        raise CouponError("You have already used this coupon")
+
+    min_amount = float(coupon["min_order_value"] or 0)
+    if subtotal < min_amount:
+        raise CouponError(f"Minimum purchase of ₹{min_amount} required")
+
+    discount_type = (coupon["discount_type"] or "").lower()
+    if discount_type == "fixed":
+        discount = float(coupon["discount_value"])
+    elif discount_type == "percentage":
+        discount = subtotal * float(coupon["discount_value"]) / 100
+    else:
+        raise CouponError("Invalid discount type")
+
+    # A coupon never takes the order below zero
+    return round(min(discount, subtotal), 2)
+
+
+class CouponRuleCache:
+    """
+    Active coupon rules held in-process. Reloaded after invalidate() (local exhaustion,
+    or the coupons_changed notification) or after COUPON_CACHE_TTL seconds.
+    used_count here is only as fresh as the last load; redeem_coupon is the real check.
+    """
+
+    def __init__(self, ttl=COUPON_CACHE_TTL):
+        self.ttl = ttl
+        self._rules = None
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._rules = None
+
+    def rules(self, cursor):
+        """code -> coupon row for every active coupon."""
+        rules = self._rules
+        if rules is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return rules
+
+        generation = self._generation
+        cursor.execute(f"SELECT {COUPON_COLUMNS} FROM coupons WHERE status = 'Active' ORDER BY id DESC")
+        loaded = {}
+        for row in cursor.fetchall():
+            row = dict(row) if isinstance(row, dict) else dict(zip(COUPON_FIELDS, row))
+            loaded[row["code"]] = row
+
+        with self._lock:
+            # An invalidation that raced with the load wins; the next call reloads
+            if generation == self._generation:
+                self._rules = loaded
+                self._loaded_at = time.monotonic()
+        return loaded
+
+    def get(self, cursor, code):
+        """The coupon row for `code`, or None. Inactive coupons fall through to the table."""
+        rule = self.rules(cursor).get(code)
+        if rule is not None:
+            return rule
+        cursor.execute(f"SELECT {COUPON_COLUMNS} FROM coupons WHERE code = %s", (code,))
+        return cursor.fetchone()
+
+
+coupon_rules = CouponRuleCache()
+
+
+def user_coupon_uses(cursor, user_id):
+    """code -> number of orders this user has placed with it."""
+    cursor.execute("""
+        SELECT coupon_code, COUNT(*) AS uses
+        FROM coupon_redemptions
+        WHERE user_id = %s AND released_at IS NULL
+        GROUP BY coupon_code
+    """, (user_id,))
+    return {
+        (row["coupon_code"] if isinstance(row, dict) else row[0]): (row["uses"] if isinstance(row, dict) else row[1])
+        for row in cursor.fetchall()
+    }
+
+
+def rank_coupons(rules, subtotal, tier, user_uses, today=None):
+    """
+    One pass over the rule set: every coupon the cart qualifies for, best saving first,
+    and the rest with the reason they don't apply (and how much more to add, where
+    spending more would unlock it).
+    """
+    today = today or datetime.now(timezone.utc).date()
+    eligible = []
+    ineligible = []
+    for coupon in rules.values():
+        if (coupon.get("customer_type") or tier).lower() != tier:
+            continue  # other tiers' coupons aren't shown at all
+        try:
+            discount = evaluate_coupon(coupon, subtotal, today, tier, user_uses.get(coupon["code"], 0))
+        except CouponError as e:
+            entry = {"code": coupon["code"], "reason": str(e)}
+            min_amount = float(coupon["min_order_value"] or 0)
+            if subtotal < min_amount and str(e).startswith("Minimum purchase"):
+                entry["add_amount"] = round(min_amount - subtotal, 2)
+            ineligible.append(entry)
+            continue
+        eligible.append({
+            "code": coupon["code"],
+            "discount_type": coupon["discount_type"],
+            "discount_value": float(coupon["discount_value"]),
+            "min_order_value": float(coupon["min_order_value"] or 0),
+            "discount_amount": discount,
+            "expires_at": coupon["expiry"].isoformat() if coupon["expiry"] else None,
+        })
+
+    # Ties go to the coupon expiring first, so the user doesn't lose it
+    eligible.sort(key=lambda c: (-c["discount_amount"], c["expires_at"] or "9999-12-31"))
+    ineligible.sort(key=lambda c: c.get("add_amount", float("inf")))
+    return eligible, ineligible
+
+
+def redeem_coupon(cursor, code, order_id, user_id, discount_amount):
+    """
+    Takes one use of the coupon for the order, in the caller's transaction. The
+    conditional UPDATE is the only gate on the limit, so concurrent checkouts can't
+    overshoot it. Raises CouponError when the coupon is inactive, used up, or this
+    user has reached its per-user limit; the caller rolls back.
+    """
+    cursor.execute("""
+        UPDATE coupons
+        SET used_count = used_count + 1
+        WHERE code = %s AND status = 'Active' AND used_count < usage_limit
+        RETURNING used_count, usage_limit, per_user_limit
+    """, (code,))
+    row = cursor.fetchone()
+    if row is None:
+        raise CouponError("Coupon usage limit reached")
+    used, limit, per_user_limit = (
+        (row["used_count"], row["usage_limit"], row["per_user_limit"]) if isinstance(row, dict) else row
+    )
+
+    if per_user_limit is not None:
+        # The UPDATE holds the coupon's row lock until commit, so this count can't race
+        # with another checkout using the same coupon
+        cursor.execute(
+            "SELECT COUNT(*) AS uses FROM coupon_redemptions"
+            " WHERE coupon_code = %s AND user_id = %s AND released_at IS NULL",
+            (code, user_id)
+        )
+        row = cursor.fetchone()
+        uses = row["uses"] if isinstance(row, dict) else row[0]
+        if uses >= per_user_limit:
+            raise CouponError("You have already used this coupon")
+
+    cursor.execute("""
+        INSERT INTO coupon_redemptions (coupon_code, user_id, order_id, discount_amount)
+        VALUES (%s, %s, %s, %s)
+    """, (code, user_id, order_id, discount_amount))
+
+    if used >= limit:
+        coupon_rules.invalidate()
+    return used, limit
+
+
+if __name__ == "__main__":
+    # Contention benchmark: many connections race to redeem one coupon; exactly
+    # `limit` of them must succeed
+    import argparse
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+
+    from database import get_db_connection
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--attempts", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=32)
+    args = parser.parse_args()
+
+    code = f"BENCH{uuid.uuid4().hex[:8].upper()}"
+    setup = get_db_connection()
+    setup_cursor = setup.cursor()
+    setup_cursor.execute("""
+        INSERT INTO coupons (code, status, discount_type, discount_value, min_order_value, used_count, usage_limit)
+        VALUES (%s, 'Active', 'fixed', 10, 0, 0, %s)
+    """, (code, args.limit))
+    setup.commit()
+
+    def attempt(n):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            redeem_coupon(cursor, code, f"{code}-{n}", "bench", 10)
+            conn.commit()
+            return True
+        except CouponError:
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            succeeded = sum(pool.map(attempt, range(args.attempts)))
+        elapsed = time.perf_counter() - started
+
+        setup_cursor.execute("SELECT used_count FROM coupons WHERE code = %s", (code,))
+        used_count = setup_cursor.fetchone()[0]
+        setup_cursor.execute("SELECT COUNT(*) FROM coupon_redemptions WHERE coupon_code = %s", (code,))
+        redemptions = setup_cursor.fetchone()[0]
+        print(f"{args.attempts} attempts on {args.workers} workers in {elapsed:.2f}s "
+              f"({args.attempts / elapsed:.0f}/s)")
+        print(f"limit={args.limit} succeeded={succeeded} used_count={used_count} redemptions={redemptions}")
+        assert succeeded == used_count == redemptions == min(args.limit, args.attempts), "limit overshot"
+        print("OK")
+    finally:
+        setup_cursor.execute("DELETE FROM coupon_redemptions WHERE coupon_code = %s", (code,))
+        setup_cursor.execute("DELETE FROM coupons WHERE code = %s", (code,))
+        setup.commit()
+        setup_cursor.close()
+        setup.close()
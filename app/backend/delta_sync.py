@@ -0,0 +1,125 @@
+import base64
+import os
+
+from product_fragments import REVIEW_STATS_JOIN
+
+CHANGES_PAGE_LIMIT = int(os.getenv("CHANGES_PAGE_LIMIT", 200))
+CHANGES_MAX_LIMIT = 1000
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", 30))
+TOMBSTONE_PRUNE_INTERVAL = int(os.getenv("TOMBSTONE_PRUNE_INTERVAL", 24 * 3600))
+
+# Changes are ordered by (change_seq, product id). change_seq is the id of the
+# transaction that wrote the row (migration 013), and only changes below the oldest
+# running transaction are served, so nothing can still commit behind a token.
+SAFE_UPPER_BOUND = "pg_snapshot_xmin(pg_current_snapshot())::text::bigint"
+
+
+class SyncToken:
+    """
+    Opaque cursor for /products/changes: the (change_seq, product_id) position the
+    client has reached, plus the tombstone horizon at the time it was issued.
+    """
+
+    __slots__ = ("seq", "product_id", "horizon")
+
+    def __init__(self, seq=0, product_id="", horizon=0):
+        self.seq = seq
+        self.product_id = product_id
+        self.horizon = horizon
+
+    def encode(self):
+        raw = f"v1.{self.seq}.{self.horizon}.{self.product_id}".encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, token):
+        """ValueError for anything this server didn't issue."""
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        version, seq, horizon, product_id = raw.split(".", 3)
+        if version != "v1":
+            raise ValueError(f"unknown token version {version!r}")
+        return cls(int(seq), product_id, int(horizon))
+
+
+def tombstone_horizon(cursor):
+    cursor.execute("SELECT pruned_through FROM product_sync_horizon")
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+    return row["pruned_through"] if isinstance(row, dict) else row[0]
+
+
+def needs_resync(token, horizon):
+    """
+    True when tombstones the client may not have seen were pruned: the client is
+    behind the horizon and pruning has happened since the token was issued.
+    """
+    return token.seq < horizon and token.horizon < horizon
+
+
+def fetch_changes(cursor, token, limit=CHANGES_PAGE_LIMIT):
+    """
+    One page of changes after `token`: light product rows (id, status, stock,
+    updated_at, review stats; the shape render_products takes) and deleted ids, as
+    a merged list of (seq, product_id, row or None) plus whether more remain.
+    """
+    cursor.execute(f"SELECT {SAFE_UPPER_BOUND} AS upper")
+    row = cursor.fetchone()
+    upper = row["upper"] if isinstance(row, dict) else row[0]
+
+    cursor.execute(f"""
+        SELECT p.id, p.status, p.stock, p.updated_at, p.change_seq, r.review_count, r.avg_rating
+        FROM products p
+        {REVIEW_STATS_JOIN}
+        WHERE (p.change_seq, p.id::text) > (%s, %s)
+          AND p.change_seq < %s
+        ORDER BY p.change_seq, p.id::text
+        LIMIT %s
+    """, (token.seq, token.product_id, upper, limit + 1))
+    products = [(row["change_seq"], str(row["id"]), row) for row in cursor.fetchall()]
+
+    cursor.execute("""
+        SELECT product_id, change_seq
+        FROM product_tombstones
+        WHERE (change_seq, product_id) > (%s, %s)
+          AND change_seq < %s
+        ORDER BY change_seq, product_id
+        LIMIT %s
+    """, (token.seq, token.product_id, upper, limit + 1))
+    deleted = [
+        (row["change_seq"], row["product_id"], None) if isinstance(row, dict) else (row[1], row[0], None)
+        for row in cursor.fetchall()
+    ]
+
+    # Each list holds the first limit + 1 of its stream, so the first `limit` of the
+    # merge are exactly the next `limit` changes overall
+    merged = sorted(products + deleted, key=lambda change: (change[0], change[1]))
+    return merged[:limit], len(merged) > limit, upper
+
+
+def prune_tombstones(conn, retention_days=TOMBSTONE_RETENTION_DAYS):
+    """
+    Drops tombstones older than the retention window and moves the horizon past
+    them; clients whose tokens predate it are told to resync. Returns the count.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            WITH pruned AS (
+                DELETE FROM product_tombstones
+                WHERE deleted_at < NOW() - make_interval(days => %s)
+                RETURNING change_seq
+            )
+            UPDATE product_sync_horizon
+            SET pruned_through = GREATEST(pruned_through, (SELECT MAX(change_seq) FROM pruned))
+            WHERE EXISTS (SELECT 1 FROM pruned)
+            RETURNING (SELECT COUNT(*) FROM pruned)
+        """, (retention_days,))
+        row = cursor.fetchone()
+        conn.commit()
+        return row[0] if row else 0
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
@@ -0,0 +1,324 @@
+import os
+import time
+from collections import Counter
+
+from psycopg2.extras import execute_values
+
+from variants import normalize_color
+
+# Unpaid online checkouts hold stock this long before the sweeper gives it back
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", 15 * 60))
+# Replacement units for an open exchange; settled by the exchange status trigger (migration 018)
+EXCHANGE_HOLD_TTL = int(os.getenv("EXCHANGE_HOLD_TTL", 7 * 24 * 3600))
+RESERVATION_SWEEP_INTERVAL = int(os.getenv("RESERVATION_SWEEP_INTERVAL", 30))
+
+
+class InsufficientStock(Exception):
+    """Raised by reserve(); `shortages` maps product_id -> (requested, available)."""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        detail = ", ".join(f"{pid} (requested {req}, available {avail})" for pid, (req, avail) in shortages.items())
+        super().__init__(f"Insufficient stock: {detail}")
+
+
+def _pair(row, first, second):
+    """Works with both plain and RealDictCursor rows."""
+    return (row[first], row[second]) if isinstance(row, dict) else (row[0], row[1])
+
+
+def _lock_products(cursor, product_ids):
+    """
+    Row-locks the products in id order. Every writer takes locks in the same order,
+    so two checkouts sharing SKUs queue behind each other instead of deadlocking.
+    """
+    # products.id is numeric: an id that isn't can't exist, and would fail the cast for the
+    # whole statement, so it's simply left out and reported short like any unknown product
+    ids = tuple(pid for pid in product_ids if str(pid).isdigit())
+    if not ids:
+        return {}
+    cursor.execute(
+        "SELECT id::text AS id, stock FROM products WHERE id IN %s ORDER BY id FOR UPDATE",
+        (ids,)
+    )
+    return dict(_pair(row, "id", "stock") for row in cursor.fetchall())
+
+
+def _adjust_stock(cursor, quantities, sign):
+    """
+    One UPDATE for all products; `p.id IN %s` keeps it on the primary key index.
+    Only called with ids _lock_products found, so all of them are numeric.
+    """
+    ids = [pid for pid in quantities if str(pid).isdigit()]
+    if not ids:
+        return 0
+    cursor.execute("""
+        UPDATE products p
+        SET stock = p.stock + %s * v.qty
+        FROM (SELECT unnest(%s::text[]) AS pid, unnest(%s::int[]) AS qty) v
+        WHERE p.id IN %s AND p.id::text = v.pid
+          AND (%s > 0 OR p.stock >= v.qty)
+    """, (sign, ids, [quantities[i] for i in ids], tuple(ids), sign))
+    return cursor.rowcount
+
+
+def _lock_variants(cursor, keys):
+    """Row-locks variant rows in (product_id, colour) order, always after the product locks."""
+    product_ids, colors = zip(*sorted(keys))
+    cursor.execute("""
+        SELECT v.product_id, v.color, v.stock
+        FROM product_variants v
+        JOIN unnest(%s::text[], %s::text[]) AS k(product_id, color)
+          ON v.product_id = k.product_id AND v.color = k.color
+        ORDER BY v.product_id, v.color
+        FOR UPDATE OF v
+    """, (list(product_ids), list(colors)))
+    locked = {}
+    for row in cursor.fetchall():
+        if isinstance(row, dict):
+            locked[(row["product_id"], row["color"])] = row["stock"]
+        else:
+            locked[(row[0], row[1])] = row[2]
+
+    cursor.execute(
+        "SELECT DISTINCT product_id FROM product_variants WHERE product_id = ANY(%s)",
+        (list(set(product_ids)),)
+    )
+    with_variants = {row["product_id"] if isinstance(row, dict) else row[0] for row in cursor.fetchall()}
+    return locked, with_variants
+
+
+def _adjust_variant_stock(cursor, quantities, sign):
+    keys = list(quantities)
+    cursor.execute("""
+        UPDATE product_variants v
+        SET stock = v.stock + %s * k.qty, updated_at = NOW()
+        FROM unnest(%s::text[], %s::text[], %s::int[]) AS k(product_id, color, qty)
+        WHERE v.product_id = k.product_id AND v.color = k.color
+          AND (%s > 0 OR v.stock >= k.qty)
+    """, (sign, [k[0] for k in keys], [k[1] for k in keys], [quantities[k] for k in keys], sign))
+    return cursor.rowcount
+
+
+def reserve(cursor, order_id, items, expires_in=None):
+    """
+    Takes stock for an order inside the caller's transaction.
+    `items` is an iterable of (product_id, quantity) or (product_id, quantity, colour);
+    repeated lines are summed. A coloured line of a product that has variants also takes
+    the variant's stock (products.stock is the total across colours).
+    With `expires_in` (seconds) the reservation is 'held' until commit_reservation or
+    release_reservation (the sweeper releases it once expired); otherwise it's taken for good.
+    Raises InsufficientStock (caller rolls back) if any product or colour is short.
+    """
+    quantities = Counter()
+    by_color = Counter()
+    for item in items:
+        product_id, quantity = str(item[0]), int(item[1])
+        color = normalize_color(item[2]) if len(item) > 2 else ""
+        quantities[product_id] += quantity
+        by_color[(product_id, color)] += quantity
+    if not quantities:
+        return []
+
+    # Lock order: products by id, then variants by (product_id, colour)
+    stock = _lock_products(cursor, quantities)
+    shortages = {
+        pid: (qty, stock.get(pid) or 0)
+        for pid, qty in quantities.items()
+        if (stock.get(pid) or 0) < qty
+    }
+
+    variant_quantities = Counter()
+    coloured = [key for key in by_color if key[1]]
+    if coloured:
+        variant_stock, with_variants = _lock_variants(cursor, coloured)
+        for key in coloured:
+            if key[0] not in with_variants:
+                continue  # product isn't stocked per colour
+            available = variant_stock.get(key, 0)
+            if available < by_color[key]:
+                shortages[f"{key[0]}/{key[1]}"] = (by_color[key], available)
+            variant_quantities[key] = by_color[key]
+
+    if shortages:
+        raise InsufficientStock(shortages)
+
+    # Rows are locked, so the guarded updates can't lose a race; the guards are belt and braces
+    if _adjust_stock(cursor, quantities, -1) != len(quantities):
+        raise InsufficientStock({pid: (qty, stock.get(pid) or 0) for pid, qty in quantities.items()})
+    if variant_quantities and _adjust_variant_stock(cursor, variant_quantities, -1) != len(variant_quantities):
+        raise InsufficientStock({f"{k[0]}/{k[1]}": (q, 0) for k, q in variant_quantities.items()})
+
+    status = "held" if expires_in else "committed"
+    execute_values(cursor, """
+        INSERT INTO stock_reservations (order_id, product_id, color, quantity, status, expires_at)
+        VALUES %s
+    """, [
+        (order_id, pid, color if (pid, color) in variant_quantities else "", qty, status, expires_in)
+        for (pid, color), qty in sorted(by_color.items())
+    ], template="(%s, %s, %s, %s, %s, NOW() + make_interval(secs => %s))")
+
+    return sorted(by_color.items())
+
+
+def commit_reservation(cursor, order_id):
+    """Payment captured: held stock becomes a sale. Returns the number of lines committed."""
+    cursor.execute("""
+        UPDATE stock_reservations
+        SET status = 'committed', updated_at = NOW()
+        WHERE order_id = %s AND status = 'held'
+    """, (order_id,))
+    return cursor.rowcount
+
+
+def release_reservation(cursor, order_id, reason="released"):
+    """
+    Payment failed or timed out: puts held stock back. Idempotent, only 'held' rows move.
+    Returns the number of lines released.
+    """
+    cursor.execute("""
+        UPDATE stock_reservations
+        SET status = 'released', release_reason = %s, updated_at = NOW()
+        WHERE order_id = %s AND status = 'held'
+        RETURNING product_id, color, quantity
+    """, (reason, order_id))
+    rows = cursor.fetchall()
+    if not rows:
+        return 0
+
+    quantities = Counter()
+    variant_quantities = Counter()
+    for row in rows:
+        if isinstance(row, dict):
+            product_id, color, quantity = row["product_id"], row["color"], row["quantity"]
+        else:
+            product_id, color, quantity = row
+        quantities[product_id] += quantity
+        if color:
+            variant_quantities[(product_id, color)] += quantity
+
+    _lock_products(cursor, quantities)
+    _adjust_stock(cursor, quantities, 1)
+    if variant_quantities:
+        _lock_variants(cursor, variant_quantities)
+        _adjust_variant_stock(cursor, variant_quantities, 1)
+    return len(rows)
+
+
+def release_expired(conn, limit=100):
+    """Releases up to `limit` expired checkouts, one transaction each. Returns the order ids."""
+    cursor = conn.cursor()
+    released = []
+    try:
+        cursor.execute("""
+            SELECT DISTINCT order_id
+            FROM stock_reservations
+            WHERE status = 'held' AND expires_at < NOW()
+            LIMIT %s
+        """, (limit,))
+        order_ids = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+
+        for order_id in order_ids:
+            try:
+                if release_reservation(cursor, order_id, reason="expired"):
+                    released.append(order_id)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Failed to release reservation for {order_id}: {e}")
+        return released
+    finally:
+        cursor.close()
+
+
+# ============================ CONCURRENCY BENCHMARK ============================
+# Hammers a few hot SKUs from many threads and checks nothing was oversold:
+#   python inventory.py --product <id> [--product <id> ...] --stock 200 --orders 2000 --workers 32
+# The products' stock is overwritten for the run and restored afterwards.
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import threading
+    import uuid
+
+    from database import get_db_connection
+
+    parser = argparse.ArgumentParser(description="Stock reservation contention benchmark")
+    parser.add_argument("--product", action="append", required=True, help="hot product id (repeatable)")
+    parser.add_argument("--stock", type=int, default=200, help="units per product for the run")
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--max-qty", type=int, default=3)
+    args = parser.parse_args()
+
+    setup = get_db_connection()
+    cur = setup.cursor()
+    cur.execute("SELECT id::text, stock FROM products WHERE id IN %s", (tuple(args.product),))
+    original_stock = dict(cur.fetchall())
+    missing = set(args.product) - set(original_stock)
+    if missing:
+        raise SystemExit(f"Unknown product ids: {', '.join(missing)}")
+    cur.execute("UPDATE products SET stock = %s WHERE id IN %s", (args.stock, tuple(args.product)))
+    setup.commit()
+
+    run_id = f"bench-{uuid.uuid4().hex[:8]}"
+    sold = Counter()
+    results = Counter()
+    lock = threading.Lock()
+    order_numbers = iter(range(args.orders))
+
+    def worker():
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            while True:
+                with lock:
+                    n = next(order_numbers, None)
+                if n is None:
+                    return
+                picks = random.sample(args.product, random.randint(1, len(args.product)))
+                items = [(pid, random.randint(1, args.max_qty)) for pid in picks]
+                try:
+                    reserve(cursor, f"{run_id}-{n}", items)
+                    conn.commit()
+                    with lock:
+                        results["ok"] += 1
+                        for pid, qty in items:
+                            sold[pid] += qty
+                except InsufficientStock:
+                    conn.rollback()
+                    with lock:
+                        results["sold_out"] += 1
+                except Exception as e:
+                    conn.rollback()
+                    with lock:
+                        results[type(e).__name__] += 1
+        finally:
+            conn.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    cur.execute("SELECT id::text, stock FROM products WHERE id IN %s", (tuple(args.product),))
+    final_stock = dict(cur.fetchall())
+    oversold = False
+    for pid in args.product:
+        ok = final_stock[pid] >= 0 and final_stock[pid] + sold[pid] == args.stock
+        oversold |= not ok
+        print(f"{pid}: sold {sold[pid]}, left {final_stock[pid]} -> {'OK' if ok else 'MISMATCH'}")
+
+    print(f"{args.orders} checkouts in {elapsed:.2f}s ({args.orders / elapsed:.0f} orders/sec), results: {dict(results)}")
+
+    cur.execute("DELETE FROM stock_reservations WHERE order_id LIKE %s", (f"{run_id}-%",))
+    for pid, stock in original_stock.items():
+        cur.execute("UPDATE products SET stock = %s WHERE id = %s", (stock, pid))
+    setup.commit()
+    setup.close()
+    raise SystemExit(1 if oversold else 0)
@@ -2,6 +2,7 @@
 import os
 import uuid
 import json  
+import asyncio
 import razorpay
 from twilio.rest import Client
 import random
@@ -13,6 +14,9 @@ from fastapi import Request,FastAPI,APIRouter, HTTPException, Depends, UploadFil
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 import urllib.parse
 from jose import jwt, JWTError
 from datetime import datetime
@@ -24,8 +28,40 @@ from pydantic import BaseModel
 from typing import Optional, List
 from pydantic import Field
 from models import UserCreate, UserLogin, AddressCreate, B2CRegister, OrderCreate , PhoneRequest, VerifyOtpRequest,normalize_phone, ResetPasswordRequest ,CreatePaymentRequest,VerifyPaymentRequest  
+from models import CartItemRequest, CartQuantityUpdate, CartCouponRequest, CartPincodeRequest, PaymentFailedRequest
+from models import BatchRequest
 from dotenv import load_dotenv
 from dotenv import load_dotenv
+from shipping import calculate_mock_shipping, chargeable_weight as calculate_chargeable_weight
+from bulk_orders import BulkOrderError, process_bulk_order
+from coupons import (
+    COUPONS_CHANGED_CHANNEL, CouponError, coupon_rules, evaluate_coupon, rank_coupons, redeem_coupon, user_coupon_uses
+)
+import cart as cart_service
+from tax import TaxLine, compute_tax, tax_engine
+from variants import VariantIndex, list_variants, normalize_color
+from uploads import UploadBatch, UploadError, DOCUMENT_TYPES
+import media
+from returns import QuantityExceeded, claim_quantity, fetch_timeline
+from order_events import OrderStatusHub, stream_order_status
+from route_cache import PRODUCT_CHANGED_CHANNEL, route_cache
+from product_fragments import REVIEW_STATS_JOIN, assemble_list, fragments as product_fragments, render_products
+from content_cache import CONTENT_CHANGED_CHANNEL, CONTENT_MAX_AGE, CachedContent, ContentCache
+from catalog_snapshot import catalog
+from account_deletion import ACCOUNT_DELETION_POLL, drain_account_deletions, job_status, request_deletion
+from user_profile import PROFILE_CHANGED_CHANNEL, load_profile, profile_cache
+from batch import BatchError, batch_identity, run_batch
+from delta_sync import (CHANGES_MAX_LIMIT, CHANGES_PAGE_LIMIT, TOMBSTONE_PRUNE_INTERVAL, SyncToken, fetch_changes,
+                        needs_resync, prune_tombstones, tombstone_horizon)
+from bootstrap import (BOOTSTRAP_PRODUCTS, build_section, load_category_banners, load_cms_pages, load_hero_banners, load_new_products,
+                       load_user_type, parse_versions, price_products, with_connection)
+from payments import (ORDER_CURRENCY, PAID_STATUSES, PAYMENT_EVENTS_POLL, amount_mismatch, drain_payment_events,
+                      enqueue_event, parse_event, verify_signature)
+from upload_gc import collect_garbage, UPLOAD_GC_INTERVAL, UPLOAD_GC_DELETE
+from storage import IMMUTABLE_CACHE_CONTROL, content_type_of, digest_of, get_storage, parse_range
+from inventory import (InsufficientStock, reserve, commit_reservation, release_reservation,
+                       release_expired, RESERVATION_TTL, RESERVATION_SWEEP_INTERVAL,
+                       EXCHANGE_HOLD_TTL)
 
 
 
@@ -56,6 +92,17 @@ razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
 
 otp_store = {}
 
+# Fire-and-forget tasks. The event loop only keeps weak references to tasks, so
+# these hold them until they finish
+background_tasks = set()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 
 app = FastAPI(title="backendapi")
 app.mount("/uploads", StaticFiles(directory=UPLOAD_FOLDER), name="uploads")
@@ -99,6 +146,11 @@ def normalize_product_dates(product):
 
 
 def get_current_user(token: str = Depends(oauth2_scheme)):
+    # Sub-requests of a /batch call were authenticated once by the batch itself
+    identity = batch_identity.get()
+    if identity is not None and identity[0] == token:
+        return identity[1]
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -115,7 +167,7 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
 
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT id FROM auth_users WHERE email = %s", (email,))
+    cursor.execute("SELECT id FROM auth_users WHERE email = %s AND deleted_at IS NULL", (email,))
     user = cursor.fetchone()
     conn.close()
 
@@ -123,7 +175,30 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
     
     return user["id"] # Return the user_id
-    
+
+
+# ============================ BATCH ============================
+
+@app.post("/batch")
+async def batch_requests(
+    payload: BatchRequest,
+    request: Request,
+    token: str = Depends(oauth2_scheme),
+    current_user_id: str = Depends(get_current_user)
+):
+    """
+    Several GET calls in one round trip, e.g. /users/me, /users/addresses,
+    /coupons/available and /orders/user/{email} on app start. The caller is
+    authenticated once; sub-requests run concurrently through the app itself and
+    each gets its own status and body. Unfinished ones at the deadline get 504.
+    """
+    batch_identity.set((token, current_user_id))
+    try:
+        body = await run_batch(request.app, request.scope, payload.requests, f"Bearer {token}".encode())
+    except BatchError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return Response(content=body, media_type="application/json")
+
 
 @app.post("/auth/send-verification")
 async def send_verification(payload: PhoneRequest):
@@ -184,7 +259,7 @@ async def forgot_password_request(payload: PhoneRequest):
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     # Check if phone exists in auth_users
-    cursor.execute("SELECT id FROM auth_users WHERE phone_number = %s", (phone,))
+    cursor.execute("SELECT id FROM auth_users WHERE phone_number = %s AND deleted_at IS NULL", (phone,))
     if not cursor.fetchone():
         raise HTTPException(404, "Phone number not registered")
     
@@ -228,7 +303,7 @@ async def reset_password(payload: ResetPasswordRequest):
     cursor = conn.cursor(cursor_factory=RealDictCursor)
 
     cursor.execute(
-        "SELECT id FROM auth_users WHERE email = %s AND phone_number = %s",
+        "SELECT id FROM auth_users WHERE email = %s AND phone_number = %s AND deleted_at IS NULL",
         (email, phone)
     )
     user = cursor.fetchone()
@@ -299,7 +374,10 @@ async def login(form: UserLogin):
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     try:
         # First, check auth_users table
-        cursor.execute("SELECT id, password_hash, email FROM auth_users WHERE email = %s", (form.email,))
+        cursor.execute(
+            "SELECT id, password_hash, email FROM auth_users WHERE email = %s AND deleted_at IS NULL",
+            (form.email,)
+        )
         user = cursor.fetchone()
         
         if not user:
@@ -438,6 +516,7 @@ async def register_b2b(
 ):
     conn = None
     cursor = None
+    uploads = UploadBatch()
 
     try:
         # ✅ Normalize phone FIRST
@@ -448,6 +527,13 @@ async def register_b2b(
         if not otp_entry or not otp_entry.get("verified"):
             raise HTTPException(status_code=400, detail="Phone number not verified")
 
+        # ✅ Stage documents (published only after the DB commit)
+        user_id = str(uuid.uuid4())
+        documents = await uploads.stage_many([gst_certificate, business_license], DOCUMENT_TYPES)
+        if len(documents) != 2:
+            raise HTTPException(status_code=400, detail="GST certificate and business license are required")
+        gst_doc, license_doc = documents
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
@@ -457,7 +543,6 @@ async def register_b2b(
             raise HTTPException(status_code=400, detail="Email already registered")
 
         # ✅ Create user
-        user_id = str(uuid.uuid4())
         hashed_pw = get_password_hash(password[:72])
 
         cursor.execute("""
@@ -466,21 +551,8 @@ async def register_b2b(
             VALUES (%s, %s, %s, %s, %s,%s)
         """, (user_id, email, hashed_pw, business_name, phone, "{}"))
 
-        # ✅ Save documents
-        gst_filename = f"{user_id}_{gst_certificate.filename}"
-        license_filename = f"{user_id}_{business_license.filename}"
-
-        gst_fs_path = os.path.join(GST_DIR, gst_filename)
-        license_fs_path = os.path.join(LICENSE_DIR, license_filename)
-
-        with open(gst_fs_path, "wb") as f:
-             f.write(await gst_certificate.read())
-
-        with open(license_fs_path, "wb") as f:
-             f.write(await business_license.read())
-
-        gst_public_url = f"{BASE_URL}/uploads/business/app/gst/{gst_filename}"
-        license_public_url = f"{BASE_URL}/uploads/business/app/license/{license_filename}"
+        gst_public_url = f"{BASE_URL}/files/{gst_doc.key}"
+        license_public_url = f"{BASE_URL}/files/{license_doc.key}"
 
         # ✅ Address handling
         address_id = None
@@ -532,6 +604,7 @@ async def register_b2b(
         ))
 
         conn.commit()
+        await uploads.commit()
 
         # ✅ Remove OTP after success
         otp_store.pop(phone, None)
@@ -552,13 +625,18 @@ async def register_b2b(
         }
 
     except HTTPException:
+        if conn:
+            conn.rollback()
         raise
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         if conn:
             conn.rollback()
         print("🔥 B2B REGISTER ERROR:", repr(e))
         raise HTTPException(status_code=500, detail="B2B registration failed")
     finally:
+        uploads.discard()
         if cursor:
             cursor.close()
         if conn:
@@ -583,6 +661,7 @@ async def create_address(address: AddressCreate, current_user_id: str = Depends(
             VALUES (gen_random_uuid(), %s, %s, %s, %s)
         """, (current_user_id, address_id, address.name, address.is_default))
         conn.commit()
+        profile_cache.invalidate(current_user_id)
         return {"message": "Address added", "address_id": address_id}
     finally:
         if cursor: cursor.close()
@@ -609,6 +688,7 @@ async def update_address(user_address_id: str, address: AddressCreate, current_u
             WHERE id = %s AND user_id = %s
         """, (address.name, address.is_default, user_address_id, current_user_id))
         conn.commit()
+        profile_cache.invalidate(current_user_id)
         return {"message": "Address updated"}
     finally:
         if cursor: cursor.close()
@@ -623,6 +703,7 @@ async def delete_address(user_address_id: str, current_user_id: str = Depends(ge
         conn.commit()
         if cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="Address not found or not owned by user")
+        profile_cache.invalidate(current_user_id)
         return {"message": "Deleted"}
     finally:
         if cursor: cursor.close()
@@ -648,10 +729,11 @@ async def list_addresses(current_user_id: str = Depends(get_current_user)):
 # ============================ USER PROFILE (GET /users/me) ============================
 
 @app.get("/users/me")
-async def get_me(token: str = Depends(oauth2_scheme)):
+async def get_me(token: str = Depends(oauth2_scheme), include_address: bool = False):
     """
     Returns the logged-in user's complete profile information.
     Detects B2B or B2C automatically based on the token payload.
+    include_address=true adds the default address (or null) as `default_address`.
     """
     # Validate token
     try:
@@ -664,152 +746,39 @@ async def get_me(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise HTTPException(401, "Invalid or expired token")
 
+    cached = profile_cache.get(user_id, user_type, include_address)
+    if cached is not None:
+        return cached
+
+    generation = profile_cache.generation(user_id)
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
 
     try:
-        user_info = {
-            "user_id": user_id,
-            "email": email,
-            "user_type": user_type or "b2c"
-        }
-
-        if user_type == "b2b":
-            # Fetch from b2b_applications table
-            cursor.execute("""
-                SELECT 
-                    business_name,
-                    email,
-                    phone_number,
-                    gstin,
-                    pan,
-                    created_at
-                FROM b2b_applications
-                WHERE user_id = %s
-            """, (user_id,))
-            row = cursor.fetchone()
-            
-            if row:
-                user_info["full_name"] = row["business_name"]  # Use business name as display name
-                user_info["business_name"] = row["business_name"]
-                user_info["email"] = row["email"]
-                user_info["phone_number"] = row["phone_number"]
-                user_info["gstin"] = row["gstin"]
-                user_info["pan"] = row["pan"]
-                user_info["created_at"] = row["created_at"]
-                
-                # Also get from auth_users for consistency
-                cursor.execute("""
-                    SELECT full_name, created_at as auth_created_at 
-                    FROM auth_users 
-                    WHERE id = %s
-                """, (user_id,))
-                auth_row = cursor.fetchone()
-                if auth_row and auth_row["full_name"]:
-                    user_info["full_name"] = auth_row["full_name"]  # Prefer personal name if available
-                user_info["auth_created_at"] = auth_row["auth_created_at"] if auth_row else row["created_at"]
-        
-        else:
-            # Fetch from b2c_applications table
-            cursor.execute("""
-                SELECT 
-                    full_name,
-                    email,
-                    phone_number,
-                    created_at
-                FROM b2c_applications
-                WHERE id = %s
-            """, (user_id,))
-            row = cursor.fetchone()
-            
-            if row:
-                user_info["full_name"] = row["full_name"]
-                user_info["email"] = row["email"]
-                user_info["phone_number"] = row["phone_number"]
-                user_info["created_at"] = row["created_at"]
-                
-                # Also get from auth_users for consistency
-                cursor.execute("""
-                    SELECT created_at as auth_created_at 
-                    FROM auth_users 
-                    WHERE id = %s
-                """, (user_id,))
-                auth_row = cursor.fetchone()
-                user_info["auth_created_at"] = auth_row["auth_created_at"] if auth_row else row["created_at"]
-
-        # If no data found in application tables, fallback to auth_users
-        if not row:
-            cursor.execute("""
-                SELECT 
-                    full_name,
-                    email,
-                    phone_number,
-                    created_at as auth_created_at
-                FROM auth_users 
-                WHERE id = %s
-            """, (user_id,))
-            auth_data = cursor.fetchone()
-            
-            if auth_data:
-                user_info["full_name"] = auth_data["full_name"] or email.split('@')[0]
-                user_info["email"] = auth_data["email"]
-                user_info["phone_number"] = auth_data["phone_number"]
-                user_info["created_at"] = auth_data["auth_created_at"]
-                user_info["auth_created_at"] = auth_data["auth_created_at"]
-                
-                # Set default values for B2B fields
-                if user_type == "b2b":
-                    user_info["gstin"] = ""
-                    user_info["pan"] = ""
-                    user_info["business_name"] = ""
-        return user_info
+        # One query over auth_users, the tier's application table and the default address
+        user_info = load_profile(cursor, user_id, email, user_type, with_address=include_address)
+        if user_info is None:
+            raise HTTPException(401, "Account has been deleted")
+        profile_cache.put(user_id, user_type, include_address, user_info, generation)
+        return dict(user_info)
 
     finally:
         cursor.close()
         conn.close()
-# ============================ DELETE USER ACCOUNT ============================
+
+
 @app.delete("/users/me")
 async def delete_user(current_user_id: str = Depends(get_current_user)):
     """
-    Deletes the user and all associated data in the system.
+    Deletes the user and all associated data in the system. The account is revoked
+    right away; its data is deleted in the background in bounded batches
+    (account_deletion.py). Poll the returned status_url for progress.
     """
     conn = get_db_connection()
-    cursor = conn.cursor()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        # ---------------------- CHILD TABLES ----------------------
-        # 1️⃣ Delete product reviews
-        cursor.execute("DELETE FROM product_reviews WHERE user_id = %s", (current_user_id,))
-            
-        # 3️⃣ Delete orders & order items
-        cursor.execute("SELECT id FROM orders WHERE customer = %s", (current_user_id,))
-        order_ids = [row for row in cursor.fetchall()]
-        if order_ids:
-            cursor.execute(
-                "DELETE FROM order_items WHERE order_id = ANY(%s)", (order_ids,)
-            )
-            cursor.execute(
-                "DELETE FROM orders WHERE id = ANY(%s)", (order_ids,)
-            )
-
-        # 4️⃣ Delete user addresses mapping & addresses
-        cursor.execute("DELETE FROM user_addresses WHERE user_id = %s", (current_user_id,))
-        cursor.execute("DELETE FROM addresses WHERE user_id = %s", (current_user_id,))
-
-        # 5️⃣ Delete B2B / B2C applications
-        cursor.execute("DELETE FROM b2b_applications WHERE user_id = %s", (current_user_id,))
-        cursor.execute("DELETE FROM b2c_applications WHERE id = %s", (current_user_id,))
-
-        # 6️⃣ Delete any other dependent tables
-        # Add more deletes here if you have wishlist, notifications, etc.
-
-        # ---------------------- DELETE USER ----------------------
-        cursor.execute("DELETE FROM auth_users WHERE id = %s", (current_user_id,))
-
-        # Commit all deletes
+        job = request_deletion(cursor, current_user_id)
         conn.commit()
-
-        return {"message": "Account and all associated data deleted successfully"}
-
     except Exception as e:
         conn.rollback()
         print("🔥 DELETE USER ERROR:", repr(e))
@@ -818,6 +787,58 @@ async def delete_user(current_user_id: str = Depends(get_current_user)):
         cursor.close()
         conn.close()
 
+    profile_cache.invalidate(current_user_id)
+    run_in_background(run_in_threadpool(process_account_deletions))
+    return JSONResponse(status_code=202, content={
+        "message": "Account deleted; associated data is being removed",
+        "job_id": str(job["id"]),
+        "status": job["status"],
+        "status_url": f"/account-deletions/{job['id']}",
+    })
+
+
+@app.get("/account-deletions/{job_id}")
+async def get_account_deletion(job_id: str):
+    """
+    Progress of an account deletion. The account can't authenticate any more, so
+    the unguessable job id from DELETE /users/me is what grants access.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        job = job_status(cursor, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Deletion job not found")
+        job.pop("user_id")
+        job.pop("last_error")
+        return {"success": True, "job": job}
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def process_account_deletions():
+    conn = get_db_connection()
+    try:
+        return drain_account_deletions(conn)
+    finally:
+        conn.close()
+
+
+async def account_deletion_worker():
+    # Also resumes jobs left unfinished by a restart or a crashed worker
+    while True:
+        try:
+            await run_in_threadpool(process_account_deletions)
+        except Exception as e:
+            print(f"Account deletion processing failed: {e}")
+        await asyncio.sleep(ACCOUNT_DELETION_POLL)
+
+
+@app.on_event("startup")
+async def start_account_deletion_worker():
+    run_in_background(account_deletion_worker())
+
 
 @app.put("/users/me")
 async def update_user_profile(
@@ -899,6 +920,7 @@ async def update_user_profile(
                 cursor.execute(b2c_query, b2c_values)
         
         conn.commit()
+        profile_cache.invalidate(current_user_id)
         
         return {"message": "Profile updated successfully"}
         
@@ -909,6 +931,28 @@ async def update_user_profile(
         cursor.close()
         conn.close()
 # ============================ PRODUCT ENDPOINTS (View Only) ============================
+# Search is cached by route_cache (key: path + query, which carries user_type); catalog
+# edits invalidate by tag through the product_changed notification. /products and
+# /products/{id} aren't: their JSON comes from cached fragments, but stock-only writes
+# don't notify (migrations 012/013), so the light query has to run on every request.
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", 60))
+
+
+def on_product_changed(payload):
+    try:
+        change = json.loads(payload)
+    except ValueError:
+        return
+    product_fragments.invalidate(change["id"])
+    tags = ["products", f"product:{change['id']}", *(f"category:{c}" for c in change.get("categories") or [])]
+    run_in_background(route_cache.invalidate(*tags))
+
+
+@app.get("/cache/metrics")
+async def get_cache_metrics(user_id: str = Depends(get_current_user)):
+    """Per-route hit/miss/coalesced counts and latencies of the response cache in this worker."""
+    return {"success": True, "routes": route_cache.metrics(), "catalog_snapshot": catalog.status()}
+
 
 # Get all products with filtering
 @app.get("/products")
@@ -928,121 +972,48 @@ async def get_products(
     cursor = conn.cursor(cursor_factory=RealDictCursor)
    
     try:
-        # Base query - REMOVED 'rating, reviews' as they don't exist in products table
-        query = """
-            SELECT 
-                id, name, colors,brand_name,category, description, status, stock, image,
-                created_at, updated_at,
-                b2c_price, b2b_price, 
-                b2c_active_offer, b2b_active_offer,
-                b2c_offer_price, b2b_offer_price,
-                b2c_discount, b2b_discount,
-                b2c_offer_start_date, b2c_offer_end_date,sgst,
-                cgst,b2b_offer_start_date, b2b_offer_end_date,
-                compare_at_price ,info,
-                weight, length, breadth, return_policy,height,hsn
-                -- rating, reviews REMOVED: These columns don't exist in products table
-            FROM products WHERE 1=1
+        # Light query for the page (ids, live stock, review stats); each product's JSON
+        # comes from its pre-rendered fragment (product_fragments.py)
+        query = f"""
+            SELECT p.id, p.stock, p.updated_at, r.review_count, r.avg_rating
+            FROM products p
+            {REVIEW_STATS_JOIN}
+            WHERE 1=1
         """
         params = []
         
         # Apply filters
         if category and category.lower() != "all":
-            query += " AND category = %s"
+            query += " AND p.category = %s"
             params.append(category)
         
         if min_price is not None:
             if user_type == "b2c":
-                query += " AND b2c_price >= %s"
+                query += " AND p.b2c_price >= %s"
             else:
-                query += " AND b2b_price >= %s"
+                query += " AND p.b2b_price >= %s"
             params.append(min_price)
         
         if max_price is not None:
             if user_type == "b2c":
-                query += " AND b2c_price <= %s"
+                query += " AND p.b2c_price <= %s"
             else:
-                query += " AND b2b_price <= %s"
+                query += " AND p.b2b_price <= %s"
             params.append(max_price)
         
         if status:
-            query += " AND status = %s"
+            query += " AND p.status = %s"
             params.append(status)
         
         # Add pagination
-        query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
+        query += " ORDER BY p.created_at DESC LIMIT %s OFFSET %s"
         params.extend([limit, offset])
         
         cursor.execute(query, params)
-        products = cursor.fetchall()
-        
-        # Get review counts for each product
-        for product in products:
-            # Get review count from product_reviews table
-            cursor.execute("""
-                SELECT 
-                    COUNT(*) as review_count,
-                    AVG(rating) as avg_rating
-                FROM product_reviews 
-                WHERE product_id = %s
-            """, (product["id"],))
-            review_stats = cursor.fetchone()
-            
-            # Add rating and reviews to product dynamically
-            product["reviews"] = review_stats["review_count"] if review_stats else 0
-            product["rating"] = round(review_stats["avg_rating"], 2) if review_stats and review_stats["avg_rating"] else 0
-            
-            # Calculate current price based on user type and active offers
-            current_time = datetime.now()
-            normalize_product_dates(product)
-            
-            if user_type == "b2c":
-                # Check if offer is active
-                is_offer_active = (
-                    product["b2c_active_offer"] and 
-                    product["b2c_offer_price"] > 0 and
-                    (product["b2c_offer_start_date"] is None or product["b2c_offer_start_date"] <= current_time) and
-                    (product["b2c_offer_end_date"] is None or product["b2c_offer_end_date"] >= current_time)
-                )
-                
-                if is_offer_active:
-                    product["current_price"] = product["b2c_offer_price"]
-                    if product["b2c_price"] > 0:
-                        product["discount_percentage"] = round(
-                            (product["b2c_price"] - product["b2c_offer_price"]) / product["b2c_price"] * 100, 2
-                        )
-                    else:
-                        product["discount_percentage"] = 0
-                else:
-                    product["current_price"] = product["b2c_price"]
-                    product["discount_percentage"] = product["b2c_discount"] or 0
-                    
-                product["original_price"] = product["b2c_price"]
-                    
-            else:  # b2b
-                # Check if offer is active
-                is_offer_active = (
-                    product["b2b_active_offer"] and 
-                    product["b2b_offer_price"] > 0 and
-                    (product["b2b_offer_start_date"] is None or product["b2b_offer_start_date"] <= current_time) and
-                    (product["b2b_offer_end_date"] is None or product["b2b_offer_end_date"] >= current_time)
-                )
-                
-                if is_offer_active:
-                    product["current_price"] = product["b2b_offer_price"]
-                    if product["b2b_price"] > 0:
-                        product["discount_percentage"] = round(
-                            (product["b2b_price"] - product["b2b_offer_price"]) / product["b2b_price"] * 100, 2
-                        )
-                    else:
-                        product["discount_percentage"] = 0
-                else:
-                    product["current_price"] = product["b2b_price"]
-                    product["discount_percentage"] = product["b2b_discount"] or 0
-                    
-                product["original_price"] = product["b2b_price"]
-        
-        return {"products": products, "count": len(products)}
+        rows = cursor.fetchall()
+
+        rendered = render_products(cursor, rows, user_type, normalize_product_dates)
+        return Response(content=assemble_list(rendered), media_type="application/json")
     
     finally:
         cursor.close()
@@ -1050,6 +1021,7 @@ async def get_products(
         
 # Search products
 @app.get("/products/search")
+@route_cache.cached(ttl=PRODUCT_CACHE_TTL, tags=lambda params: ["products"])
 async def search_products(
     query: str,
     limit: int = 20,
@@ -1132,6 +1104,66 @@ async def search_products(
     finally:
         cursor.close()
         conn.close()
+
+# Delta sync for the app's local catalog (declared before /products/{product_id})
+@app.get("/products/changes")
+async def get_product_changes(
+    since: Optional[str] = None,
+    limit: int = CHANGES_PAGE_LIMIT,
+    user_type: Optional[str] = None
+):
+    """
+    Products inserted, updated, unpublished or deleted after `since` (the next_token of
+    the previous call; omit it for a first sync). Published products come back in the
+    /products shape, everything else as ids in `removed`. Keep calling while has_more.
+    full_resync means the token is unknown or too old: drop the local copy and start over.
+    """
+    limit = max(1, min(limit, CHANGES_MAX_LIMIT))
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    try:
+        horizon = tombstone_horizon(cursor)
+        try:
+            token = SyncToken.decode(since) if since else SyncToken(horizon=horizon)
+        except ValueError:
+            token = None
+        if token is None or needs_resync(token, horizon):
+            return {
+                "products": [],
+                "removed": [],
+                "next_token": SyncToken(horizon=horizon).encode(),
+                "has_more": True,
+                "full_resync": True,
+            }
+
+        changes, has_more, upper = fetch_changes(cursor, token, limit)
+        published = [row for _, _, row in changes if row is not None and row["status"] == "Published"]
+        removed = [product_id for _, product_id, row in changes if row is None or row["status"] != "Published"]
+        rendered = render_products(cursor, published, user_type, normalize_product_dates)
+
+        if has_more:
+            seq, product_id, _ = changes[-1]
+            next_token = SyncToken(seq, product_id, horizon)
+        else:
+            next_token = SyncToken(upper, "", horizon)
+
+        items = b",".join(fragment.render({"stock": row["stock"]}) for row, fragment in rendered)
+        tail = json.dumps({
+            "removed": removed,
+            "next_token": next_token.encode(),
+            "has_more": has_more,
+            "full_resync": False,
+        }, separators=(",", ":"))
+        return Response(
+            content=b'{"products":[' + items + b"]," + tail[1:].encode(),
+            media_type="application/json"
+        )
+
+    finally:
+        cursor.close()
+        conn.close()
+
 # Get single product
 @app.get("/products/{product_id}")
 async def get_product(product_id: str, user_type: Optional[str] = None):
@@ -1142,90 +1174,40 @@ async def get_product(product_id: str, user_type: Optional[str] = None):
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        cursor.execute("""
-            SELECT 
-                id, name,colors,brand_name, category, description, status, stock, image,
-                created_at, updated_at,
-                b2c_price, b2b_price, 
-                b2c_active_offer, b2b_active_offer,
-                b2c_offer_price, b2b_offer_price,
-                b2c_discount, b2b_discount,
-                b2c_offer_start_date, b2c_offer_end_date,sgst,
-                cgst,weight, length, breadth, return_policy,height,
-                b2b_offer_start_date, b2b_offer_end_date,
-                hsn,
-                compare_at_price,info
-            FROM products WHERE id = %s
+        cursor.execute(f"""
+            SELECT p.id, p.stock, p.updated_at, r.review_count, r.avg_rating
+            FROM products p
+            {REVIEW_STATS_JOIN}
+            WHERE p.id = %s
         """, (product_id,))
-        product = cursor.fetchone()
+        row = cursor.fetchone()
         
-        if not product:
+        if not row:
             raise HTTPException(status_code=404, detail="Product not found")
+
+        # Pre-rendered detail JSON for this tier; stock and variants are patched in live
+        rendered = render_products(cursor, [row], user_type, normalize_product_dates, kind="detail")
+        if not rendered:
+            raise HTTPException(status_code=404, detail="Product not found")
+        _, fragment = rendered[0]
+
+        # Colour variants with the price this user type pays for each
+        tier = "b2c" if user_type == "b2c" else "b2b"
+        variants = [
+            {
+                "color": v["color"],
+                "color_name": v["color_name"],
+                "stock": v["stock"],
+                "in_stock": v["stock"] > 0,
+                "price": float(v[f"{tier}_price"]) if v[f"{tier}_price"] is not None else fragment.current_price,
+            }
+            for v in list_variants(cursor, product_id)
+        ]
         
-        # Get review stats
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as review_count,
-                AVG(rating) as avg_rating
-            FROM product_reviews 
-            WHERE product_id = %s
-        """, (product_id,))
-        review_stats = cursor.fetchone()
-        
-        product["reviews"] = review_stats["review_count"] if review_stats else 0
-        product["rating"] = round(review_stats["avg_rating"], 2) if review_stats and review_stats["avg_rating"] else 0
-        
-        # Format response based on user_type
-        current_time = datetime.now()
-        normalize_product_dates(product)
-        
-        if user_type == "b2c":
-            # Check if offer is active
-            is_offer_active = (
-                product["b2c_active_offer"] and 
-                product["b2c_offer_price"] > 0 and
-                (product["b2c_offer_start_date"] is None or product["b2c_offer_start_date"] <= current_time) and
-                (product["b2c_offer_end_date"] is None or product["b2c_offer_end_date"] >= current_time)
-            )
-            
-            if is_offer_active:
-                product["current_price"] = product["b2c_offer_price"]
-                if product["b2c_price"] > 0:
-                    product["discount_percentage"] = round(
-                        (product["b2c_price"] - product["b2c_offer_price"]) / product["b2c_price"] * 100, 2
-                    )
-                else:
-                    product["discount_percentage"] = 0
-            else:
-                product["current_price"] = product["b2c_price"]
-                product["discount_percentage"] = product["b2c_discount"] or 0
-                
-            product["original_price"] = product["b2c_price"]
-            
-        else:  # b2b
-            # Check if offer is active
-            is_offer_active = (
-                product["b2b_active_offer"] and 
-                product["b2b_offer_price"] > 0 and
-                (product["b2b_offer_start_date"] is None or product["b2b_offer_start_date"] <= current_time) and
-                (product["b2b_offer_end_date"] is None or product["b2b_offer_end_date"] >= current_time)
-            )
-            
-            if is_offer_active:
-                product["current_price"] = product["b2b_offer_price"]
-                if product["b2b_price"] > 0:
-                    product["discount_percentage"] = round(
-                        (product["b2b_price"] - product["b2b_offer_price"]) / product["b2b_price"] * 100, 2
-                    )
-                else:
-                    product["discount_percentage"] = 0
-            else:
-                product["current_price"] = product["b2b_price"]
-                product["discount_percentage"] = product["b2b_discount"] or 0
-                
-            product["original_price"] = product["b2b_price"]
-        
-        return product
+        return Response(
+            content=fragment.render({"stock": row["stock"], "variants": variants}),
+            media_type="application/json"
+        )
     
     finally:
         cursor.close()
@@ -1421,21 +1403,6 @@ async def delete_review(
 @app.post("/shipping/delhivery/estimate")
 async def calculate_shipping(payload: dict):
     
-    # 1. DEFINE THIS FIRST so it can be used in the 'except' blocks below
-    def calculate_mock_shipping(weight):
-        """
-        <= 10 kg  -> flat price
-        > 10 kg   -> flat + per kg extra
-        """
-        FLAT_PRICE_UPTO_10KG = 120   # ₹
-        EXTRA_PRICE_PER_KG = 15      # ₹ per kg
-
-        if weight <= 10:
-            return FLAT_PRICE_UPTO_10KG
-        else:
-            extra_weight = weight - 10
-            return round(FLAT_PRICE_UPTO_10KG + (extra_weight * EXTRA_PRICE_PER_KG), 2)
-
     # ---------------- BASIC VALIDATION ----------------
     if not DELHIVERY_TOKEN or not DELHIVERY_PICKUP_PIN:
         raise HTTPException(status_code=500, detail="Delhivery not configured")
@@ -1449,27 +1416,10 @@ async def calculate_shipping(payload: dict):
         raise HTTPException(status_code=400, detail="No items in payload")
 
     # ---------------- WEIGHT CALCULATION ----------------
-    total_weight = 0.0
-    total_vol_weight = 0.0
-
-    for item in items:
-        try:
-            qty = int(item.get("quantity", 1))
-            weight = float(item.get("weight", 0)) * qty
-            length = float(item.get("length", 0))
-            breadth = float(item.get("breadth", 0))
-            height = float(item.get("height", 0))
-
-            vol_weight = (length * breadth * height) / 5000 * qty
-
-            total_weight += weight
-            total_vol_weight += vol_weight
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid item data")
-
-    chargeable_weight = round(max(total_weight, total_vol_weight), 2)
-    if chargeable_weight < 0.5:
-        chargeable_weight = 0.5
+    try:
+        chargeable_weight = calculate_chargeable_weight(items)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid item data")
 
     weight_in_grams = int(chargeable_weight * 1000)
 
@@ -1531,60 +1481,242 @@ async def calculate_shipping(payload: dict):
         "note": "Mock pricing applied as fallback" if pricing_source == "mock" else "Live pricing applied"
     }
 
-# ============================ ORDER PLACEMENT ============================
-@app.post("/orders/place")
-async def place_order_from_app(order_data: OrderCreate, current_user_id: str = Depends(get_current_user)):
+# ============================ CART ============================
+def _cart_response(cursor, user_id):
+    return cart_service.serialize_cart(
+        cart_service.get_priced_cart(cursor, user_id, normalize_product_dates)
+    )
+
+
+@app.get("/cart")
+async def get_cart(current_user_id: str = Depends(get_current_user)):
     """
-    Receives a complete order object from the Flutter app and saves it to the PostgreSQL 'orders' table.
+    Returns the user's cart priced by the server: tier prices, coupon, GST and shipping estimate.
     """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    created_order_items = []
-    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        # Get user type from token
-        actual_customer_type = order_data.customer_type or "b2c"
-
+        cart = _cart_response(cursor, current_user_id)
+        conn.commit()  # first call creates the cart row
+        return cart
+    finally:
+        cursor.close()
+        conn.close()
 
-        # Extract order-level dimensions and HSN (use values from first product or calculate aggregate)
-        hsn_code = ""
-        total_weight = 0
-        total_height = 0
-        total_length = 0
-        total_breadth = 0
-        
-        if order_data.products and len(order_data.products) > 0:
-            # Get HSN from first product (or you can aggregate differently)
-            hsn_code = getattr(order_data.products[0], "hsnCode", "")
-            original_price = 0.0
-            # Calculate totals for the entire order
-            for product in order_data.products:
-                total_weight += getattr(product, "weightKg", 0)
-                total_height += getattr(product, "heightCm", 0)
-                total_length += getattr(product, "lengthCm", 0)
-                total_breadth += getattr(product, "breadthCm", 0)
-                original_price += product.price  * product.quantity 
 
-        # 1. Insert order with dimensions and HSN in separate columns
+@app.post("/cart/items")
+async def add_cart_item(item: CartItemRequest, current_user_id: str = Depends(get_current_user)):
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cursor.execute("SELECT id FROM products WHERE id = %s", (item.product_id,))
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Product not found")
+
+        state = cart_service.get_cart_state(cursor, current_user_id)
+        cart_service.add_item(cursor, state["id"], item.product_id, item.quantity, item.color)
+        conn.commit()
+        return _cart_response(cursor, current_user_id)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.put("/cart/items/{product_id}")
+async def update_cart_item(
+    product_id: str,
+    update: CartQuantityUpdate,
+    color: Optional[str] = None,
+    current_user_id: str = Depends(get_current_user)
+):
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        state = cart_service.get_cart_state(cursor, current_user_id)
+        if not cart_service.set_item_quantity(cursor, state["id"], product_id, update.quantity, color):
+            raise HTTPException(status_code=404, detail="Item not in cart")
+        conn.commit()
+        return _cart_response(cursor, current_user_id)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.delete("/cart/items/{product_id}")
+async def delete_cart_item(
+    product_id: str,
+    color: Optional[str] = None,
+    current_user_id: str = Depends(get_current_user)
+):
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        state = cart_service.get_cart_state(cursor, current_user_id)
+        if not cart_service.remove_item(cursor, state["id"], product_id, color):
+            raise HTTPException(status_code=404, detail="Item not in cart")
+        conn.commit()
+        return _cart_response(cursor, current_user_id)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.delete("/cart")
+async def clear_cart(current_user_id: str = Depends(get_current_user)):
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        state = cart_service.get_cart_state(cursor, current_user_id)
+        cart_service.clear_cart(cursor, state["id"])
+        conn.commit()
+        return _cart_response(cursor, current_user_id)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.put("/cart/coupon")
+async def set_cart_coupon(payload: CartCouponRequest, current_user_id: str = Depends(get_current_user)):
+    """
+    Attaches a coupon to the cart. The priced cart reports whether it applied and why not.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        state = cart_service.get_cart_state(cursor, current_user_id)
+        cart_service.set_coupon(cursor, state["id"], payload.coupon_code.strip())
+        conn.commit()
+        return _cart_response(cursor, current_user_id)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.delete("/cart/coupon")
+async def remove_cart_coupon(current_user_id: str = Depends(get_current_user)):
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        state = cart_service.get_cart_state(cursor, current_user_id)
+        cart_service.set_coupon(cursor, state["id"], None)
+        conn.commit()
+        return _cart_response(cursor, current_user_id)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.put("/cart/pincode")
+async def set_cart_pincode(payload: CartPincodeRequest, current_user_id: str = Depends(get_current_user)):
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        state = cart_service.get_cart_state(cursor, current_user_id)
+        cart_service.set_pincode(cursor, state["id"], payload.pincode.strip())
+        conn.commit()
+        return _cart_response(cursor, current_user_id)
+    finally:
+        cursor.close()
+        conn.close()
+
+# ============================ ORDER PLACEMENT ============================
+OFFLINE_PAYMENT_METHODS = ("cod", "cash on delivery", "cash_on_delivery")
+
+
+def awaits_online_payment(order_data):
+    """Unpaid online checkouts only hold their stock until payment lands or times out."""
+    return (
+        (order_data.payment_status or "").lower() not in PAID_STATUSES and
+        (order_data.payment_method or "").lower() not in OFFLINE_PAYMENT_METHODS
+    )
+
+
+def insufficient_stock_error(e):
+    return HTTPException(status_code=409, detail={
+        "message": "Some items are out of stock",
+        "shortages": [
+            {"product_id": pid, "requested": requested, "available": available}
+            for pid, (requested, available) in e.shortages.items()
+        ]
+    })
+
+
+@app.post("/orders/place")
+async def place_order_from_app(order_data: OrderCreate, current_user_id: str = Depends(get_current_user)):
+    """
+    Receives a complete order object from the Flutter app and saves it to the PostgreSQL 'orders' table.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    created_order_items = []
+    
+    try:
+        # Get user type from token
+        actual_customer_type = order_data.customer_type or "b2c"
+
+
+        # Extract order-level dimensions and HSN (use values from first product or calculate aggregate)
+        hsn_code = ""
+        total_weight = 0
+        total_height = 0
+        total_length = 0
+        total_breadth = 0
+        
+        if order_data.products and len(order_data.products) > 0:
+            # Get HSN from first product (or you can aggregate differently)
+            hsn_code = getattr(order_data.products[0], "hsnCode", "")
+            original_price = 0.0
+            # Calculate totals for the entire order
+            for product in order_data.products:
+                total_weight += getattr(product, "weightKg", 0)
+                total_height += getattr(product, "heightCm", 0)
+                total_length += getattr(product, "lengthCm", 0)
+                total_breadth += getattr(product, "breadthCm", 0)
+                original_price += product.price  * product.quantity 
+
+        # GST is computed server-side from HSN and the delivery state; the client's tax
+        # figures are only swapped out of its total so discounts/shipping carry over.
+        # Catalogue products use their own HSN, with their sgst/cgst for codes the rate table lacks
+        catalog_ids = [p.productId for p in order_data.products if p.productId]
+        catalog_tax = {}
+        if catalog_ids:
+            cursor.execute("SELECT id::text, hsn, sgst, cgst FROM products WHERE id::text = ANY(%s)", (catalog_ids,))
+            catalog_tax = {row[0]: row[1:] for row in cursor.fetchall()}
+
+        tax_lines = []
+        for product in order_data.products:
+            hsn, sgst, cgst = catalog_tax.get(product.productId, (None, None, None))
+            tax_lines.append(TaxLine(hsn or product.hsnCode, product.price * product.quantity, sgst or 0, cgst or 0))
+        tax = compute_tax(cursor, tax_lines, order_data.state)
+
+        # A line with no catalogue product has no rate of its own to fall back on
+        for product, line in zip(order_data.products, tax_lines):
+            if product.productId not in catalog_tax and tax_engine.rate_for(line.hsn) is None:
+                raise HTTPException(status_code=400, detail=f"Unknown HSN code {line.hsn!r} for {product.name}")
+        client_tax = (order_data.state_gst_amount or 0) + (order_data.central_gst_amount or 0)
+        order_amount = round(order_data.total_price - client_tax + tax["total_tax"], 2)
+
+        # 1. Insert order with dimensions and HSN in separate columns
         cursor.execute("""
         INSERT INTO orders (
             order_id, customer, email, phone, amount, shipping_fee,
-            state_gst_amount, central_gst_amount, sgst_percentage, cgst_percentage,
+            state_gst_amount, central_gst_amount, igst_amount, sgst_percentage, cgst_percentage,
             items_count, customer_type, status, payment, payment_method, products,
             created_at, address, hsn, weight, height, length, breadth, city, state, pincode, original_price,customer_name
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         RETURNING id
         """, (
             order_data.order_id,
             current_user_id,
             order_data.customer_email,
             order_data.phone,
-            order_data.total_price,
+            order_amount,
             order_data.shipping_fee,
-            order_data.state_gst_amount,
-            order_data.central_gst_amount,
-            order_data.sgst_percentage,  
-            order_data.cgst_percentage,
+            tax["sgst_amount"],
+            tax["cgst_amount"],
+            tax["igst_amount"],
+            tax["sgst_percentage"],
+            tax["cgst_percentage"],
             len(order_data.products),
             actual_customer_type,
             order_data.order_status,
@@ -1608,25 +1740,30 @@ async def place_order_from_app(order_data: OrderCreate, current_user_id: str = D
         db_order_id = cursor.fetchone()[0]
 
         # 2. Insert each product (without dimensions in product JSON if not needed)
-        for product in order_data.products:
+        for product, line_tax in zip(order_data.products, tax["lines"]):
             cursor.execute("""
             INSERT INTO order_items (
-                order_id, product_name, image, unit_price, quantity, item_total
-            ) VALUES (%s, %s, %s, %s, %s, %s)
+                order_id, product_id, color, product_name, image, unit_price, quantity, item_total, hsn, gst_rate
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             RETURNING id
             """, (
                 order_data.order_id,
+                product.productId,
+                normalize_color(product.colorHex),
                 product.name,
                 product.imageUrl,
                 product.price,
                 product.quantity,
-                product.price * product.quantity
+                product.price * product.quantity,
+                line_tax["hsn"],
+                line_tax["rate"]
             ))
             
             product.order_item_id = cursor.fetchone()[0]
 
             created_order_items.append({ 
                 "order_item_id": product.order_item_id,
+                "product_id": product.productId,
                 "colorHex": product.colorHex,
                 "name": product.name,
                 "imageUrl": product.imageUrl,
@@ -1635,13 +1772,34 @@ async def place_order_from_app(order_data: OrderCreate, current_user_id: str = D
                 "item_total": product.price * product.quantity,
             })
 
-        # 3. Build products JSON
+        # 3. Take stock for lines that carry a product id (conditional, row-locked in id order)
+        reserve_items = [(p.productId, p.quantity, p.colorHex) for p in order_data.products if p.productId]
+        if reserve_items:
+            reserve(
+                cursor, order_data.order_id, reserve_items,
+                expires_in=RESERVATION_TTL if awaits_online_payment(order_data) else None
+            )
+
+        # 4. Take one use of the coupon; the conditional UPDATE enforces the limit
+        if order_data.coupon_code:
+            coupon = coupon_rules.get(cursor, order_data.coupon_code)
+            if coupon is None:
+                raise CouponError("Invalid coupon code")
+            # Tier and per-user uses come from the server, not order_data.customer_type
+            discount = evaluate_coupon(
+                coupon, original_price,
+                tier=load_user_type(cursor, current_user_id),
+                user_uses=user_coupon_uses(cursor, current_user_id).get(coupon["code"], 0),
+            )
+            redeem_coupon(cursor, order_data.coupon_code, order_data.order_id, current_user_id, discount)
+
+        # 5. Build products JSON
         items_json_string = json.dumps(created_order_items)
 
-        # 4. Update orders row with real JSON
+        # 6. Update orders row with real JSON
         cursor.execute("UPDATE orders SET products=%s WHERE id=%s", (items_json_string, db_order_id))
 
-        # 5. Commit transaction
+        # 7. Commit transaction
         conn.commit()
 
         return {
@@ -1649,9 +1807,22 @@ async def place_order_from_app(order_data: OrderCreate, current_user_id: str = D
             "order_id": order_data.order_id,
             "user_id_saved_as_customer": current_user_id,
             "payment_status": order_data.payment_status,
+            "amount": order_amount,
+            "state_gst_amount": tax["sgst_amount"],
+            "central_gst_amount": tax["cgst_amount"],
+            "igst_amount": tax["igst_amount"],
             "created_order_items": created_order_items
         }
 
+    except HTTPException:
+        conn.rollback()
+        raise
+    except InsufficientStock as e:
+        conn.rollback()
+        raise insufficient_stock_error(e)
+    except CouponError as e:
+        conn.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         conn.rollback()
         print(f"Error saving order: {e}")
@@ -1663,6 +1834,40 @@ async def place_order_from_app(order_data: OrderCreate, current_user_id: str = D
         cursor.close()
         conn.close()
 
+# ============================ BULK ORDER UPLOAD (B2B) ============================
+@app.post("/orders/bulk")
+async def place_bulk_order(
+    file: UploadFile = File(...),
+    address_id: Optional[str] = Form(None),
+    payment_method: str = Form("bank_transfer"),
+    allow_partial: bool = Form(False),
+    current_user_id: str = Depends(get_current_user)
+):
+    """
+    Creates an order from a CSV/XLSX of product id + quantity.
+    Every line is validated (SKU, stock, tier price) and reported back; with allow_partial
+    the order is placed for the valid lines only, otherwise any bad line rejects the file.
+    """
+    conn = get_db_connection()
+    try:
+        # Parsing and batched DB work are blocking, keep them off the event loop
+        created, body = await run_in_threadpool(
+            process_bulk_order,
+            conn, current_user_id, file.file, file.filename,
+            address_id, payment_method, allow_partial, normalize_product_dates
+        )
+        return body if created else JSONResponse(status_code=422, content=body)
+
+    except BulkOrderError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Error saving bulk order: {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Failed to save bulk order: {str(e)}")
+    finally:
+        conn.close()
+
 @app.get("/orders/user/{user_email}")
 async def get_orders_by_user(
     user_email: str,
@@ -1847,6 +2052,7 @@ async def create_refund(
 ):
     conn = get_db_connection()
     cursor = conn.cursor()
+    uploads = UploadBatch()
 
     try:
         print(f"=== DEBUG: Starting refund request ===")
@@ -1856,25 +2062,10 @@ async def create_refund(
         print(f"DEBUG: current_user={current_user}")
         print(f"DEBUG: Number of images: {len(images)}")
 
-        # === Upload images ===
-        image_urls = []
-        for i, file in enumerate(images):
-            print(f"DEBUG: Processing image {i+1}: {file.filename}")
-            if file and file.filename:
-                ext = file.filename.rsplit(".", 1)[-1]
-                filename = f"{uuid.uuid4()}.{ext}"
-                path = os.path.join(UPLOAD_FOLDER, filename)
-                print(f"DEBUG: Saving image to: {path}")
-                
-                try:
-                    with open(path, "wb") as f:
-                        content = await file.read()
-                        f.write(content)
-                        print(f"DEBUG: Image saved successfully: {filename}, size: {len(content)} bytes")
-                    image_urls.append(f"{BASE_URL.rstrip('/')}/uploads/{filename}")
-                except Exception as img_error:
-                    print(f"DEBUG: Error saving image: {str(img_error)}")
-                    raise
+        # === Stage images (moved into uploads/ after the commit) ===
+        staged = await uploads.stage_many(images)
+        image_urls = [f"{BASE_URL.rstrip('/')}/files/{s.key}" for s in staged]
+        print(f"DEBUG: Staged {len(staged)} images, {uploads.received} bytes")
 
         images_json = json.dumps(image_urls)
         print(f"DEBUG: Image URLs JSON: {images_json}")
@@ -1929,9 +2120,15 @@ async def create_refund(
                 oi.order_id as  business_order_id,
                 oi.quantity,
                 oi.product_name,
-                oi.unit_price
+                oi.unit_price,
+                COALESCE(oi.hsn, p.hsn, o.hsn),
+                oi.gst_rate,
+                p.sgst,
+                p.cgst,
+                o.state
             FROM order_items oi
             JOIN orders o ON o.order_id = oi.order_id
+            LEFT JOIN products p ON p.id::text = oi.product_id
             WHERE oi.id = %s AND o.customer = %s
         """, (order_item_id, current_user))
 
@@ -1941,7 +2138,7 @@ async def create_refund(
             raise HTTPException(403, "Invalid order item")
 
         # FIXED: Changed 'price' to 'row'
-        order_id, original_qty, product_name, unit_price = row
+        order_id, original_qty, product_name, unit_price, item_hsn, item_rate, item_sgst, item_cgst, order_state = row
         
         print(f"DEBUG: Found order - order_id: {order_id}, original_qty: {original_qty}")
         print(f"DEBUG: product_name: {product_name}, unit_price: {unit_price}")
@@ -1953,26 +2150,25 @@ async def create_refund(
             print(f"DEBUG: {error_msg}")
             raise HTTPException(400, error_msg)
 
-        # === Existing refunds ===
-        cursor.execute("""
-            SELECT COALESCE(SUM(quantity),0)
-            FROM refunds
-            WHERE order_item_id = %s
-              AND status NOT IN ('Rejected','Cancelled')
-        """, (order_item_id,))
-        already_refunded = cursor.fetchone()[0]
-        print(f"DEBUG: Already refunded quantity: {already_refunded}")
-
-        if already_refunded + quantity > original_qty:
-            error_msg = f"Quantity exceeds limit: {already_refunded + quantity} > {original_qty}"
-            print(f"DEBUG: {error_msg}")
-            raise HTTPException(400, error_msg)
+        # === Claim the quantity (atomic, also sets the item status) ===
+        try:
+            refunded_total = claim_quantity(cursor, order_item_id, "refund", quantity)
+        except QuantityExceeded as e:
+            print(f"DEBUG: {e}")
+            raise HTTPException(400, str(e))
+        print(f"DEBUG: Refunded quantity now: {refunded_total}")
 
         # === Amount validation ===
         expected = float(unit_price) * quantity
         refund_amount = round(expected, 2)
         print(f"DEBUG: Calculated refund amount: {refund_amount} ({unit_price} * {quantity})")
 
+        # GST component of the refunded value, at the rate this item was charged
+        # (lines from before order_items.gst_rate are looked up again)
+        refund_tax = compute_tax(cursor, [
+            TaxLine(item_hsn, refund_amount, item_sgst or 0, item_cgst or 0, item_rate)
+        ], order_state)
+
         # === Insert refund ===
         print(f"DEBUG: Inserting refund into database...")
         cursor.execute("""
@@ -1986,10 +2182,11 @@ async def create_refund(
         payment_method,
         amount,
         proof_image_path,
+        images,
         type,
         product_name,
         quantity
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s::jsonb, %s, %s, %s)
         RETURNING id
         """, (
         order_id,
@@ -2001,6 +2198,7 @@ async def create_refund(
         payment_method,
         refund_amount,     # amount
         images_json,       # proof_image_path
+        images_json,       # images (JSONB)
         'refund',          # type
         product_name,
         quantity
@@ -2009,24 +2207,27 @@ async def create_refund(
         refund_id = cursor.fetchone()[0]
         print(f"DEBUG: Refund created with ID: {refund_id}")
 
-        # === Update item status ===
-        total = already_refunded + quantity
-        status = "returned" if total >= original_qty else "partial_returned"
-        print(f"DEBUG: Updating order item status to: {status}")
-
-        cursor.execute(
-            "UPDATE order_items SET status=%s WHERE id=%s",
-            (status, order_item_id)
-        )
-
         conn.commit()
+        run_in_background(media.pregenerate(await uploads.commit()))
         print(f"DEBUG: Transaction committed successfully")
-        return {"success": True, "refund_id": refund_id}
+        return {
+            "success": True,
+            "refund_id": refund_id,
+            "tax": {
+                "cgst_amount": refund_tax["cgst_amount"],
+                "sgst_amount": refund_tax["sgst_amount"],
+                "igst_amount": refund_tax["igst_amount"],
+                "total_tax": refund_tax["total_tax"],
+            }
+        }
 
     except HTTPException as http_err:
         print(f"DEBUG: HTTP Exception: {http_err.status_code} - {http_err.detail}")
         conn.rollback()
         raise http_err
+    except UploadError as e:
+        conn.rollback()
+        raise HTTPException(e.status_code, str(e))
     except Exception as e:
         print(f"=== DEBUG: UNEXPECTED ERROR ===")
         print(f"DEBUG: Error type: {type(e).__name__}")
@@ -2038,6 +2239,7 @@ async def create_refund(
         conn.rollback()
         raise HTTPException(500, f"Internal server error: {str(e)}")
     finally:
+        uploads.discard()
         cursor.close()
         conn.close()
         print(f"=== DEBUG: Refund request completed ===")
@@ -2054,6 +2256,7 @@ async def create_exchange(
 ):
     conn = get_db_connection()
     cursor = conn.cursor()
+    uploads = UploadBatch()
 
     try:
         print(f"=== DEBUG: Starting exchange request ===")
@@ -2062,16 +2265,9 @@ async def create_exchange(
         print(f"DEBUG: current_user={current_user}")
         print(f"DEBUG: Number of images: {len(images)}")
 
-        # === Upload images ===
-        image_urls = []
-        for file in images:
-            if file and file.filename:
-                ext = file.filename.rsplit(".", 1)[-1]
-                name = f"{uuid.uuid4()}.{ext}"
-                path = os.path.join(UPLOAD_FOLDER, name)
-                with open(path, "wb") as f:
-                    f.write(await file.read())
-                image_urls.append(f"{BASE_URL.rstrip('/')}/uploads/{name}")
+        # === Stage images (moved into uploads/ after the commit) ===
+        staged = await uploads.stage_many(images)
+        image_urls = [f"{BASE_URL.rstrip('/')}/files/{s.key}" for s in staged]
 
         images_json = json.dumps(image_urls)
 
@@ -2092,7 +2288,8 @@ async def create_exchange(
          oi.order_id,
          oi.quantity,
          oi.product_name,
-         oi.unit_price
+         oi.unit_price,
+         oi.product_id
          FROM order_items oi
         JOIN orders o ON o.order_id = oi.order_id
         WHERE oi.id = %s AND o.customer = %s
@@ -2103,20 +2300,23 @@ async def create_exchange(
         if not row:
             raise HTTPException(403, "Invalid order item")
 
-        business_order_id, original_qty, product_name, price = row  # FIXED: variable name
-
-        # === Quantity check ===
-        cursor.execute("""
-            SELECT COALESCE(SUM(quantity),0)
-            FROM exchanges
-            WHERE order_item_id=%s
-              AND status NOT IN ('rejected','cancelled','completed')
-        """, (order_item_id,))
-        used = cursor.fetchone()[0]
+        business_order_id, original_qty, product_name, price, product_id = row  # FIXED: variable name
 
-        if used + quantity > original_qty:
+        # === Claim the quantity (atomic, also sets the item status) ===
+        if quantity < 1:
+            raise HTTPException(400, "Invalid quantity")
+        try:
+            claim_quantity(cursor, order_item_id, "exchange", quantity)
+        except QuantityExceeded:
             raise HTTPException(400, "Quantity exceeded")
 
+        # === Replacement colour must be in stock ===
+        variant_color = normalize_color(variant_color)
+        if product_id and variant_color:
+            problem = VariantIndex.load(cursor, [(product_id, variant_color)]).check(product_id, variant_color, quantity)
+            if problem:
+                raise HTTPException(409, problem)
+
         # === Insert exchange ===
         cursor.execute("""
         INSERT INTO exchanges (
@@ -2127,6 +2327,7 @@ async def create_exchange(
         reason,
         description,
         proof_image_path,
+        images,
         type,
         product_name,
         variant_color,
@@ -2134,8 +2335,9 @@ async def create_exchange(
         quantity,
         status
         ) VALUES (
-        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+        %s, %s, %s, %s, %s, %s, %s, %s::jsonb, %s, %s, %s, %s, %s, %s
         )
+        RETURNING id
         """, (
         business_order_id,
         order_item_id,
@@ -2144,6 +2346,7 @@ async def create_exchange(
         reason,
         details,           # This maps to 'description'
         images_json,       # This maps to 'proof_image_path'
+        images_json,       # This maps to 'images' (JSONB)
         'exchange',        # This maps to 'type'
         product_name,
         variant_color,
@@ -2151,24 +2354,33 @@ async def create_exchange(
         quantity,
         'Pending'          # This maps to 'status'
    ))
+        exchange_id = cursor.fetchone()[0]
 
-        # === Update item status ===
-        total = used + quantity
-        status = "exchanged" if total >= original_qty else "partial_exchanged"
-
-        cursor.execute(
-            "UPDATE order_items SET status=%s WHERE id=%s",
-            (status, order_item_id)
-        )
+        # Hold the replacement units until the exchange is completed or rejected (migration 018),
+        # or until the sweeper gives them back after EXCHANGE_HOLD_TTL
+        if product_id and variant_color:
+            reserve(cursor, f"exchange-{exchange_id}", [(product_id, quantity, variant_color)],
+                    expires_in=EXCHANGE_HOLD_TTL)
 
         conn.commit()
+        run_in_background(media.pregenerate(await uploads.commit()))
         return {"success": True, "message": "Exchange created"}
 
+    except HTTPException:
+        conn.rollback()
+        raise
+    except UploadError as e:
+        conn.rollback()
+        raise HTTPException(e.status_code, str(e))
+    except InsufficientStock as e:
+        conn.rollback()
+        raise insufficient_stock_error(e)
     except Exception as e:
         conn.rollback()
         print(f"DEBUG: Exchange error: {str(e)}")
         raise HTTPException(500, str(e))
     finally:
+        uploads.discard()
         cursor.close()
         conn.close()
 
@@ -2361,6 +2573,40 @@ async def get_exchanges_by_order(
         cursor.close()
         conn.close()
 
+@app.get("/returns/timeline")
+async def get_returns_timeline(
+    order_id: Optional[str] = None,
+    status: Optional[str] = None,
+    type: Optional[str] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    current_user: str = Depends(get_current_user)
+):
+    """
+    Refunds and exchanges of the current user in one newest-first list.
+    Filter by order_id, status and type (refund|exchange); pass next_cursor back as
+    `cursor` for the following page.
+    """
+    if type and type not in ("refund", "exchange"):
+        raise HTTPException(400, "type must be 'refund' or 'exchange'")
+
+    conn = get_db_connection()
+    db_cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        items, next_cursor = fetch_timeline(
+            db_cursor, current_user,
+            order_id=order_id, status=status, kind=type, limit=limit, after=cursor
+        )
+        return {"success": True, "items": items, "count": len(items), "next_cursor": next_cursor}
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except Exception as e:
+        print(f"RETURNS TIMELINE ERROR for user {current_user}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to fetch returns")
+    finally:
+        db_cursor.close()
+        conn.close()
+
 # ============================ RAZORPAY PAYMENT INTEGRATION ============================
 
 @app.post("/payment/create-order")
@@ -2417,7 +2663,27 @@ async def verify_payment(payload: VerifyPaymentRequest):
     
 
         # ✅ Step 2: Payment is verified
-        # ❌ DO NOT CHECK DB HERE
+        # ❌ DO NOT REQUIRE THE ORDER HERE (it may not be placed yet)
+        # Only turn a held stock reservation into a sale; no-op when there is none. The
+        # payment must be for the Razorpay order /payment/create-for-order recorded for
+        # this order, and for its full amount: the client picks payload.order_id.
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT amount, razorpay_order_id FROM orders WHERE order_id = %s FOR UPDATE",
+                (payload.order_id,)
+            )
+            order = cursor.fetchone()
+            if order and order[1] == payload.razorpay_order_id \
+                    and payment.get("order_id") == payload.razorpay_order_id \
+                    and payment.get("status") in ("authorized", "captured") \
+                    and not amount_mismatch(order[0], payment.get("amount"), payment.get("currency")):
+                commit_reservation(cursor, payload.order_id)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
 
         return {
             "success": True,
@@ -2434,6 +2700,167 @@ async def verify_payment(payload: VerifyPaymentRequest):
         raise HTTPException(status_code=500, detail="Payment verification failed")
 
 
+def store_payment_event(event):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        inserted = enqueue_event(cursor, event)
+        conn.commit()
+        return inserted
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.post("/payment/webhook")
+async def razorpay_webhook(request: Request):
+    """
+    Razorpay webhook receiver. Verifies the signature, stores the event (once per event id)
+    and returns; the payment event worker applies it to the order.
+    """
+    body = await request.body()
+    if not verify_signature(body, request.headers.get("x-razorpay-signature")):
+        raise HTTPException(status_code=400, detail="Invalid webhook signature")
+
+    try:
+        event = parse_event(body, request.headers.get("x-razorpay-event-id"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+
+    try:
+        inserted = await run_in_threadpool(store_payment_event, event)
+    except Exception as e:
+        print("Error storing payment event:", e)
+        # Non-2xx makes Razorpay redeliver later
+        raise HTTPException(status_code=500, detail="Failed to store event")
+
+    return {"status": "ok", "duplicate": not inserted}
+
+
+def process_payment_events():
+    conn = get_db_connection()
+    try:
+        return drain_payment_events(conn)
+    finally:
+        conn.close()
+
+
+async def payment_event_worker():
+    while True:
+        try:
+            await run_in_threadpool(process_payment_events)
+        except Exception as e:
+            print(f"Payment event processing failed: {e}")
+        await asyncio.sleep(PAYMENT_EVENTS_POLL)
+
+
+@app.on_event("startup")
+async def start_payment_event_worker():
+    run_in_background(payment_event_worker())
+
+
+@app.post("/payment/failed")
+async def payment_failed(payload: PaymentFailedRequest, current_user_id: str = Depends(get_current_user)):
+    """
+    Called by the app when Razorpay checkout fails or is dismissed; gives held stock back.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT 1 FROM orders WHERE order_id = %s AND customer = %s",
+            (payload.order_id, current_user_id)
+        )
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Order not found")
+
+        released = release_reservation(cursor, payload.order_id, reason=payload.reason or "payment_failed")
+        conn.commit()
+        return {"success": True, "order_id": payload.order_id, "released_lines": released}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        conn.rollback()
+        print("Error releasing reservation:", e)
+        raise HTTPException(status_code=500, detail="Failed to release reservation")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def sweep_expired_reservations():
+    conn = get_db_connection()
+    try:
+        released = release_expired(conn)
+        if released:
+            print(f"Released expired stock reservations for {len(released)} orders")
+    finally:
+        conn.close()
+
+
+async def reservation_sweeper():
+    while True:
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
+        try:
+            await run_in_threadpool(sweep_expired_reservations)
+        except Exception as e:
+            print(f"Reservation sweep failed: {e}")
+
+
+@app.on_event("startup")
+async def start_reservation_sweeper():
+    run_in_background(reservation_sweeper())
+
+
+def run_upload_gc():
+    conn = get_db_connection()
+    try:
+        report = collect_garbage(conn, dry_run=not UPLOAD_GC_DELETE)
+    finally:
+        conn.close()
+    report.pop("sample")
+    print(f"Upload GC: {report}")
+
+
+async def upload_gc_loop():
+    while True:
+        await asyncio.sleep(UPLOAD_GC_INTERVAL)
+        try:
+            await run_in_threadpool(run_upload_gc)
+        except Exception as e:
+            print(f"Upload GC failed: {e}")
+
+
+@app.on_event("startup")
+async def start_upload_gc():
+    run_in_background(upload_gc_loop())
+
+
+def run_tombstone_prune():
+    conn = get_db_connection()
+    try:
+        pruned = prune_tombstones(conn)
+    finally:
+        conn.close()
+    if pruned:
+        print(f"Pruned {pruned} product tombstones")
+
+
+async def tombstone_prune_loop():
+    while True:
+        await asyncio.sleep(TOMBSTONE_PRUNE_INTERVAL)
+        try:
+            await run_in_threadpool(run_tombstone_prune)
+        except Exception as e:
+            print(f"Tombstone prune failed: {e}")
+
+
+@app.on_event("startup")
+async def start_tombstone_prune():
+    run_in_background(tombstone_prune_loop())
+
+
 @app.get("/payment/order-status/{order_id}")
 async def get_payment_status(order_id: str):
     """
@@ -2471,20 +2898,101 @@ async def get_payment_status(order_id: str):
         cursor.close()
         conn.close()
 
+order_status_hub = OrderStatusHub(get_db_connection)
+# Coupon edits from the admin panel (and coupons running out) reach every worker's cache
+order_status_hub.on(COUPONS_CHANGED_CHANNEL, lambda payload: coupon_rules.invalidate())
+order_status_hub.on(PRODUCT_CHANGED_CHANNEL, on_product_changed)
+order_status_hub.on(PROFILE_CHANGED_CHANNEL, profile_cache.on_notify)
+
+
+@app.on_event("startup")
+async def start_order_status_hub():
+    order_status_hub.start()
+
+
+@app.on_event("shutdown")
+async def stop_order_status_hub():
+    await order_status_hub.stop()
+
+
+def load_order_status(order_id, customer):
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cursor.execute("""
+            SELECT order_id, status, payment, payment_method
+            FROM orders
+            WHERE order_id = %s AND customer = %s
+        """, (order_id, customer))
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.get("/orders/{order_id}/status/stream")
+async def stream_order_status_events(
+    order_id: str,
+    request: Request,
+    current_user_id: str = Depends(get_current_user)
+):
+    """
+    Server-Sent Events feed of the order's status and payment. Sends the current state,
+    then a `status` event whenever either changes (pushed via Postgres NOTIFY), and a
+    keep-alive comment while idle. Replaces polling /payment/order-status.
+    """
+    async def load_snapshot():
+        snapshot = await run_in_threadpool(load_order_status, order_id, current_user_id)
+        return dict(snapshot) if snapshot else None
+
+    # Only checks the order exists and is the caller's; the stream loads its own
+    # snapshot once it is subscribed
+    if await load_snapshot() is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+
+    return StreamingResponse(
+        stream_order_status(order_status_hub, order_id, load_snapshot, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/payment/create-for-order/{order_id}")
 async def create_payment_for_order(
     order_id: str,
-    payload: CreatePaymentRequest
+    payload: CreatePaymentRequest  # payload.amount is ignored; the order's amount is charged
 ):
     try:
-        amount_in_paise = int(payload.amount * 100)
+        # The amount comes from the order, not the request: this mapping is what webhooks
+        # and /payment/verify trust to mark the order paid
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT amount, payment FROM orders WHERE order_id = %s", (order_id,))
+            order = cursor.fetchone()
+            if not order:
+                raise HTTPException(status_code=404, detail="Order not found")
+            if (order[1] or "").lower() in PAID_STATUSES:
+                raise HTTPException(status_code=400, detail="Order is already paid")
+            amount_in_paise = int(round(float(order[0] or 0) * 100))
+
+            razorpay_order = razorpay_client.order.create({
+                "amount": amount_in_paise,
+                "currency": ORDER_CURRENCY,
+                "receipt": f"receipt_{order_id}",
+                "notes": {"order_id": order_id},
+                "payment_capture": 1
+            })
 
-        razorpay_order = razorpay_client.order.create({
-            "amount": amount_in_paise,
-            "currency": "INR",
-            "receipt": f"receipt_{order_id}",
-            "payment_capture": 1
-        })
+            # Webhooks for this Razorpay order are matched back to ours through this column
+            cursor.execute(
+                "UPDATE orders SET razorpay_order_id = %s WHERE order_id = %s",
+                (razorpay_order["id"], order_id)
+            )
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
 
         return {
             "success": True,
@@ -2494,6 +3002,8 @@ async def create_payment_for_order(
             "key": RAZORPAY_KEY_ID
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         print("Error creating Razorpay order:", e)
         raise HTTPException(status_code=500, detail="Payment creation failed")
@@ -2548,10 +3058,8 @@ async def verify_order_otp(payload: VerifyOrderOtpRequest, user_id: str = Depend
 
 class CouponRequest(BaseModel):
     coupon_code: str
-    subtotal: float
-    # Usually, you'd fetch the cart subtotal from the DB based on user_id, 
-    # but for simplicity, we'll assume it's provided or handled.
-    # subtotal: float 
+    # Optional: when omitted the subtotal is taken from the user's server-side cart
+    subtotal: Optional[float] = None
 @app.post("/coupons/apply")
 async def apply_coupon(
     request: CouponRequest,
@@ -2561,56 +3069,32 @@ async def apply_coupon(
     cursor = conn.cursor(cursor_factory=RealDictCursor)
 
     try:
-        # 1️⃣ Fetch coupon
-        cursor.execute("""
-            SELECT *
-            FROM coupons
-            WHERE code = %s
-        """, (request.coupon_code,))
-        coupon = cursor.fetchone()
+        # 1️⃣ Fetch coupon (active rules come from the in-process cache)
+        coupon = coupon_rules.get(cursor, request.coupon_code)
 
         if not coupon:
             raise HTTPException(400, "Invalid coupon code")
 
-        # 2️⃣ Validations
-        if coupon["status"] != "Active":
-            raise HTTPException(400, "Coupon is not active")
-
-        now = datetime.now(timezone.utc).date()
-
-        if coupon["expiry"] and coupon["expiry"] < now:
-            raise HTTPException(400, "Coupon has expired")
-
-        # Parse usage_count from "0/100" format
-        usage_parts = coupon["usage_count"].split("/")
-        current_usage = int(usage_parts[0])
-        usage_limit = int(usage_parts[1])
-
-
-        if current_usage >= usage_limit:
-            raise HTTPException(400, "Coupon usage limit reached")
-
-        # 3️⃣ Subtotal (TEMP)
-        current_subtotal =request.subtotal # Replace later
-
-        min_amount = float(coupon["min_order_value"] or 0)
-        if current_subtotal < min_amount:
-            raise HTTPException(
-                400,
-                f"Minimum purchase of ₹{min_amount} required"
-            )
-
-        # 4️⃣ Discount calculation
-        if coupon["discount_type"].lower() == "fixed":
-            discount_amount = float(coupon["discount_value"])
-        elif coupon["discount_type"].lower() == "percentage":
-            discount_amount = (
-                current_subtotal * float(coupon["discount_value"])
-            ) / 100
+        # 2️⃣ Subtotal (server cart unless the client still sends one)
+        if request.subtotal is not None:
+            current_subtotal = request.subtotal
         else:
-            raise HTTPException(400, "Invalid discount type")
+            snapshot = cart_service.get_priced_cart(cursor, user_id, normalize_product_dates)
+            conn.commit()
+            current_subtotal = snapshot["subtotal"]
+
+        # 3️⃣ Validations + discount calculation, for this user's tier and past uses
+        tier = load_user_type(cursor, user_id)
+        user_uses = (
+            user_coupon_uses(cursor, user_id).get(coupon["code"], 0)
+            if coupon["per_user_limit"] is not None else 0
+        )
+        try:
+            discount_amount = evaluate_coupon(coupon, current_subtotal, tier=tier, user_uses=user_uses)
+        except CouponError as e:
+            raise HTTPException(400, str(e))
 
-        # 5️⃣ Success response
+        # 4️⃣ Success response
         return {
             "success": True,
             "coupon_code": coupon["code"],
@@ -2638,32 +3122,13 @@ async def get_available_coupons(
     try:
         now = datetime.now(timezone.utc).date()
 
-        cursor.execute("""
-            SELECT
-                code,
-                discount_type,
-                discount_value,
-                min_order_value,
-                usage_count,
-                expiry
-            FROM coupons
-            WHERE status = 'Active'
-              AND (expiry IS NULL OR expiry >= %s)
-            ORDER BY id DESC
-        """, (now,))
-
-        coupons = cursor.fetchall()
-
         available_coupons = []
-        for c in coupons:
-            # Parse usage_count from "0/100" format
-            usage_parts = c["usage_count"].split("/")
-            current_usage = int(usage_parts[0])
-            usage_limit = int(usage_parts[1])
-
+        for c in coupon_rules.rules(cursor).values():
+            if c["expiry"] and c["expiry"] < now:
+                continue
 
             # Only include if usage limit not reached
-            if current_usage < usage_limit:
+            if c["used_count"] < c["usage_limit"]:
                 available_coupons.append({
                     "code": c["code"],
                     "discount_type": c["discount_type"],
@@ -2683,133 +3148,231 @@ async def get_available_coupons(
     finally:
         cursor.close()
         conn.close()
-@app.get("/category-banners")
-async def get_category_banners(
+
+
+@app.get("/coupons/best")
+async def get_best_coupons(
+    subtotal: Optional[float] = None,
     user_id: str = Depends(get_current_user)
 ):
+    """
+    Every coupon the user's cart qualifies for, ranked by saving, plus the ones that
+    don't apply yet and why. Runs over the cached rule set, so the app can call it on
+    every cart change instead of trying codes one by one.
+    """
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
 
     try:
-        cursor.execute("""
-            SELECT
-                id,
-                category,
-                image_url,
-                status
-            FROM cms_category_banners
-            WHERE status = TRUE
-            ORDER BY id ASC
-        """)
-
-        banners = cursor.fetchall()
+        snapshot = cart_service.get_priced_cart(cursor, user_id, normalize_product_dates)
+        rules = coupon_rules.rules(cursor)
+        user_uses = user_coupon_uses(cursor, user_id) if any(
+            c["per_user_limit"] is not None for c in rules.values()
+        ) else {}
+        conn.commit()
+
+        cart_subtotal = subtotal if subtotal is not None else snapshot["subtotal"]
+        tier = "b2b" if snapshot["user_type"] == "b2b" else "b2c"
+        eligible, ineligible = rank_coupons(rules, cart_subtotal, tier, user_uses)
 
         return {
             "success": True,
-            "data": [
-                {
-                    "id": b["id"],
-                    "category": b["category"],
-                    "image_url": b["image_url"]
-                }
-                for b in banners
-            ]
+            "subtotal": cart_subtotal,
+            "best": eligible[0] if eligible else None,
+            "data": eligible,
+            "ineligible": ineligible,
         }
 
     except Exception as e:
-        print("Fetch category banners error:", e)
-        raise HTTPException(500, "Failed to fetch category banners")
-
+        print("Best coupons error:", e)
+        raise HTTPException(500, "Failed to evaluate coupons")
     finally:
         cursor.close()
-        conn.close()        
-@app.get("/hero-banners")
-async def get_hero_banners(
-    user_id: str = Depends(get_current_user)
-):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+        conn.close()
+# ============================ MEDIA ============================
+@app.get("/files/{key:path}")
+async def get_file(key: str, request: Request):
+    """
+    Content-addressed blob. The URL changes whenever the content does, so responses are
+    cacheable forever. Whole-file local responses go through FileResponse (zero-copy where
+    the server supports it); single byte ranges are streamed as 206.
+    """
+    digest = digest_of(key)
+    if not digest:
+        raise HTTPException(404, "File not found")
+
+    etag = f'"{digest}"'
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, "ETag": etag, "Accept-Ranges": "bytes"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    storage = get_storage()
+    size = await run_in_threadpool(storage.size, key)
+    if size is None:
+        raise HTTPException(404, "File not found")
 
     try:
-        cursor.execute("""
-            SELECT
-                id,
-                title,
-                image,
-                position,
-                status,
-                created_at
-            FROM cms_banners
-            WHERE position = 'Hero Slider'
-              AND status = 'Active'
-            ORDER BY id ASC
-        """)
-
-        banners = cursor.fetchall()
+        byte_range = parse_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    media_type = content_type_of(key)
+    if byte_range is None:
+        local_path = storage.local_path(key)
+        if local_path:
+            return FileResponse(local_path, media_type=media_type, headers=headers)
+        start, end, status_code = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        storage.read_range(key, start, end),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
 
-        return {
-            "success": True,
-            "data": [
-                {
-                    "id": banner["id"],
-                    "title": banner["title"],
-                    "image_url": banner["image"],
-                    "position": banner["position"],
-                    "created_at": banner["created_at"].isoformat() if banner["created_at"] else None
-                }
-                for banner in banners
-            ]
-        }
 
+@app.get("/media/{path:path}")
+async def get_media(path: str, w: Optional[int] = None, fmt: Optional[str] = None, q: Optional[str] = None):
+    """
+    Resized/re-encoded variant of an image under uploads/, e.g. /media/abc.jpg?w=320&fmt=webp&q=medium.
+    Without Pillow on the server the original file is returned.
+    """
+    try:
+        source = media.resolve_source(path)
+        if media.Image is None:
+            return FileResponse(source, headers={"Cache-Control": "public, max-age=86400"})
+
+        width, image_format, quality = media.parse_variant(w, fmt, q)
+        variant = await media.derivatives.get(source, width, image_format, quality)
+    except media.MediaError as e:
+        raise HTTPException(e.status_code, str(e))
+    except HTTPException:
+        raise
     except Exception as e:
-        print("Fetch hero banners error:", e)
-        raise HTTPException(status_code=500, detail="Failed to fetch hero banners")
+        print(f"Media variant error for {path}: {e}")
+        raise HTTPException(500, "Failed to generate image")
+
+    # Variants of content-addressed blobs never change either
+    cache_control = IMMUTABLE_CACHE_CONTROL if path.startswith("files/") else "public, max-age=86400"
+    return FileResponse(
+        variant,
+        media_type=media.CONTENT_TYPES[image_format],
+        headers={"Cache-Control": cache_control},
+    )
+
+
+@app.on_event("startup")
+async def load_media_cache():
+    await run_in_threadpool(media.derivatives.load)
+
+
+@app.on_event("shutdown")
+async def stop_media_workers():
+    media.derivatives.shutdown()
+
+
+# ============================ CMS CONTENT ============================
+# Banners and CMS pages change a few times a week; they are served from pre-serialized
+# bytes (content_cache.py) and refreshed on the content_changed notification or TTL.
+content_cache = ContentCache()
+content_cache.register("hero_banners", lambda: with_connection(get_db_connection, load_hero_banners))
+content_cache.register("category_banners", lambda: with_connection(get_db_connection, load_category_banners))
+content_cache.register("cms_pages", lambda: with_connection(get_db_connection, load_cms_pages))
+order_status_hub.on(CONTENT_CHANGED_CHANNEL, content_cache.on_notify)
+
+
+async def cached_content_response(request: Request, name: str, error_message: str):
+    try:
+        entry = await content_cache.get(name)
+    except Exception as e:
+        print(f"Fetch {name} error:", e)
+        raise HTTPException(status_code=500, detail=error_message)
+
+    headers = {"ETag": entry.etag, "Cache-Control": f"private, max-age={CONTENT_MAX_AGE}"}
+    if request.headers.get("if-none-match") == entry.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+@app.get("/category-banners")
+async def get_category_banners(
+    request: Request,
+    user_id: str = Depends(get_current_user)
+):
+    return await cached_content_response(request, "category_banners", "Failed to fetch category banners")
+
+
+@app.get("/hero-banners")
+async def get_hero_banners(
+    request: Request,
+    user_id: str = Depends(get_current_user)
+):
+    return await cached_content_response(request, "hero_banners", "Failed to fetch hero banners")
+
 
-    finally:
-        cursor.close()
-        conn.close()        
 @app.get("/cms-pages")
 async def get_cms_pages(
+    request: Request,
     user_id: str = Depends(get_current_user)
 ):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    return await cached_content_response(request, "cms_pages", "Failed to fetch CMS pages")
 
-    try:
-        cursor.execute("""
-            SELECT
-                id,
-                title,
-                slug,
-                content,
-                status,
-                updated_at
-            FROM cms_pages
-            WHERE status = 'Published'
-            ORDER BY id ASC
-        """)
-
-        pages = cursor.fetchall()
 
-        return {
-            "success": True,
-            "data": [
-                {
-                    "id": page["id"],
-                    "title": page["title"],
-                    "slug": page["slug"],
-                    "content": page["content"],
-                    "status": page["status"],
-                    "updated_at": page["updated_at"].isoformat() if page["updated_at"] else None
-                }
-                for page in pages
-            ]
-        }
-
-    except Exception as e:
-        print("Fetch CMS pages error:", e)
-        raise HTTPException(status_code=500, detail="Failed to fetch CMS pages")
+# ============================ HOME BOOTSTRAP ============================
+@app.get("/bootstrap")
+async def get_bootstrap(
+    versions: Optional[str] = None,
+    user_id: str = Depends(get_current_user)
+):
+    """
+    Everything the home screen needs in one authenticated round trip: hero banners,
+    category banners, CMS pages and the newest products priced for the user's tier.
+    Banners and CMS pages come from the content cache, the rest load concurrently,
+    each on its own connection. Every section carries a
+    content version; pass them back as ?versions=hero_banners:<v>,cms_pages:<v> and
+    unchanged sections come back as {"version", "unchanged": true} without data.
+    A section that fails to load is reported as {"error": ...} instead of failing the
+    whole response.
+    """
+    known = parse_versions(versions)
+    cached_sections = ("hero_banners", "category_banners", "cms_pages")
+    loaders = {"user_type": (load_user_type, user_id)}
+    snapshot = catalog.current()
+    if snapshot is None:
+        loaders["new_products"] = (load_new_products,)
+    results = await asyncio.gather(
+        *(content_cache.get(name) for name in cached_sections),
+        *(run_in_threadpool(with_connection, get_db_connection, *loader) for loader in loaders.values()),
+        return_exceptions=True
+    )
+    loaded = dict(zip((*cached_sections, *loaders), results))
+    if snapshot is not None:
+        # Shared catalog snapshot (catalog_snapshot.py): no query. This section is its only
+        # reader; catalogue edits show up within SNAPSHOT_MIN_INTERVAL of the loader's rebuild,
+        # stock-only changes (which don't notify) can be up to SNAPSHOT_MAX_AGE old here.
+        # Prices are still worked out per request from the tier and the snapshot's columns
+        loaded["new_products"] = snapshot.recent(BOOTSTRAP_PRODUCTS)
+
+    user_type = loaded.pop("user_type")
+    if isinstance(user_type, Exception):
+        print("Bootstrap user type error:", user_type)
+        user_type = "b2c"
+    if not isinstance(loaded["new_products"], Exception):
+        loaded["new_products"] = price_products(loaded["new_products"], user_type, normalize_product_dates)
+
+    sections = {}
+    for name, data in loaded.items():
+        if isinstance(data, Exception):
+            print(f"Bootstrap section {name} error:", data)
+            sections[name] = {"error": f"Failed to load {name.replace('_', ' ')}"}
+        elif isinstance(data, CachedContent):
+            sections[name] = build_section(data.data, known.get(name), data.version)
+        else:
+            sections[name] = build_section(jsonable_encoder(data), known.get(name))
 
-    finally:
-        cursor.close()
-        conn.close()
+    return {"success": True, "user_type": user_type, "sections": sections}
@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import digest_of, get_storage
+from uploads import UPLOAD_ROOT
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is optional; without it /media serves originals
+    Image = None
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", ".media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Eviction scans the shared directory at most this often (seconds), after a render
+MEDIA_CACHE_SWEEP_INTERVAL = int(os.getenv("MEDIA_CACHE_SWEEP_INTERVAL", 60))
+# Variants used this recently (seconds) are never evicted: a response may still be streaming them
+MEDIA_CACHE_GRACE = int(os.getenv("MEDIA_CACHE_GRACE", 300))
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+
+# Requested widths snap up to one of these so the cache stays small and hit rates high
+MEDIA_WIDTHS = (160, 320, 480, 640, 960, 1280, 1920)
+QUALITY_PRESETS = {"low": 55, "medium": 72, "high": 88}
+DEFAULT_QUALITY = "medium"
+SOURCE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
+
+# Generated in the background for every new image upload (thumbnail and card sizes)
+PREGENERATE = ((320, "webp"), (640, "webp"))
+
+CONTENT_TYPES = {
+    "webp": "image/webp",
+    "avif": "image/avif",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+
+
+class MediaError(Exception):
+    def __init__(self, message, status_code=400):
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def _supported_formats():
+    if Image is None:
+        return set()
+    formats = {"jpeg", "png"}
+    if features.check("webp"):
+        formats.add("webp")
+    try:
+        if features.check("avif"):  # Pillow 11.2+
+            formats.add("avif")
+    except ValueError:
+        try:
+            import pillow_avif  # noqa: F401  registers the AVIF plugin
+            formats.add("avif")
+        except ImportError:
+            pass
+    return formats
+
+
+SUPPORTED_FORMATS = _supported_formats()
+
+
+def snap_width(width):
+    for allowed in MEDIA_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return MEDIA_WIDTHS[-1]
+
+
+def resolve_source(path):
+    """
+    Absolute path of the image behind a /media path: 'files/<key>' for content-addressed
+    blobs, anything else is relative to UPLOAD_ROOT. Rejects traversal and non-images.
+    """
+    path = path.lstrip("/")
+    if path.startswith("files/"):
+        key = path[len("files/"):]
+        source = get_storage().local_path(key) if digest_of(key) else None
+        if source is None:
+            raise MediaError("Not found", 404)  # invalid key, or a remote backend
+    else:
+        root = os.path.realpath(UPLOAD_ROOT)
+        source = os.path.realpath(os.path.join(root, path))
+        if not source.startswith(root + os.sep):
+            raise MediaError("Invalid path", 404)
+    if os.path.splitext(source)[1].lower() not in SOURCE_EXTENSIONS:
+        raise MediaError("Not an image", 404)
+    if not os.path.isfile(source):
+        raise MediaError("Not found", 404)
+    return source
+
+
+def render_variant(source, target, width, fmt, quality):
+    """
+    Runs in a worker process: decode, orient, downscale (never up), re-encode.
+    Writes to a temp name first so readers never see a half-written file.
+    """
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.width > width:
+            img.thumbnail((width, width * 10), Image.LANCZOS)
+
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif img.mode == "P":
+            img = img.convert("RGBA")
+
+        options = {"quality": quality}
+        if fmt == "webp":
+            options["method"] = 4
+        elif fmt == "jpeg":
+            options.update(optimize=True, progressive=True)
+        elif fmt == "png":
+            options = {"optimize": True}
+
+        temp = f"{target}.{os.getpid()}.tmp"
+        img.save(temp, format=fmt.upper(), **options)
+    os.replace(temp, target)
+    return os.path.getsize(target)
+
+
+class DerivativeCache:
+    """
+    Disk cache of generated variants, evicted least recently used first by total size.
+    Every worker shares the directory, so the directory is the index: a hit bumps the
+    file's mtime as its last use, and sweep() scans the files to size and evict them.
+    Keys include the source's mtime and size, so a replaced original gets fresh variants
+    and the stale ones simply age out. Identical concurrent requests share one render.
+    """
+
+    def __init__(self, directory=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_MAX_BYTES, workers=MEDIA_WORKERS,
+                 sweep_interval=MEDIA_CACHE_SWEEP_INTERVAL, grace=MEDIA_CACHE_GRACE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.sweep_interval = sweep_interval
+        self.grace = grace
+        self._inflight = {}
+        self._pool = None
+        self._swept_at = 0.0
+        self._sweep = None
+
+    def load(self):
+        """Creates the directory and trims it to size. Blocking; run in a thread."""
+        os.makedirs(self.directory, exist_ok=True)
+        self.sweep()
+
+    def sweep(self, now=None):
+        """
+        Scans the directory and, when it holds more than max_bytes, deletes the least
+        recently used variants until it doesn't. Files used within `grace` seconds (a
+        response may still be streaming them) and renders in progress are kept; so are
+        temp files another worker may still be writing. Blocking. Returns bytes freed.
+        """
+        now = now or time.time()
+        found = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another worker mid-scan
+                if name.endswith(".tmp"):
+                    if stat.st_mtime < now - self.grace:
+                        self._unlink(path)  # left behind by a crashed render
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+
+        total = sum(size for _, _, size in found)
+        freed = 0
+        for used_at, path, size in sorted(found):
+            if total - freed <= self.max_bytes:
+                break
+            if used_at >= now - self.grace:
+                break  # everything from here on was used too recently
+            try:
+                if os.stat(path).st_mtime >= now - self.grace:
+                    continue  # served since the scan
+            except FileNotFoundError:
+                freed += size
+                continue
+            if self._unlink(path):
+                freed += size
+        return freed
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _cache_path(self, source, width, fmt, quality):
+        stat = os.stat(source)
+        key = hashlib.sha1(
+            f"{source}|{stat.st_mtime_ns}|{stat.st_size}|{width}|{fmt}|{quality}".encode()
+        ).hexdigest()
+        return os.path.join(self.directory, key[:2], f"{key}.{fmt}")
+
+    @staticmethod
+    def _touch(path):
+        """Marks the variant used now; False if it's gone (evicted)."""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _maybe_sweep(self):
+        """Starts a background sweep after a render, at most every sweep_interval seconds."""
+        now = time.monotonic()
+        if now - self._swept_at < self.sweep_interval or (self._sweep is not None and not self._sweep.done()):
+            return
+        self._swept_at = now
+        self._sweep = asyncio.get_running_loop().run_in_executor(None, self.sweep)
+
+    async def get(self, source, width, fmt, quality):
+        """Path of the cached variant, rendering it (once, however many callers) if missing."""
+        path = self._cache_path(source, width, fmt, quality)
+        if self._touch(path):
+            return path
+
+        pending = self._inflight.get(path)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[path] = future
+        try:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            await asyncio.get_running_loop().run_in_executor(
+                self._pool, render_variant, source, path, width, fmt, quality
+            )
+            future.set_result(path)
+            self._maybe_sweep()
+            return path
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            del self._inflight[path]
+
+
+derivatives = DerivativeCache()
+
+
+def parse_variant(width, fmt, quality):
+    """Validated (width, fmt, quality) for a /media request."""
+    fmt = (fmt or "webp").lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt == "avif" and "avif" not in SUPPORTED_FORMATS:
+        fmt = "webp"  # AVIF encoder not installed; WebP is the next best
+    if fmt not in SUPPORTED_FORMATS:
+        raise MediaError(f"Unsupported format '{fmt}'")
+    if width is not None and width < 1:
+        raise MediaError("Width must be positive")
+    quality = QUALITY_PRESETS.get(quality or DEFAULT_QUALITY)
+    if quality is None:
+        raise MediaError(f"Quality must be one of {', '.join(QUALITY_PRESETS)}")
+    return snap_width(width or MEDIA_WIDTHS[-1]), fmt, quality
+
+
+async def pregenerate(keys):
+    """Background warm-up for freshly stored blobs; failures are only logged."""
+    if Image is None:
+        return
+    quality = QUALITY_PRESETS[DEFAULT_QUALITY]
+    for key in keys:
+        try:
+            source = resolve_source(f"files/{key}")
+        except MediaError:
+            continue  # PDFs and other non-images
+        for width, fmt in PREGENERATE:
+            if fmt not in SUPPORTED_FORMATS:
+                continue
+            try:
+                await derivatives.get(source, width, fmt, quality)
+            except Exception as e:
+                print(f"Variant pre-generation failed for {key} ({width}/{fmt}): {e}")
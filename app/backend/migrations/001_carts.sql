@@ -0,0 +1,20 @@
+-- Server-side cart. One cart per user; `version` is bumped on every change
+-- so priced snapshots can be cached until the cart is touched again.
+
+CREATE TABLE IF NOT EXISTS carts (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id TEXT NOT NULL UNIQUE,
+    coupon_code TEXT,
+    delivery_pincode TEXT,
+    version BIGINT NOT NULL DEFAULT 1,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS cart_items (
+    cart_id UUID NOT NULL REFERENCES carts(id) ON DELETE CASCADE,
+    product_id TEXT NOT NULL,
+    quantity INTEGER NOT NULL CHECK (quantity > 0),
+    added_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (cart_id, product_id)
+);
@@ -0,0 +1,20 @@
+-- HSN/SAC -> total GST rate, read by tax.py. Codes may be 2-8 digit prefixes;
+-- the longest matching prefix wins. Intra-state orders split the rate into
+-- CGST + SGST halves, inter-state orders charge it all as IGST.
+
+CREATE TABLE IF NOT EXISTS hsn_tax_rates (
+    hsn TEXT PRIMARY KEY,
+    gst_rate NUMERIC(5, 2) NOT NULL CHECK (gst_rate >= 0),
+    description TEXT,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Seed from the rates products already carry
+INSERT INTO hsn_tax_rates (hsn, gst_rate)
+SELECT DISTINCT ON (hsn) hsn, COALESCE(sgst, 0) + COALESCE(cgst, 0)
+FROM products
+WHERE hsn IS NOT NULL AND hsn <> ''
+ORDER BY hsn, updated_at DESC
+ON CONFLICT (hsn) DO NOTHING;
+
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS igst_amount NUMERIC(12, 2) NOT NULL DEFAULT 0;
@@ -0,0 +1,26 @@
+-- Stock taken by checkouts. 'held' rows belong to unpaid online payments and
+-- are released by the sweeper after expires_at; 'committed' rows are sales.
+
+CREATE TABLE IF NOT EXISTS stock_reservations (
+    id BIGSERIAL PRIMARY KEY,
+    order_id TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    quantity INTEGER NOT NULL CHECK (quantity > 0),
+    status TEXT NOT NULL CHECK (status IN ('held', 'committed', 'released')),
+    release_reason TEXT,
+    expires_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_reservations_order ON stock_reservations (order_id);
+CREATE INDEX IF NOT EXISTS idx_stock_reservations_expiry
+    ON stock_reservations (expires_at) WHERE status = 'held';
+
+-- Oversell guard at the storage level as well
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'products_stock_non_negative') THEN
+        ALTER TABLE products ADD CONSTRAINT products_stock_non_negative CHECK (stock >= 0) NOT VALID;
+    END IF;
+END $$;
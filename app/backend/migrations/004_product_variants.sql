@@ -0,0 +1,26 @@
+-- Colour-level inventory. `color` is the normalized 'RRGGBB' key (see
+-- variants.normalize_color). Price columns override the product's tier price
+-- when set. products.stock stays the total across colours.
+
+CREATE TABLE IF NOT EXISTS product_variants (
+    id BIGSERIAL PRIMARY KEY,
+    product_id TEXT NOT NULL,
+    color TEXT NOT NULL,
+    color_name TEXT,
+    stock INTEGER NOT NULL DEFAULT 0 CHECK (stock >= 0),
+    b2c_price NUMERIC(12, 2),
+    b2b_price NUMERIC(12, 2),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    UNIQUE (product_id, color)
+);
+
+-- Cart lines and reservations are per colour ('' = no colour chosen)
+ALTER TABLE cart_items ADD COLUMN IF NOT EXISTS color TEXT NOT NULL DEFAULT '';
+ALTER TABLE cart_items DROP CONSTRAINT IF EXISTS cart_items_pkey;
+ALTER TABLE cart_items ADD PRIMARY KEY (cart_id, product_id, color);
+
+ALTER TABLE stock_reservations ADD COLUMN IF NOT EXISTS color TEXT NOT NULL DEFAULT '';
+
+-- Link order lines back to the catalog so exchanges can check the colour asked for
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS product_id TEXT;
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS color TEXT;
@@ -0,0 +1,76 @@
+-- Running totals of quantity under refund / exchange per order item, so the
+-- request handlers can claim quantity with one conditional UPDATE instead of
+-- summing the refunds/exchanges tables without a lock.
+
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS refunded_qty INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS exchanged_qty INTEGER NOT NULL DEFAULT 0;
+
+-- Backfill with the same statuses the old aggregate checks counted
+UPDATE order_items oi
+SET refunded_qty = r.qty
+FROM (
+    SELECT order_item_id, SUM(quantity) AS qty
+    FROM refunds
+    WHERE lower(status) NOT IN ('rejected', 'cancelled')
+    GROUP BY order_item_id
+) r
+WHERE r.order_item_id = oi.id;
+
+UPDATE order_items oi
+SET exchanged_qty = e.qty
+FROM (
+    SELECT order_item_id, SUM(quantity) AS qty
+    FROM exchanges
+    WHERE lower(status) NOT IN ('rejected', 'cancelled', 'completed')
+    GROUP BY order_item_id
+) e
+WHERE e.order_item_id = oi.id;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'order_items_return_counters_non_negative') THEN
+        ALTER TABLE order_items ADD CONSTRAINT order_items_return_counters_non_negative
+            CHECK (refunded_qty >= 0 AND exchanged_qty >= 0) NOT VALID;
+    END IF;
+END $$;
+
+-- Give quantity back when a request is rejected/cancelled (or an exchange completes),
+-- and take it again if an admin reopens one. Admin tools update these tables directly,
+-- so this lives in the database rather than in the API.
+CREATE OR REPLACE FUNCTION release_refund_qty() RETURNS trigger AS $$
+DECLARE
+    was_open BOOLEAN := lower(OLD.status) NOT IN ('rejected', 'cancelled');
+    is_open BOOLEAN := lower(NEW.status) NOT IN ('rejected', 'cancelled');
+BEGIN
+    IF was_open AND NOT is_open THEN
+        UPDATE order_items SET refunded_qty = GREATEST(refunded_qty - OLD.quantity, 0) WHERE id = OLD.order_item_id;
+    ELSIF is_open AND NOT was_open THEN
+        UPDATE order_items SET refunded_qty = refunded_qty + NEW.quantity WHERE id = NEW.order_item_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION release_exchange_qty() RETURNS trigger AS $$
+DECLARE
+    was_open BOOLEAN := lower(OLD.status) NOT IN ('rejected', 'cancelled', 'completed');
+    is_open BOOLEAN := lower(NEW.status) NOT IN ('rejected', 'cancelled', 'completed');
+BEGIN
+    IF was_open AND NOT is_open THEN
+        UPDATE order_items SET exchanged_qty = GREATEST(exchanged_qty - OLD.quantity, 0) WHERE id = OLD.order_item_id;
+    ELSIF is_open AND NOT was_open THEN
+        UPDATE order_items SET exchanged_qty = exchanged_qty + NEW.quantity WHERE id = NEW.order_item_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS refunds_release_qty ON refunds;
+CREATE TRIGGER refunds_release_qty
+    AFTER UPDATE OF status ON refunds
+    FOR EACH ROW EXECUTE FUNCTION release_refund_qty();
+
+DROP TRIGGER IF EXISTS exchanges_release_qty ON exchanges;
+CREATE TRIGGER exchanges_release_qty
+    AFTER UPDATE OF status ON exchanges
+    FOR EACH ROW EXECUTE FUNCTION release_exchange_qty();
@@ -0,0 +1,29 @@
+-- Proof images as JSONB next to the legacy proof_image_path text column, so
+-- reads don't json.loads every row in Python, plus keyset indexes for the
+-- /returns/timeline endpoint.
+
+ALTER TABLE refunds ADD COLUMN IF NOT EXISTS images JSONB;
+ALTER TABLE exchanges ADD COLUMN IF NOT EXISTS images JSONB;
+
+-- proof_image_path is normally a JSON array of URLs, but older rows hold a bare URL
+CREATE OR REPLACE FUNCTION proof_images_jsonb(value TEXT) RETURNS JSONB AS $$
+BEGIN
+    IF value IS NULL OR btrim(value) = '' THEN
+        RETURN '[]'::jsonb;
+    END IF;
+    BEGIN
+        IF jsonb_typeof(value::jsonb) = 'array' THEN
+            RETURN value::jsonb;
+        END IF;
+    EXCEPTION WHEN others THEN
+        NULL;
+    END;
+    RETURN jsonb_build_array(value);
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+UPDATE refunds SET images = proof_images_jsonb(proof_image_path) WHERE images IS NULL;
+UPDATE exchanges SET images = proof_images_jsonb(proof_image_path) WHERE images IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_refunds_customer_timeline ON refunds (customer, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_exchanges_customer_timeline ON exchanges (customer, created_at DESC, id DESC);
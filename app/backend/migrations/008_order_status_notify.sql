@@ -0,0 +1,21 @@
+-- Publishes order status / payment changes on the 'order_status' channel; the
+-- API's SSE endpoint LISTENs once per worker and fans them out to subscribers.
+
+CREATE OR REPLACE FUNCTION notify_order_status() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('order_status', json_build_object(
+        'order_id', NEW.order_id,
+        'status', NEW.status,
+        'payment', NEW.payment,
+        'payment_method', NEW.payment_method
+    )::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS orders_notify_status ON orders;
+CREATE TRIGGER orders_notify_status
+    AFTER UPDATE OF status, payment ON orders
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.payment IS DISTINCT FROM NEW.payment)
+    EXECUTE FUNCTION notify_order_status();
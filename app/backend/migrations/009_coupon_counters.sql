@@ -0,0 +1,96 @@
+-- Coupon usage as integer counters so redemption is one conditional UPDATE
+-- (used_count < usage_limit) instead of parsing the "used/limit" string.
+-- usage_count stays as a derived display value for the admin panel, and writes
+-- to it from there are parsed back into the counters.
+
+ALTER TABLE coupons ADD COLUMN IF NOT EXISTS used_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE coupons ADD COLUMN IF NOT EXISTS usage_limit INTEGER NOT NULL DEFAULT 0;
+
+UPDATE coupons
+SET used_count = split_part(usage_count, '/', 1)::int,
+    usage_limit = split_part(usage_count, '/', 2)::int
+WHERE usage_count ~ '^\s*\d+\s*/\s*\d+\s*$';
+
+CREATE OR REPLACE FUNCTION sync_coupon_usage() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+       AND NEW.usage_count IS DISTINCT FROM OLD.usage_count
+       AND NEW.used_count = OLD.used_count AND NEW.usage_limit = OLD.usage_limit
+       AND NEW.usage_count ~ '^\s*\d+\s*/\s*\d+\s*$' THEN
+        -- Admin edited the string
+        NEW.used_count := split_part(NEW.usage_count, '/', 1)::int;
+        NEW.usage_limit := split_part(NEW.usage_count, '/', 2)::int;
+    ELSIF TG_OP = 'INSERT' AND NEW.usage_count ~ '^\s*\d+\s*/\s*\d+\s*$'
+          AND NEW.used_count = 0 AND NEW.usage_limit = 0 THEN
+        NEW.used_count := split_part(NEW.usage_count, '/', 1)::int;
+        NEW.usage_limit := split_part(NEW.usage_count, '/', 2)::int;
+    END IF;
+    NEW.usage_count := NEW.used_count || '/' || NEW.usage_limit;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS coupons_sync_usage ON coupons;
+CREATE TRIGGER coupons_sync_usage
+    BEFORE INSERT OR UPDATE ON coupons
+    FOR EACH ROW EXECUTE FUNCTION sync_coupon_usage();
+
+-- One row per order that used a coupon
+CREATE TABLE IF NOT EXISTS coupon_redemptions (
+    id SERIAL PRIMARY KEY,
+    coupon_code TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    order_id TEXT NOT NULL UNIQUE,
+    discount_amount NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_coupon_redemptions_code_user ON coupon_redemptions (coupon_code, user_id);
+
+-- A cancelled order or failed payment gives its coupon use back
+CREATE OR REPLACE FUNCTION release_coupon_redemption() RETURNS trigger AS $$
+DECLARE
+    released RECORD;
+BEGIN
+    IF (lower(COALESCE(NEW.status, '')) = 'cancelled' AND lower(COALESCE(OLD.status, '')) <> 'cancelled')
+       OR (lower(COALESCE(NEW.payment, '')) = 'failed' AND lower(COALESCE(OLD.payment, '')) <> 'failed') THEN
+        DELETE FROM coupon_redemptions WHERE order_id = NEW.order_id RETURNING coupon_code INTO released;
+        IF FOUND THEN
+            UPDATE coupons SET used_count = GREATEST(used_count - 1, 0) WHERE code = released.coupon_code;
+        END IF;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS orders_release_coupon ON orders;
+CREATE TRIGGER orders_release_coupon
+    AFTER UPDATE OF status, payment ON orders
+    FOR EACH ROW EXECUTE FUNCTION release_coupon_redemption();
+
+-- API workers cache the active coupon rules; tell them when the rules change.
+-- Plain redemptions only move used_count and stay quiet, except when a coupon
+-- runs out or becomes available again.
+CREATE OR REPLACE FUNCTION notify_coupons_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('coupons_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS coupons_notify_insert_delete ON coupons;
+CREATE TRIGGER coupons_notify_insert_delete
+    AFTER INSERT OR DELETE OR TRUNCATE ON coupons
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_coupons_changed();
+
+DROP TRIGGER IF EXISTS coupons_notify_update ON coupons;
+CREATE TRIGGER coupons_notify_update
+    AFTER UPDATE ON coupons
+    FOR EACH ROW
+    WHEN (
+        (OLD.code, OLD.status, OLD.expiry, OLD.min_order_value, OLD.discount_type, OLD.discount_value, OLD.usage_limit)
+            IS DISTINCT FROM
+        (NEW.code, NEW.status, NEW.expiry, NEW.min_order_value, NEW.discount_type, NEW.discount_value, NEW.usage_limit)
+        OR (OLD.used_count < OLD.usage_limit) <> (NEW.used_count < NEW.usage_limit)
+    )
+    EXECUTE FUNCTION notify_coupons_changed();
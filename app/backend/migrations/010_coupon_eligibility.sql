@@ -0,0 +1,22 @@
+-- Eligibility rules evaluated by /coupons/best (and enforced again at redemption):
+-- which customer tier a coupon is for, and how many times one user may use it.
+
+ALTER TABLE coupons ADD COLUMN IF NOT EXISTS customer_type TEXT;      -- NULL = every tier, else 'b2c' / 'b2b'
+ALTER TABLE coupons ADD COLUMN IF NOT EXISTS per_user_limit INTEGER;  -- NULL = no per-user limit
+
+CREATE INDEX IF NOT EXISTS idx_coupon_redemptions_user ON coupon_redemptions (user_id);
+
+-- Tier and per-user limit are rules too; the cached rule set must reload when they change
+DROP TRIGGER IF EXISTS coupons_notify_update ON coupons;
+CREATE TRIGGER coupons_notify_update
+    AFTER UPDATE ON coupons
+    FOR EACH ROW
+    WHEN (
+        (OLD.code, OLD.status, OLD.expiry, OLD.min_order_value, OLD.discount_type, OLD.discount_value,
+         OLD.usage_limit, OLD.customer_type, OLD.per_user_limit)
+            IS DISTINCT FROM
+        (NEW.code, NEW.status, NEW.expiry, NEW.min_order_value, NEW.discount_type, NEW.discount_value,
+         NEW.usage_limit, NEW.customer_type, NEW.per_user_limit)
+        OR (OLD.used_count < OLD.usage_limit) <> (NEW.used_count < NEW.usage_limit)
+    )
+    EXECUTE FUNCTION notify_coupons_changed();
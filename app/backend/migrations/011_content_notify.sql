@@ -0,0 +1,25 @@
+-- Tells API workers which cached content section to refresh when the admin panel
+-- edits banners or CMS pages (see content_cache.py). The trigger argument is the
+-- section name used by the cache.
+
+CREATE OR REPLACE FUNCTION notify_content_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('content_changed', TG_ARGV[0]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS cms_banners_notify ON cms_banners;
+CREATE TRIGGER cms_banners_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON cms_banners
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_content_changed('hero_banners');
+
+DROP TRIGGER IF EXISTS cms_category_banners_notify ON cms_category_banners;
+CREATE TRIGGER cms_category_banners_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON cms_category_banners
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_content_changed('category_banners');
+
+DROP TRIGGER IF EXISTS cms_pages_notify ON cms_pages;
+CREATE TRIGGER cms_pages_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON cms_pages
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_content_changed('cms_pages');
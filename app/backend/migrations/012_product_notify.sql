@@ -0,0 +1,55 @@
+-- Tells API workers which cached product responses to drop (route_cache.py tags
+-- product:<id>, category:<name> and products). Stock-only updates stay quiet: they
+-- happen on every order, and checkout re-checks stock anyway.
+
+CREATE OR REPLACE FUNCTION notify_product_changed() RETURNS trigger AS $$
+DECLARE
+    row_id TEXT;
+    categories TEXT[];
+BEGIN
+    categories := ARRAY[]::TEXT[];
+    IF TG_TABLE_NAME = 'product_variants' THEN
+        IF TG_OP = 'DELETE' THEN
+            row_id := OLD.product_id::text;
+        ELSE
+            row_id := NEW.product_id::text;
+        END IF;
+    ELSE
+        IF TG_OP <> 'INSERT' THEN
+            row_id := OLD.id::text;
+            categories := array_append(categories, OLD.category::text);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            row_id := NEW.id::text;
+            categories := array_append(categories, NEW.category::text);
+        END IF;
+        categories := array_remove(categories, NULL);
+    END IF;
+    PERFORM pg_notify('product_changed', json_build_object('id', row_id, 'categories', categories)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_notify_insert_delete ON products;
+CREATE TRIGGER products_notify_insert_delete
+    AFTER INSERT OR DELETE ON products
+    FOR EACH ROW EXECUTE FUNCTION notify_product_changed();
+
+DROP TRIGGER IF EXISTS products_notify_update ON products;
+CREATE TRIGGER products_notify_update
+    AFTER UPDATE ON products
+    FOR EACH ROW
+    WHEN ((to_jsonb(OLD) - 'stock' - 'updated_at') IS DISTINCT FROM (to_jsonb(NEW) - 'stock' - 'updated_at'))
+    EXECUTE FUNCTION notify_product_changed();
+
+DROP TRIGGER IF EXISTS product_variants_notify_insert_delete ON product_variants;
+CREATE TRIGGER product_variants_notify_insert_delete
+    AFTER INSERT OR DELETE ON product_variants
+    FOR EACH ROW EXECUTE FUNCTION notify_product_changed();
+
+DROP TRIGGER IF EXISTS product_variants_notify_update ON product_variants;
+CREATE TRIGGER product_variants_notify_update
+    AFTER UPDATE ON product_variants
+    FOR EACH ROW
+    WHEN ((to_jsonb(OLD) - 'stock' - 'updated_at') IS DISTINCT FROM (to_jsonb(NEW) - 'stock' - 'updated_at'))
+    EXECUTE FUNCTION notify_product_changed();
@@ -0,0 +1,56 @@
+-- Delta sync for the app's offline catalog (/products/changes). Every product
+-- write stamps change_seq with the writing transaction's id; readers only return
+-- changes below the oldest still-running transaction (pg_snapshot_xmin), so a
+-- token never skips a change that commits late. Needs PostgreSQL 13+.
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS idx_products_change_seq ON products (change_seq, (id::text));
+
+CREATE OR REPLACE FUNCTION stamp_product_change() RETURNS trigger AS $$
+BEGIN
+    NEW.change_seq := pg_current_xact_id()::text::bigint;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_stamp_change ON products;
+CREATE TRIGGER products_stamp_change
+    BEFORE INSERT OR UPDATE ON products
+    FOR EACH ROW EXECUTE FUNCTION stamp_product_change();
+
+-- Deleted products, so clients can drop them; pruned after a retention window
+CREATE TABLE IF NOT EXISTS product_tombstones (
+    product_id TEXT PRIMARY KEY,
+    change_seq BIGINT NOT NULL,
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_product_tombstones_change_seq ON product_tombstones (change_seq, product_id);
+
+CREATE OR REPLACE FUNCTION record_product_tombstone() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO product_tombstones (product_id, change_seq)
+    VALUES (OLD.id::text, pg_current_xact_id()::text::bigint)
+    ON CONFLICT (product_id) DO UPDATE SET change_seq = EXCLUDED.change_seq, deleted_at = NOW();
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_record_tombstone ON products;
+CREATE TRIGGER products_record_tombstone
+    AFTER DELETE ON products
+    FOR EACH ROW EXECUTE FUNCTION record_product_tombstone();
+
+-- Tokens older than the newest pruned tombstone can't be served incrementally
+CREATE TABLE IF NOT EXISTS product_sync_horizon (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    pruned_through BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO product_sync_horizon (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+-- change_seq moves on every write, stock-only ones included; keep those quiet (012)
+DROP TRIGGER IF EXISTS products_notify_update ON products;
+CREATE TRIGGER products_notify_update
+    AFTER UPDATE ON products
+    FOR EACH ROW
+    WHEN ((to_jsonb(OLD) - 'stock' - 'updated_at' - 'change_seq') IS DISTINCT FROM (to_jsonb(NEW) - 'stock' - 'updated_at' - 'change_seq'))
+    EXECUTE FUNCTION notify_product_changed();
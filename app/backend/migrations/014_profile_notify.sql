@@ -0,0 +1,47 @@
+-- Tells API workers which user's cached /users/me profile to drop (see user_profile.py),
+-- whether the change came from the app or the admin panel. The trigger argument is
+-- the column holding the user id in that table.
+
+CREATE OR REPLACE FUNCTION notify_profile_changed() RETURNS trigger AS $$
+DECLARE
+    row_user TEXT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_user := to_jsonb(OLD) ->> TG_ARGV[0];
+    ELSE
+        row_user := to_jsonb(NEW) ->> TG_ARGV[0];
+    END IF;
+    IF TG_OP = 'UPDATE' AND (to_jsonb(OLD) ->> TG_ARGV[0]) IS DISTINCT FROM row_user THEN
+        PERFORM pg_notify('profile_changed', to_jsonb(OLD) ->> TG_ARGV[0]);
+    END IF;
+    IF row_user IS NOT NULL THEN
+        PERFORM pg_notify('profile_changed', row_user);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS auth_users_notify_profile ON auth_users;
+CREATE TRIGGER auth_users_notify_profile
+    AFTER INSERT OR UPDATE OR DELETE ON auth_users
+    FOR EACH ROW EXECUTE FUNCTION notify_profile_changed('id');
+
+DROP TRIGGER IF EXISTS b2b_applications_notify_profile ON b2b_applications;
+CREATE TRIGGER b2b_applications_notify_profile
+    AFTER INSERT OR UPDATE OR DELETE ON b2b_applications
+    FOR EACH ROW EXECUTE FUNCTION notify_profile_changed('user_id');
+
+DROP TRIGGER IF EXISTS b2c_applications_notify_profile ON b2c_applications;
+CREATE TRIGGER b2c_applications_notify_profile
+    AFTER INSERT OR UPDATE OR DELETE ON b2c_applications
+    FOR EACH ROW EXECUTE FUNCTION notify_profile_changed('id');
+
+DROP TRIGGER IF EXISTS user_addresses_notify_profile ON user_addresses;
+CREATE TRIGGER user_addresses_notify_profile
+    AFTER INSERT OR UPDATE OR DELETE ON user_addresses
+    FOR EACH ROW EXECUTE FUNCTION notify_profile_changed('user_id');
+
+DROP TRIGGER IF EXISTS addresses_notify_profile ON addresses;
+CREATE TRIGGER addresses_notify_profile
+    AFTER INSERT OR UPDATE OR DELETE ON addresses
+    FOR EACH ROW EXECUTE FUNCTION notify_profile_changed('user_id');
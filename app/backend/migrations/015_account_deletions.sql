@@ -0,0 +1,28 @@
+-- Account deletion as a background job (account_deletion.py). The account is
+-- revoked at once through auth_users.deleted_at; its data is then deleted in
+-- bounded batches, each committed with the job's progress so a restart resumes.
+
+ALTER TABLE auth_users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ;
+
+CREATE TABLE IF NOT EXISTS account_deletions (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'running', 'done', 'failed')),
+    step TEXT,                                   -- the step in progress; NULL before the first and when done
+    progress JSONB NOT NULL DEFAULT '{}'::jsonb, -- rows deleted so far, per step
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    requested_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    heartbeat_at TIMESTAMPTZ,
+    completed_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_account_deletions_open
+    ON account_deletions (requested_at) WHERE status IN ('pending', 'running');
+
+-- The batched deletes look rows up by owner
+CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders (customer);
+CREATE INDEX IF NOT EXISTS idx_product_reviews_user ON product_reviews (user_id);
+CREATE INDEX IF NOT EXISTS idx_user_addresses_user ON user_addresses (user_id);
+CREATE INDEX IF NOT EXISTS idx_addresses_user ON addresses (user_id);
@@ -0,0 +1,31 @@
+-- Captures that can't simply mark an order paid (wrong amount or currency, or stock
+-- or coupon no longer available after the hold was given back) flag the order for a
+-- human instead (payments.py).
+
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS payment_review TEXT;  -- why; NULL when nothing to review
+CREATE INDEX IF NOT EXISTS idx_orders_payment_review ON orders (created_at) WHERE payment_review IS NOT NULL;
+
+ALTER TABLE payment_events DROP CONSTRAINT IF EXISTS payment_events_status_check;
+ALTER TABLE payment_events ADD CONSTRAINT payment_events_status_check
+    CHECK (status IN ('pending', 'processed', 'ignored', 'unmatched', 'failed', 'review'));
+
+-- A released coupon use is kept (marked) rather than deleted, so a capture that
+-- arrives after a failed attempt can take it again
+ALTER TABLE coupon_redemptions ADD COLUMN IF NOT EXISTS released_at TIMESTAMPTZ;
+
+CREATE OR REPLACE FUNCTION release_coupon_redemption() RETURNS trigger AS $$
+DECLARE
+    released RECORD;
+BEGIN
+    IF (lower(COALESCE(NEW.status, '')) = 'cancelled' AND lower(COALESCE(OLD.status, '')) <> 'cancelled')
+       OR (lower(COALESCE(NEW.payment, '')) = 'failed' AND lower(COALESCE(OLD.payment, '')) <> 'failed') THEN
+        UPDATE coupon_redemptions SET released_at = NOW()
+        WHERE order_id = NEW.order_id AND released_at IS NULL
+        RETURNING coupon_code INTO released;
+        IF FOUND THEN
+            UPDATE coupons SET used_count = GREATEST(used_count - 1, 0) WHERE code = released.coupon_code;
+        END IF;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
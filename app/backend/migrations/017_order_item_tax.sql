@@ -0,0 +1,11 @@
+-- Each order line keeps the HSN and total GST rate it was charged, so a refund
+-- reverses that line's own tax rather than the order's first product's (main.py).
+
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS hsn TEXT;
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS gst_rate NUMERIC(5, 2);  -- NULL for lines placed before this
+
+-- Older lines get their product's current HSN; their rate is looked up again at refund time
+UPDATE order_items oi
+SET hsn = p.hsn
+FROM products p
+WHERE oi.hsn IS NULL AND oi.product_id = p.id::text;
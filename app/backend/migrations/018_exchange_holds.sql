@@ -0,0 +1,51 @@
+-- Replacement units for an exchange are held as reservation 'exchange-<id>' (main.py)
+-- until EXCHANGE_HOLD_TTL. Settle the hold when the exchange is decided: completing it
+-- makes the units a sale, rejecting or cancelling it puts them back. Admin tools update
+-- exchanges directly, so like release_exchange_qty (005) this lives in the database.
+-- A hold the sweeper already released stays released; reopening doesn't retake it.
+
+CREATE OR REPLACE FUNCTION settle_exchange_hold() RETURNS trigger AS $$
+DECLARE
+    was_open BOOLEAN := lower(COALESCE(OLD.status, '')) NOT IN ('rejected', 'cancelled', 'completed');
+    new_status TEXT := lower(COALESCE(NEW.status, ''));
+    hold_id TEXT := 'exchange-' || NEW.id;
+BEGIN
+    IF NOT was_open THEN
+        RETURN NEW;
+    END IF;
+
+    IF new_status = 'completed' THEN
+        UPDATE stock_reservations
+        SET status = 'committed', updated_at = NOW()
+        WHERE order_id = hold_id AND status = 'held';
+    ELSIF new_status IN ('rejected', 'cancelled') THEN
+        -- Same lock order as inventory.py: products by id, then variants
+        PERFORM 1 FROM products
+        WHERE id::text IN (SELECT product_id FROM stock_reservations WHERE order_id = hold_id AND status = 'held')
+        ORDER BY id
+        FOR UPDATE;
+
+        WITH released AS (
+            UPDATE stock_reservations
+            SET status = 'released', release_reason = 'exchange ' || new_status, updated_at = NOW()
+            WHERE order_id = hold_id AND status = 'held'
+            RETURNING product_id, color, quantity
+        ), restocked AS (
+            UPDATE products p
+            SET stock = p.stock + r.qty
+            FROM (SELECT product_id, SUM(quantity) AS qty FROM released GROUP BY product_id) r
+            WHERE p.id::text = r.product_id
+        )
+        UPDATE product_variants v
+        SET stock = v.stock + r.qty, updated_at = NOW()
+        FROM (SELECT product_id, color, SUM(quantity) AS qty FROM released WHERE color <> '' GROUP BY product_id, color) r
+        WHERE v.product_id = r.product_id AND v.color = r.color;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS exchanges_settle_hold ON exchanges;
+CREATE TRIGGER exchanges_settle_hold
+    AFTER UPDATE OF status ON exchanges
+    FOR EACH ROW EXECUTE FUNCTION settle_exchange_hold();
@@ -81,6 +81,7 @@ class B2CRegister(BaseModel):
     
 class OrderedProductBase(BaseModel):
     order_item_id: Optional[int] = None 
+    productId: Optional[str] = Field(None, pattern=r"^\d+$")  # needed to reserve stock for the line; products.id is numeric
     name: str
     price: float
     imageUrl: str
@@ -111,6 +112,7 @@ class OrderCreate(BaseModel):
     customer_type: Optional[str] = None
     payment_status: str
     payment_method: str
+    coupon_code: Optional[str] = None  # redeemed with the order; the limit is enforced server-side
     hsn: Optional[str] = ""  # Add this
     city: Optional[str] = None        # 🔥 ADD
     state: Optional[str] = None 
@@ -132,3 +134,29 @@ class VerifyPaymentRequest(BaseModel):
     razorpay_payment_id: str
     razorpay_signature: str
     order_id: str  # Your internal order ID    
+
+class PaymentFailedRequest(BaseModel):
+    order_id: str  # Your internal order ID
+    reason: Optional[str] = None
+
+class CartItemRequest(BaseModel):
+    product_id: str
+    quantity: int = Field(1, ge=1)
+    color: Optional[str] = None  # colorHex of the chosen variant
+
+class CartQuantityUpdate(BaseModel):
+    quantity: int = Field(..., ge=0)  # 0 removes the item
+
+class CartCouponRequest(BaseModel):
+    coupon_code: str
+
+class CartPincodeRequest(BaseModel):
+    pincode: str
+
+class BatchItem(BaseModel):
+    id: Optional[str] = None  # echoed back to match responses; defaults to the index
+    method: str = "GET"
+    path: str  # e.g. "/coupons/available?subtotal=1200"
+
+class BatchRequest(BaseModel):
+    requests: List[BatchItem]
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+
+import psycopg2.extensions
+
+ORDER_STATUS_CHANNEL = "order_status"
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", 15))  # seconds between keep-alive comments
+SSE_QUEUE_SIZE = 4  # updates buffered per connection; older ones are dropped first
+LISTENER_RETRY = 5  # seconds before reconnecting a lost LISTEN connection
+
+# Queued to every subscriber after the LISTEN connection comes back: notifications sent
+# while it was down are gone, so streams reload their snapshot instead
+RESYNC = {"resync": True}
+
+
+class OrderStatusHub:
+    """
+    One LISTEN connection per worker process, read from the event loop with add_reader
+    (no thread, no polling), fanned out to per-order subscriber queues.
+    Each subscriber is a tiny bounded queue; a slow client only ever holds the latest
+    few updates, since each update carries the full current status.
+    Other modules can share the connection for their own channels via on().
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._conn = None
+        self._subscribers = {}  # order_id -> set of queues
+        self._handlers = {}  # extra channel -> callback(payload)
+        self._task = None
+
+    @property
+    def subscriber_count(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def on(self, channel, callback):
+        """Calls callback(payload) for every notification on `channel`; register before start()."""
+        self._handlers[channel] = callback
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._conn.fileno())
+            except Exception:
+                pass
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        listened = False
+        while True:
+            lost = loop.create_future()
+            try:
+                self._conn = await loop.run_in_executor(None, self._connect)
+                self._conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = self._conn.cursor()
+                for channel in (ORDER_STATUS_CHANNEL, *self._handlers):
+                    cursor.execute(f"LISTEN {channel}")
+                loop.add_reader(self._conn.fileno(), self._on_readable, lost)
+                if listened:
+                    self.resync()
+                listened = True
+                await lost
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Order status listener error: {e}")
+            finally:
+                self._close()
+            await asyncio.sleep(LISTENER_RETRY)
+
+    def _on_readable(self, lost):
+        try:
+            self._conn.poll()
+        except Exception as e:
+            if not lost.done():
+                lost.set_exception(e)
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            if notify.channel in self._handlers:
+                try:
+                    self._handlers[notify.channel](notify.payload)
+                except Exception as e:
+                    print(f"{notify.channel} handler error: {e}")
+                continue
+            try:
+                update = json.loads(notify.payload)
+            except ValueError:
+                continue
+            self.publish(update)
+
+    def publish(self, update):
+        for queue in self._subscribers.get(update.get("order_id"), ()):
+            self._put(queue, update)
+
+    def resync(self):
+        for queues in self._subscribers.values():
+            for queue in queues:
+                self._put(queue, RESYNC)
+
+    @staticmethod
+    def _put(queue, update):
+        if queue.full():
+            queue.get_nowait()  # keep the newest; every update is a full snapshot
+        queue.put_nowait(update)
+
+    def subscribe(self, order_id):
+        queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self._subscribers.setdefault(order_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, order_id, queue):
+        queues = self._subscribers.get(order_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[order_id]
+
+
+def sse_message(data, event="status"):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def stream_order_status(hub, order_id, load_snapshot, is_disconnected):
+    """
+    SSE body: the current snapshot, then every change, with a comment line every
+    SSE_HEARTBEAT seconds so proxies keep the idle connection open.
+    `load_snapshot` is an async callable returning the order's status (None once it's
+    gone). It runs after subscribing, so a change committed in between is still
+    delivered, and again whenever the hub asks for a resync.
+    """
+    queue = hub.subscribe(order_id)
+    try:
+        snapshot = await load_snapshot()
+        if snapshot is None:
+            return
+        yield sse_message(snapshot)
+        while True:
+            try:
+                update = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    return
+                yield ": ping\n\n"
+                continue
+            if update is RESYNC:
+                update = await load_snapshot()
+                if update is None:
+                    return
+            yield sse_message(update)
+    finally:
+        hub.unsubscribe(order_id, queue)
@@ -0,0 +1,410 @@
+import hashlib
+import hmac
+import json
+import os
+
+from psycopg2.extras import Json
+
+from inventory import InsufficientStock, commit_reservation, release_reservation, reserve
+
+RAZORPAY_WEBHOOK_SECRET = os.getenv("RAZORPAY_WEBHOOK_SECRET")
+PAYMENT_EVENTS_BATCH = int(os.getenv("PAYMENT_EVENTS_BATCH", 100))
+PAYMENT_EVENTS_POLL = float(os.getenv("PAYMENT_EVENTS_POLL", 1.0))  # seconds between idle polls
+PAYMENT_EVENT_MAX_ATTEMPTS = 20
+PAYMENT_EVENT_RETRY_DELAY = 30  # seconds, multiplied by the attempt number
+
+PAID_STATUSES = ("paid", "success", "completed", "captured")
+ORDER_CURRENCY = "INR"  # orders.amount is in rupees
+AMOUNT_TOLERANCE = 1  # paise
+CAPTURED_EVENTS = {"payment.captured", "order.paid"}
+FAILED_EVENTS = {"payment.failed"}
+
+
+def verify_signature(body, signature, secret=None):
+    """Razorpay signs the raw request body with the webhook secret (HMAC-SHA256, hex)."""
+    secret = secret or RAZORPAY_WEBHOOK_SECRET
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def parse_event(body, event_id=None):
+    """
+    The columns stored for one delivery. Razorpay sends the event id in the
+    X-Razorpay-Event-Id header; a hash of the body stands in when it's missing.
+    """
+    payload = json.loads(body)
+    entities = payload.get("payload") or {}
+    payment = (entities.get("payment") or {}).get("entity") or {}
+    order = (entities.get("order") or {}).get("entity") or {}
+    return {
+        "event_id": event_id or hashlib.sha256(body).hexdigest(),
+        "event_type": payload.get("event") or "unknown",
+        "razorpay_order_id": payment.get("order_id") or order.get("id"),
+        "razorpay_payment_id": payment.get("id"),
+        "payload": payload,
+    }
+
+
+def enqueue_event(cursor, event):
+    """Stores a delivery; returns False when the event id was already stored (a redelivery)."""
+    cursor.execute("""
+        INSERT INTO payment_events (event_id, event_type, razorpay_order_id, razorpay_payment_id, payload)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (event_id) DO NOTHING
+    """, (event["event_id"], event["event_type"], event["razorpay_order_id"],
+          event["razorpay_payment_id"], Json(event["payload"])))
+    return cursor.rowcount == 1
+
+
+def _payment_entity(payload):
+    return ((payload.get("payload") or {}).get("payment") or {}).get("entity") or {}
+
+
+def _captured_amount(payload):
+    """(amount in paise, currency) of a capture; order.paid may carry only the order entity."""
+    payment = _payment_entity(payload)
+    if payment.get("amount") is not None:
+        return payment.get("amount"), payment.get("currency")
+    order = ((payload.get("payload") or {}).get("order") or {}).get("entity") or {}
+    return order.get("amount_paid"), order.get("currency")
+
+
+def _resolve_orders(cursor, events):
+    """
+    Maps each event to one of our order ids with a single lookup for the whole batch.
+    Only the mapping /payment/create-for-order records counts; notes and receipts are
+    whatever the client asked Razorpay to store, so they are never trusted.
+    """
+    razorpay_ids = [e["razorpay_order_id"] for e in events if e["razorpay_order_id"]]
+    if not razorpay_ids:
+        return {}
+
+    cursor.execute("""
+        SELECT order_id, razorpay_order_id
+        FROM orders
+        WHERE razorpay_order_id = ANY(%s)
+    """, (razorpay_ids,))
+    by_razorpay = {}
+    for row in cursor.fetchall():
+        order_id, razorpay_order_id = (row["order_id"], row["razorpay_order_id"]) if isinstance(row, dict) else row
+        by_razorpay[razorpay_order_id] = order_id
+
+    return {
+        e["event_id"]: by_razorpay[e["razorpay_order_id"]]
+        for e in events if e["razorpay_order_id"] in by_razorpay
+    }
+
+
+def amount_mismatch(order_amount, amount, currency):
+    """Why a capture of `amount` paise in `currency` doesn't pay the order, or None."""
+    if (currency or "").upper() != ORDER_CURRENCY:
+        return f"paid in {currency or 'unknown currency'}, expected {ORDER_CURRENCY}"
+    expected = int(round(float(order_amount or 0) * 100))
+    if amount is None or abs(expected - int(amount)) > AMOUNT_TOLERANCE:
+        return f"paid {amount} paise, expected {expected}"
+    return None
+
+
+def flag_for_review(cursor, reasons):
+    """reasons: order_id -> why the order needs a human. Latest reason wins."""
+    if not reasons:
+        return
+    ids = list(reasons)
+    cursor.execute("""
+        UPDATE orders o
+        SET payment_review = v.reason
+        FROM unnest(%s::text[], %s::text[]) AS v(order_id, reason)
+        WHERE o.order_id = v.order_id
+    """, (ids, [reasons[i] for i in ids]))
+
+
+def retake_released(cursor, order_id):
+    """
+    A capture for an order whose hold was already given back (an earlier attempt
+    failed, or the hold expired): takes the stock and the coupon use again. Returns
+    why that wasn't possible, or None.
+    """
+    cursor.execute("""
+        SELECT product_id, quantity, color,
+               EXISTS (SELECT 1 FROM stock_reservations
+                       WHERE order_id = %s AND status = 'committed') AS committed
+        FROM stock_reservations
+        WHERE order_id = %s AND status = 'released'
+    """, (order_id, order_id))
+    rows = [row if isinstance(row, dict) else dict(zip(("product_id", "quantity", "color", "committed"), row))
+            for row in cursor.fetchall()]
+    problems = []
+    if rows and not rows[0]["committed"]:
+        cursor.execute("SAVEPOINT retake_stock")
+        try:
+            reserve(cursor, order_id, [(r["product_id"], r["quantity"], r["color"]) for r in rows])
+            cursor.execute("RELEASE SAVEPOINT retake_stock")
+        except InsufficientStock as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT retake_stock")
+            problems.append(f"captured after its stock was released; {e}")
+
+    # Coupon use given back by the 009/016 trigger when the order was marked failed
+    cursor.execute("""
+        WITH released AS (
+            UPDATE coupon_redemptions SET released_at = NULL
+            WHERE order_id = %s AND released_at IS NOT NULL
+            RETURNING coupon_code
+        )
+        SELECT r.coupon_code,
+               (SELECT c.used_count < c.usage_limit FROM coupons c WHERE c.code = r.coupon_code) AS available
+        FROM released r
+    """, (order_id,))
+    row = cursor.fetchone()
+    if row is not None:
+        code, available = (row["coupon_code"], row["available"]) if isinstance(row, dict) else row
+        # Taken even when the coupon has run out since: the customer paid the discounted price
+        cursor.execute("UPDATE coupons SET used_count = used_count + 1 WHERE code = %s", (code,))
+        if not available:
+            problems.append(f"captured after coupon {code} ran out; its limit is now exceeded")
+
+    return "; ".join(problems) or None
+
+
+def apply_payment_updates(cursor, paid, failed):
+    """
+    Batched order updates. `paid` maps order_id -> (payment_id, method, razorpay_order_id,
+    amount in paise, currency), `failed` maps order_id -> razorpay_order_id. A paid order
+    is never downgraded, and a capture that doesn't match the order's amount and currency
+    never marks it paid; such orders are flagged for review instead.
+    Returns (newly_paid, newly_failed, flagged), flagged being order_id -> reason.
+    """
+    newly_paid = []
+    flagged = {}
+    if paid:
+        cursor.execute("""
+            SELECT order_id, amount, payment
+            FROM orders
+            WHERE order_id = ANY(%s)
+            ORDER BY order_id
+            FOR UPDATE
+        """, (list(paid),))
+        payable = []
+        for row in cursor.fetchall():
+            order_id, amount, payment = (
+                (row["order_id"], row["amount"], row["payment"]) if isinstance(row, dict) else row
+            )
+            if (payment or "").lower() in PAID_STATUSES:
+                continue
+            mismatch = amount_mismatch(amount, paid[order_id][3], paid[order_id][4])
+            if mismatch:
+                flagged[order_id] = f"payment {paid[order_id][0]} {mismatch}"
+            else:
+                payable.append(order_id)
+
+        ids = payable
+        if ids:
+            cursor.execute("""
+                UPDATE orders o
+                SET payment = 'paid',
+                    payment_method = COALESCE(v.method, o.payment_method),
+                    razorpay_payment_id = v.payment_id
+                FROM unnest(%s::text[], %s::text[], %s::text[]) AS v(order_id, payment_id, method)
+                WHERE o.order_id = v.order_id
+                RETURNING o.order_id
+            """, (ids, [paid[i][0] for i in ids], [paid[i][1] for i in ids]))
+            newly_paid = [row["order_id"] if isinstance(row, dict) else row[0] for row in cursor.fetchall()]
+        for order_id in newly_paid:
+            if commit_reservation(cursor, order_id) == 0:
+                problem = retake_released(cursor, order_id)
+                if problem:
+                    flagged[order_id] = problem
+
+    newly_failed = []
+    if failed:
+        ids = list(failed)
+        cursor.execute("""
+            UPDATE orders o
+            SET payment = 'failed'
+            FROM unnest(%s::text[]) AS v(order_id)
+            WHERE o.order_id = v.order_id
+              AND lower(COALESCE(o.payment, '')) <> ALL(%s)
+            RETURNING o.order_id
+        """, (ids, list(PAID_STATUSES)))
+        newly_failed = [row["order_id"] if isinstance(row, dict) else row[0] for row in cursor.fetchall()]
+        for order_id in newly_failed:
+            release_reservation(cursor, order_id, reason="payment_failed")
+
+    flag_for_review(cursor, flagged)
+    return newly_paid, newly_failed, flagged
+
+
+def _mark(cursor, outcomes):
+    """outcomes: event_id -> (status, error). 'pending' means retry later."""
+    if not outcomes:
+        return
+    ids = list(outcomes)
+    cursor.execute("""
+        UPDATE payment_events e
+        SET status = v.status,
+            attempts = e.attempts + 1,
+            last_error = v.error,
+            processed_at = CASE WHEN v.status = 'pending' THEN NULL ELSE NOW() END,
+            next_attempt_at = NOW() + make_interval(secs => %s * (e.attempts + 1))
+        FROM unnest(%s::text[], %s::text[], %s::text[]) AS v(event_id, status, error)
+        WHERE e.event_id = v.event_id
+    """, (PAYMENT_EVENT_RETRY_DELAY, ids, [outcomes[i][0] for i in ids], [outcomes[i][1] for i in ids]))
+
+
+def process_pending_events(conn, batch_size=PAYMENT_EVENTS_BATCH):
+    """
+    Applies one batch of pending events in one transaction. SKIP LOCKED lets several
+    workers (or app instances) drain the queue without stepping on each other.
+    Returns the number of events taken from the queue.
+    """
+    cursor = conn.cursor()
+    events = []
+    try:
+        cursor.execute("""
+            SELECT event_id, event_type, razorpay_order_id, razorpay_payment_id, payload, attempts
+            FROM payment_events
+            WHERE status = 'pending' AND next_attempt_at <= NOW()
+            ORDER BY received_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (batch_size,))
+        columns = ("event_id", "event_type", "razorpay_order_id", "razorpay_payment_id", "payload", "attempts")
+        events = [row if isinstance(row, dict) else dict(zip(columns, row)) for row in cursor.fetchall()]
+        if not events:
+            conn.commit()
+            return 0
+
+        resolved = _resolve_orders(cursor, events)
+        paid, failed, outcomes = {}, {}, {}
+        for e in events:
+            kind = e["event_type"]
+            if kind not in CAPTURED_EVENTS and kind not in FAILED_EVENTS:
+                outcomes[e["event_id"]] = ("ignored", None)
+                continue
+            order_id = resolved.get(e["event_id"])
+            if order_id is None:
+                # The webhook can beat the app to placing the order; try again later
+                gave_up = e["attempts"] + 1 >= PAYMENT_EVENT_MAX_ATTEMPTS
+                outcomes[e["event_id"]] = ("unmatched" if gave_up else "pending", "No matching order")
+                continue
+            if kind in CAPTURED_EVENTS:
+                payment = _payment_entity(e["payload"])
+                paid[order_id] = (e["razorpay_payment_id"], payment.get("method"), e["razorpay_order_id"],
+                                  *_captured_amount(e["payload"]))
+            else:
+                failed[order_id] = e["razorpay_order_id"]
+            outcomes[e["event_id"]] = ("processed", None)
+
+        # A capture in the same batch wins over an earlier failed attempt
+        for order_id in paid:
+            failed.pop(order_id, None)
+
+        _, _, flagged = apply_payment_updates(cursor, paid, failed)
+        for e in events:
+            if resolved.get(e["event_id"]) in flagged and e["event_type"] in CAPTURED_EVENTS:
+                outcomes[e["event_id"]] = ("review", flagged[resolved[e["event_id"]]][:500])
+        _mark(cursor, outcomes)
+        conn.commit()
+        return len(events)
+    except Exception as e:
+        conn.rollback()
+        _record_failure(conn, [ev["event_id"] for ev in events], str(e))
+        raise
+    finally:
+        cursor.close()
+
+
+def _record_failure(conn, event_ids, error):
+    """Counts a failed batch against its events so a poison event eventually stops retrying."""
+    if not event_ids:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE payment_events
+            SET attempts = attempts + 1,
+                last_error = %s,
+                status = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE status END,
+                next_attempt_at = NOW() + make_interval(secs => %s * (attempts + 1))
+            WHERE event_id = ANY(%s) AND status = 'pending'
+        """, (error[:500], PAYMENT_EVENT_MAX_ATTEMPTS, PAYMENT_EVENT_RETRY_DELAY, event_ids))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+    finally:
+        cursor.close()
+
+
+def drain_payment_events(conn, batch_size=PAYMENT_EVENTS_BATCH):
+    """Processes batches until the queue has nothing due. Returns the total processed."""
+    total = 0
+    while True:
+        taken = process_pending_events(conn, batch_size)
+        total += taken
+        if taken < batch_size:
+            return total
+
+
+# ============================ FAKE WEBHOOK SENDER ============================
+# Sends signed Razorpay-style webhooks to a running server, each one delivered
+# several times to exercise de-duplication:
+#   python payments.py --url http://localhost:8000/payment/webhook \
+#       --razorpay-order order_ABC --event payment.captured --repeat 3
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import uuid
+
+    import requests
+
+    parser = argparse.ArgumentParser(description="Fake Razorpay webhook sender")
+    parser.add_argument("--url", default="http://localhost:8000/payment/webhook")
+    parser.add_argument("--secret", default=RAZORPAY_WEBHOOK_SECRET, help="defaults to RAZORPAY_WEBHOOK_SECRET")
+    parser.add_argument("--razorpay-order", action="append", required=True, help="razorpay order id (repeatable)")
+    parser.add_argument("--order-id", help="our order id, sent as notes.order_id")
+    parser.add_argument("--event", default="payment.captured",
+                        choices=sorted(CAPTURED_EVENTS | FAILED_EVENTS | {"payment.authorized"}))
+    parser.add_argument("--method", default="upi")
+    parser.add_argument("--amount", type=int, default=10000, help="paise")
+    parser.add_argument("--repeat", type=int, default=2, help="deliveries per event (same event id)")
+    parser.add_argument("--bad-signature", action="store_true")
+    args = parser.parse_args()
+    if not args.secret:
+        raise SystemExit("Set RAZORPAY_WEBHOOK_SECRET or pass --secret")
+
+    session = requests.Session()
+    for razorpay_order_id in args.razorpay_order:
+        event_id = f"evt_{uuid.uuid4().hex[:14]}"
+        payment_id = f"pay_{uuid.uuid4().hex[:14]}"
+        body = json.dumps({
+            "entity": "event",
+            "event": args.event,
+            "contains": ["payment"],
+            "created_at": int(time.time()),
+            "payload": {"payment": {"entity": {
+                "id": payment_id,
+                "entity": "payment",
+                "amount": args.amount,
+                "currency": "INR",
+                "status": "failed" if args.event in FAILED_EVENTS else "captured",
+                "order_id": razorpay_order_id,
+                "method": args.method,
+                "notes": {"order_id": args.order_id} if args.order_id else [],
+            }}},
+        }).encode()
+        signature = hmac.new(args.secret.encode(), body, hashlib.sha256).hexdigest()
+        if args.bad_signature:
+            signature = "0" * len(signature)
+
+        for attempt in range(args.repeat):
+            started = time.perf_counter()
+            response = session.post(args.url, data=body, headers={
+                "Content-Type": "application/json",
+                "X-Razorpay-Signature": signature,
+                "X-Razorpay-Event-Id": event_id,
+            })
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            print(f"{event_id} {args.event} {razorpay_order_id} delivery {attempt + 1}: "
+                  f"{response.status_code} {response.text} ({elapsed_ms:.1f} ms)")
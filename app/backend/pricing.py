@@ -0,0 +1,44 @@
+from datetime import datetime
+
+
+def tier_for(user_type):
+    """Maps a user_type to the price tier used by the products table (anything but b2c is b2b)."""
+    return "b2c" if user_type == "b2c" else "b2b"
+
+
+def is_offer_active(product, tier, now=None):
+    """True when the tier's offer is switched on, priced and inside its start/end window."""
+    now = now or datetime.now()
+    start = product.get(f"{tier}_offer_start_date")
+    end = product.get(f"{tier}_offer_end_date")
+    return bool(
+        product.get(f"{tier}_active_offer") and
+        (product.get(f"{tier}_offer_price") or 0) > 0 and
+        (start is None or start <= now) and
+        (end is None or end >= now)
+    )
+
+
+def resolve_price(product, user_type, now=None):
+    """
+    Returns (current_price, original_price, discount_percentage) for a product row.
+    Offer dates must already be normalized (see normalize_product_dates in main.py).
+    """
+    tier = tier_for(user_type)
+    base_price = float(product.get(f"{tier}_price") or 0)
+
+    if is_offer_active(product, tier, now):
+        offer_price = float(product[f"{tier}_offer_price"])
+        discount = round((base_price - offer_price) / base_price * 100, 2) if base_price > 0 else 0
+        return offer_price, base_price, discount
+
+    return base_price, base_price, float(product.get(f"{tier}_discount") or 0)
+
+
+def next_offer_boundary(product, tier, now):
+    """The next offer start/end after `now` for the tier, i.e. when the price can next change."""
+    upcoming = [
+        d for d in (product.get(f"{tier}_offer_start_date"), product.get(f"{tier}_offer_end_date"))
+        if isinstance(d, datetime) and d > now
+    ]
+    return min(upcoming) if upcoming else None
@@ -0,0 +1,215 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+
+from bootstrap import price_products
+from pricing import next_offer_boundary, tier_for
+
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", 5000))  # (product, tier, kind) entries
+
+# Columns of the /products and /products/{id} responses, before the computed price fields
+PRODUCT_COLUMNS = """
+    p.id, p.name, p.colors, p.brand_name, p.category, p.description, p.status, p.stock, p.image,
+    p.created_at, p.updated_at,
+    p.b2c_price, p.b2b_price,
+    p.b2c_active_offer, p.b2b_active_offer,
+    p.b2c_offer_price, p.b2b_offer_price,
+    p.b2c_discount, p.b2b_discount,
+    p.b2c_offer_start_date, p.b2c_offer_end_date, p.sgst,
+    p.cgst, p.b2b_offer_start_date, p.b2b_offer_end_date,
+    p.compare_at_price, p.info,
+    p.weight, p.length, p.breadth, p.return_policy, p.height, p.hsn
+"""
+
+REVIEW_STATS_JOIN = """
+    LEFT JOIN LATERAL (
+        SELECT COUNT(*) AS review_count, AVG(rating) AS avg_rating
+        FROM product_reviews pr
+        WHERE pr.product_id = p.id
+    ) r ON TRUE
+"""
+
+_SLOT_PATTERN = re.compile(rb'"\\u0000(\w+)\\u0000"')
+
+
+def _slot(name):
+    return f"\x00{name}\x00"
+
+
+class Fragment:
+    """
+    A product's JSON rendered once, split around its dynamic fields (slots) so a
+    response is static byte chunks joined with a few freshly encoded values.
+    """
+
+    __slots__ = ("chunks", "slots", "signature", "valid_until", "current_price")
+
+    def __init__(self, data, dynamic, signature, valid_until):
+        data = dict(data)
+        for name in dynamic:
+            data[name] = _slot(name)
+        body = json.dumps(jsonable_encoder(data), separators=(",", ":")).encode()
+        parts = _SLOT_PATTERN.split(body)
+        self.chunks = parts[0::2]
+        self.slots = [name.decode() for name in parts[1::2]]
+        self.signature = signature
+        self.valid_until = valid_until
+        self.current_price = data.get("current_price")
+
+    def render(self, values):
+        out = [self.chunks[0]]
+        for name, chunk in zip(self.slots, self.chunks[1:]):
+            out.append(json.dumps(values.get(name), separators=(",", ":"), default=str).encode())
+            out.append(chunk)
+        return b"".join(out)
+
+
+def fragment_signature(row):
+    """Everything that changes a fragment and is cheap to read per request."""
+    return (row["updated_at"], row["review_count"], row["avg_rating"])
+
+
+class FragmentCache:
+    """(product_id, tier, kind) -> Fragment, LRU-bounded, shared by every request in the worker."""
+
+    def __init__(self, size=FRAGMENT_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, product_id, tier, kind, signature, now):
+        key = (str(product_id), tier, kind)
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is None:
+                return None
+            if fragment.signature != signature or (fragment.valid_until and fragment.valid_until <= now):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return fragment
+
+    def put(self, product_id, tier, kind, fragment):
+        key = (str(product_id), tier, kind)
+        with self._lock:
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, product_id=None):
+        with self._lock:
+            if product_id is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if k[0] == str(product_id)]:
+                del self._entries[key]
+
+
+fragments = FragmentCache()
+
+
+def fetch_full_rows(cursor, product_ids):
+    cursor.execute(f"""
+        SELECT {PRODUCT_COLUMNS}, r.review_count, r.avg_rating
+        FROM products p
+        {REVIEW_STATS_JOIN}
+        WHERE p.id IN %s
+    """, (tuple(product_ids),))
+    return {str(row["id"]): row for row in cursor.fetchall()}
+
+
+def build_fragment(row, user_type, kind, normalize_dates, now):
+    """Renders one product for a tier; `kind` is 'card' (list item) or 'detail' (+ variants)."""
+    product = price_products([row], user_type, normalize_dates, now)[0]
+    dynamic = ("stock", "variants") if kind == "detail" else ("stock",)
+    # normalize_dates ran on the priced copy, so boundaries are datetimes here
+    return Fragment(product, dynamic, fragment_signature(row), next_offer_boundary(product, tier_for(user_type), now))
+
+
+def render_products(cursor, rows, user_type, normalize_dates, kind="card", cache=fragments):
+    """
+    Fragments for light rows (id, stock, updated_at, review stats) in order, fetching
+    and rendering the full rows only for products without a current fragment.
+    """
+    tier = tier_for(user_type)
+    now = datetime.now()
+    found = {}
+    missing = []
+    for row in rows:
+        fragment = cache.get(row["id"], tier, kind, fragment_signature(row), now)
+        if fragment is None:
+            missing.append(row["id"])
+        else:
+            found[str(row["id"])] = fragment
+
+    if missing:
+        for product_id, full in fetch_full_rows(cursor, missing).items():
+            fragment = build_fragment(full, user_type, kind, normalize_dates, now)
+            cache.put(product_id, tier, kind, fragment)
+            found[product_id] = fragment
+
+    return [(row, found[str(row["id"])]) for row in rows if str(row["id"]) in found]
+
+
+def assemble_list(rendered):
+    """The /products body from fragments, with each product's current stock patched in."""
+    items = b",".join(fragment.render({"stock": row["stock"]}) for row, fragment in rendered)
+    return b'{"products":[' + items + b'],"count":' + str(len(rendered)).encode() + b"}"
+
+
+if __name__ == "__main__":
+    # Benchmark: per-request cost of building and serializing 50 products vs
+    # assembling them from cached fragments
+    import time
+    from datetime import timedelta
+    from decimal import Decimal
+
+    def normalize(product):
+        pass
+
+    base = datetime.now()
+    rows = [
+        {
+            "id": i, "name": f"Product {i}", "colors": ["#000000", "#ffffff"], "brand_name": "Brand",
+            "category": "Phones", "description": "A fairly long product description " * 8,
+            "status": "Published", "stock": 10 + i, "image": f"https://cdn.example.com/p/{i}.jpg",
+            "created_at": base, "updated_at": base,
+            "b2c_price": Decimal("1999.00"), "b2b_price": Decimal("1799.00"),
+            "b2c_active_offer": True, "b2b_active_offer": False,
+            "b2c_offer_price": Decimal("1499.00"), "b2b_offer_price": Decimal("0"),
+            "b2c_discount": Decimal("5"), "b2b_discount": Decimal("3"),
+            "b2c_offer_start_date": base - timedelta(days=1), "b2c_offer_end_date": base + timedelta(days=3),
+            "sgst": Decimal("9"), "cgst": Decimal("9"), "b2b_offer_start_date": None, "b2b_offer_end_date": None,
+            "compare_at_price": Decimal("2499"), "info": {"warranty": "1 year", "origin": "IN"},
+            "weight": 0.4, "length": 10, "breadth": 5, "height": 3, "return_policy": "7 days", "hsn": "8517",
+            "review_count": 12, "avg_rating": Decimal("4.25"),
+        }
+        for i in range(50)
+    ]
+    iterations = 500
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        products = price_products(rows, "b2c", normalize)
+        json.dumps(jsonable_encoder({"products": products, "count": len(products)})).encode()
+    rebuild = (time.perf_counter() - started) / iterations
+
+    cache = FragmentCache()
+    tier = tier_for("b2c")
+    for row in rows:
+        cache.put(row["id"], tier, "card", build_fragment(row, "b2c", "card", normalize, base))
+    started = time.perf_counter()
+    for _ in range(iterations):
+        now = datetime.now()
+        rendered = [(row, cache.get(row["id"], tier, "card", fragment_signature(row), now)) for row in rows]
+        assemble_list(rendered)
+    assembled = (time.perf_counter() - started) / iterations
+
+    print(f"rebuild + serialize: {rebuild * 1000:.3f} ms/request")
+    print(f"fragment assembly:   {assembled * 1000:.3f} ms/request ({rebuild / assembled:.1f}x less CPU)")
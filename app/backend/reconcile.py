@@ -0,0 +1,379 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from psycopg2.extras import RealDictCursor, execute_values
+
+from payments import PAID_STATUSES, apply_payment_updates, flag_for_review
+
+RECONCILE_PAGE_SIZE = 100  # Razorpay's maximum `count` per list call
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", 4))
+RECONCILE_SLICE = 6 * 3600  # the window is split into slices that are paged in parallel
+RECONCILE_MAX_RETRIES = 5
+CORRECTION_BATCH = 500
+AMOUNT_TOLERANCE = 1  # paise
+
+# Discrepancies the job fixes with --apply; the others are reported for a human
+CORRECTABLE = {"captured_not_paid"}
+
+
+def _is_rate_limited(error):
+    return getattr(error, "status_code", None) == 429 or "too many requests" in str(error).lower()
+
+
+def _call(fetch, params):
+    """One list call, retried with exponential backoff when Razorpay rate-limits us."""
+    for attempt in range(RECONCILE_MAX_RETRIES):
+        try:
+            return fetch(params)
+        except Exception as e:
+            if not _is_rate_limited(e) or attempt == RECONCILE_MAX_RETRIES - 1:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def _page_slice(fetch, start, end, page_size):
+    """Every item created in [start, end), page by page."""
+    items = []
+    skip = 0
+    while True:
+        page = _call(fetch, {"from": start, "to": end - 1, "count": page_size, "skip": skip})
+        batch = page.get("items", [])
+        items.extend(batch)
+        if len(batch) < page_size:
+            return items
+        skip += page_size
+
+
+def fetch_window(client, start, end, concurrency=RECONCILE_CONCURRENCY, slice_seconds=RECONCILE_SLICE,
+                 page_size=RECONCILE_PAGE_SIZE):
+    """
+    Razorpay payments and orders created in [start, end) (unix seconds). Slices are
+    fetched on a pool of `concurrency` threads, which bounds the requests in flight.
+    """
+    slices = [(s, min(s + slice_seconds, end)) for s in range(start, end, slice_seconds)]
+    jobs = [(client.payment.all, s, e) for s, e in slices] + [(client.order.all, s, e) for s, e in slices]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda job: _page_slice(job[0], job[1], job[2], page_size), jobs))
+
+    half = len(slices)
+    payments = {p["id"]: p for chunk in results[:half] for p in chunk}
+    orders = {o["id"]: o for chunk in results[half:] for o in chunk}
+    return list(payments.values()), list(orders.values())
+
+
+def _hinted_order_id(razorpay_order):
+    """
+    Our order id from notes.order_id, or from the 'receipt_<order_id>' receipt. The client
+    sets both, so the hint only labels orphan payments for a human; it never matches.
+    """
+    notes = razorpay_order.get("notes")
+    if isinstance(notes, dict) and notes.get("order_id"):
+        return notes["order_id"]
+    receipt = razorpay_order.get("receipt") or ""
+    return receipt[len("receipt_"):] if receipt.startswith("receipt_") else None
+
+
+def load_window(cursor, payments, orders):
+    """
+    Copies the Razorpay side into temp tables and resolves razorpay order -> our order
+    through orders.razorpay_order_id, the mapping /payment/create-for-order records.
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE rzp_payments (
+            id TEXT PRIMARY KEY, order_id TEXT, status TEXT, method TEXT, amount BIGINT, currency TEXT,
+            created_at BIGINT
+        ) ON COMMIT DROP;
+        CREATE TEMP TABLE rzp_orders (id TEXT PRIMARY KEY, hinted_order_id TEXT) ON COMMIT DROP;
+        CREATE TEMP TABLE rzp_match (razorpay_order_id TEXT PRIMARY KEY, order_id TEXT NOT NULL) ON COMMIT DROP;
+    """)
+    execute_values(cursor, "INSERT INTO rzp_payments VALUES %s", [
+        (p["id"], p.get("order_id"), p.get("status"), p.get("method"), p.get("amount"), p.get("currency"),
+         p.get("created_at"))
+        for p in payments
+    ], page_size=1000)
+    execute_values(cursor, "INSERT INTO rzp_orders VALUES %s", [
+        (o["id"], _hinted_order_id(o)) for o in orders
+    ], page_size=1000)
+    cursor.execute("ANALYZE rzp_payments; ANALYZE rzp_orders")
+
+    cursor.execute("""
+        INSERT INTO rzp_match (razorpay_order_id, order_id)
+        SELECT DISTINCT ON (o.razorpay_order_id) o.razorpay_order_id, o.order_id
+        FROM orders o
+        WHERE o.razorpay_order_id IN (SELECT order_id FROM rzp_payments UNION SELECT id FROM rzp_orders)
+        ON CONFLICT DO NOTHING
+    """)
+
+
+def find_discrepancies(cursor, start, end):
+    """Classifies every Razorpay order in the window against our orders with two joins."""
+    cursor.execute("""
+        WITH best AS (
+            -- the captured payment if there is one, otherwise the latest attempt
+            SELECT DISTINCT ON (order_id) *
+            FROM rzp_payments
+            WHERE order_id IS NOT NULL
+            ORDER BY order_id, (status = 'captured') DESC, created_at DESC
+        )
+        SELECT
+            b.order_id AS razorpay_order_id, b.id AS payment_id, b.status AS razorpay_status,
+            b.method, b.amount AS razorpay_amount, b.currency,
+            m.order_id, o.amount AS order_amount, o.payment AS order_payment,
+            ro.hinted_order_id
+        FROM best b
+        LEFT JOIN rzp_match m ON m.razorpay_order_id = b.order_id
+        LEFT JOIN rzp_orders ro ON ro.id = b.order_id
+        LEFT JOIN orders o ON o.order_id = m.order_id
+    """)
+
+    discrepancies = []
+    matched = 0
+    for row in cursor.fetchall():
+        captured = row["razorpay_status"] == "captured"
+        base = {
+            "order_id": row["order_id"],
+            "razorpay_order_id": row["razorpay_order_id"],
+            "payment_id": row["payment_id"],
+            "razorpay_status": row["razorpay_status"],
+            "order_payment": row["order_payment"],
+        }
+        if row["order_id"] is None:
+            if captured:
+                # Possibly ours by its notes/receipt, but those are client-supplied
+                discrepancies.append({**base, "kind": "orphan_payment", "razorpay_amount": row["razorpay_amount"],
+                                      "hinted_order_id": row["hinted_order_id"]})
+            continue
+
+        matched += 1
+        paid_here = (row["order_payment"] or "").lower() in PAID_STATUSES
+        if captured and not paid_here:
+            discrepancies.append({**base, "kind": "captured_not_paid", "method": row["method"],
+                                  "razorpay_amount": row["razorpay_amount"], "currency": row["currency"]})
+        elif not captured and row["razorpay_status"] == "failed" and not paid_here \
+                and (row["order_payment"] or "").lower() != "failed":
+            discrepancies.append({**base, "kind": "failed_not_marked"})
+
+        if captured and row["order_amount"] is not None:
+            expected = int(round(float(row["order_amount"]) * 100))
+            if abs(expected - (row["razorpay_amount"] or 0)) > AMOUNT_TOLERANCE:
+                discrepancies.append({**base, "kind": "amount_mismatch",
+                                      "order_amount_paise": expected, "razorpay_amount": row["razorpay_amount"]})
+
+    # Orders we think are paid by Razorpay with no captured payment on their side
+    cursor.execute("""
+        SELECT o.order_id, o.razorpay_order_id, o.payment AS order_payment
+        FROM orders o
+        WHERE o.created_at >= to_timestamp(%s) AND o.created_at < to_timestamp(%s)
+          AND o.razorpay_order_id IS NOT NULL
+          AND lower(COALESCE(o.payment, '')) = ANY(%s)
+          AND NOT EXISTS (
+              SELECT 1 FROM rzp_payments p
+              WHERE p.order_id = o.razorpay_order_id AND p.status = 'captured'
+          )
+    """, (start, end, list(PAID_STATUSES)))
+    for row in cursor.fetchall():
+        discrepancies.append({**row, "kind": "paid_not_captured"})
+
+    return matched, discrepancies
+
+
+def needs_review(discrepancies):
+    """
+    Orders captured but unpaid here whose captured amount also differs from the order:
+    marking them paid isn't safe, so they're left for a human.
+    """
+    mismatched = {d["order_id"] for d in discrepancies if d["kind"] == "amount_mismatch"}
+    return sorted({d["order_id"] for d in discrepancies
+                   if d["kind"] == "captured_not_paid" and d["order_id"] in mismatched})
+
+
+def apply_corrections(conn, cursor, discrepancies, batch_size=CORRECTION_BATCH):
+    """
+    Fixes the correctable discrepancies, committing every `batch_size` orders.
+    Orders from needs_review() are flagged for review instead of marked paid.
+    """
+    corrected = 0
+    held = set(needs_review(discrepancies))
+    flag_for_review(cursor, {order_id: "reconcile: captured amount differs from order" for order_id in held})
+    conn.commit()
+
+    to_pay = [d for d in discrepancies if d["kind"] == "captured_not_paid" and d["order_id"] not in held]
+    for i in range(0, len(to_pay), batch_size):
+        batch = to_pay[i:i + batch_size]
+        # apply_payment_updates re-checks amount and currency and flags what doesn't match
+        newly_paid, _, _ = apply_payment_updates(cursor, {
+            d["order_id"]: (d["payment_id"], d.get("method"), d["razorpay_order_id"],
+                            d["razorpay_amount"], d["currency"])
+            for d in batch
+        }, {})
+        corrected += len(newly_paid)
+        conn.commit()
+    return corrected
+
+
+def reconcile(conn, client, start, end, apply=False, concurrency=RECONCILE_CONCURRENCY):
+    """
+    Reconciles Razorpay against orders for [start, end) (unix seconds) and returns the
+    report. Nothing is written unless `apply`.
+    """
+    started = time.perf_counter()
+    payments, razorpay_orders = fetch_window(client, start, end, concurrency)
+    fetched = time.perf_counter()
+
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        load_window(cursor, payments, razorpay_orders)
+        matched, discrepancies = find_discrepancies(cursor, start, end)
+        # Corrections commit in batches, and commits drop the temp tables; that's fine
+        # because everything needed is already in `discrepancies`
+        corrected = apply_corrections(conn, cursor, discrepancies) if apply else 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    review = needs_review(discrepancies)
+    counts = {}
+    for d in discrepancies:
+        counts[d["kind"]] = counts.get(d["kind"], 0) + 1
+    return {
+        "window": [datetime.fromtimestamp(start).isoformat(), datetime.fromtimestamp(end).isoformat()],
+        "applied": apply,
+        "razorpay_payments": len(payments),
+        "razorpay_orders": len(razorpay_orders),
+        "matched_orders": matched,
+        "discrepancy_counts": counts,
+        "correctable": sum(1 for d in discrepancies
+                           if d["kind"] in CORRECTABLE
+                           and not (d["kind"] == "captured_not_paid" and d["order_id"] in review)),
+        "corrected": corrected,
+        "manual_review": review,
+        "fetch_seconds": round(fetched - started, 2),
+        "total_seconds": round(time.perf_counter() - started, 2),
+        "discrepancies": discrepancies,
+    }
+
+
+# ============================ FAKE RAZORPAY API ============================
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class _FakeCollection:
+    def __init__(self, api, items):
+        self._api = api
+        self._items = sorted(items, key=lambda item: item["created_at"], reverse=True)
+
+    def all(self, params):
+        self._api.tick()
+        matching = [i for i in self._items if params["from"] <= i["created_at"] <= params["to"]]
+        skip, count = params.get("skip", 0), params.get("count", 10)
+        page = matching[skip:skip + count]
+        return {"entity": "collection", "count": len(page), "items": page}
+
+
+class FakeRazorpayClient:
+    """
+    In-memory stand-in for razorpay.Client's payment.all / order.all, with optional
+    latency and a 429 every `rate_limit_every` calls to exercise the backoff.
+    """
+
+    def __init__(self, payments, orders, latency=0.02, rate_limit_every=0):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.calls = 0
+        self.payment = _FakeCollection(self, payments)
+        self.order = _FakeCollection(self, orders)
+
+    def tick(self):
+        self.calls += 1
+        if self.rate_limit_every and self.calls % self.rate_limit_every == 0:
+            raise RateLimited("Too many requests")
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def fake_client_from_orders(cursor, start, end, seed=7, **options):
+    """
+    A fake Razorpay account mirroring our online orders in the window, with some
+    deliberate discrepancies: ~5% captured but unpaid here, ~3% amount mismatch,
+    ~3% failed, and a few orphan payments.
+    """
+    import random
+
+    rng = random.Random(seed)
+    cursor.execute("""
+        SELECT order_id, amount, razorpay_order_id, EXTRACT(EPOCH FROM created_at)::bigint AS created
+        FROM orders
+        WHERE created_at >= to_timestamp(%s) AND created_at < to_timestamp(%s)
+          AND lower(COALESCE(payment_method, '')) NOT IN ('cod', 'cash on delivery', 'cash_on_delivery')
+    """, (start, end))
+    payments, orders = [], []
+    for n, row in enumerate(cursor.fetchall()):
+        razorpay_order_id = row["razorpay_order_id"] or f"order_fake{n:08d}"
+        amount = int(round(float(row["amount"] or 0) * 100))
+        roll = rng.random()
+        status = "failed" if roll < 0.03 else "captured"
+        if 0.03 <= roll < 0.06:
+            amount += 100
+        orders.append({"id": razorpay_order_id, "receipt": f"receipt_{row['order_id']}",
+                       "notes": {}, "created_at": row["created"]})
+        payments.append({"id": f"pay_fake{n:08d}", "order_id": razorpay_order_id, "status": status,
+                         "method": rng.choice(["upi", "card", "netbanking"]), "amount": amount,
+                         "currency": "INR", "created_at": row["created"] + 30})
+    for n in range(3):
+        created = rng.randint(start, end - 1)
+        payments.append({"id": f"pay_orphan{n}", "order_id": f"order_orphan{n}", "status": "captured",
+                         "method": "upi", "amount": 49900, "currency": "INR", "created_at": created})
+    return FakeRazorpayClient(payments, orders, **options)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import sys
+
+    from database import get_db_connection
+
+    parser = argparse.ArgumentParser(description="Reconcile Razorpay payments against orders")
+    parser.add_argument("--from", dest="start", required=True, help="window start, YYYY-MM-DD[THH:MM]")
+    parser.add_argument("--to", dest="end", help="window end (default: now)")
+    parser.add_argument("--apply", action="store_true", help="write corrections (default: report only)")
+    parser.add_argument("--concurrency", type=int, default=RECONCILE_CONCURRENCY)
+    parser.add_argument("--report", help="write the full report as JSON to this file")
+    parser.add_argument("--fake", action="store_true", help="use a fake Razorpay API built from local orders")
+    parser.add_argument("--fake-rate-limit-every", type=int, default=0)
+    args = parser.parse_args()
+
+    window_start = int(datetime.fromisoformat(args.start).timestamp())
+    window_end = int(datetime.fromisoformat(args.end).timestamp()) if args.end else int(time.time())
+
+    connection = get_db_connection()
+    try:
+        if args.fake:
+            setup_cursor = connection.cursor(cursor_factory=RealDictCursor)
+            razorpay = fake_client_from_orders(setup_cursor, window_start, window_end,
+                                               rate_limit_every=args.fake_rate_limit_every)
+            setup_cursor.close()
+            connection.commit()
+        else:
+            import razorpay as razorpay_sdk
+            razorpay = razorpay_sdk.Client(auth=(os.getenv("RAZORPAY_KEY_ID"), os.getenv("RAZORPAY_KEY_SECRET")))
+
+        report = reconcile(connection, razorpay, window_start, window_end,
+                           apply=args.apply, concurrency=args.concurrency)
+    finally:
+        connection.close()
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+    summary = dict(report)
+    summary["discrepancies"] = report["discrepancies"][:20]
+    json.dump(summary, sys.stdout, indent=2, default=str)
+    print()
@@ -0,0 +1,221 @@
+import base64
+import json
+import time
+
+# kind -> (counter column, item status when fully / partly claimed)
+RETURN_KINDS = {
+    "refund": ("refunded_qty", "returned", "partial_returned"),
+    "exchange": ("exchanged_qty", "exchanged", "partial_exchanged"),
+}
+
+
+class QuantityExceeded(Exception):
+    """Raised by claim_quantity; carries what was already claimed and the item quantity."""
+
+    def __init__(self, claimed, ordered, requested):
+        self.claimed = claimed
+        self.ordered = ordered
+        self.requested = requested
+        super().__init__(f"Quantity exceeds limit: {claimed + requested} > {ordered}")
+
+
+def claim_quantity(cursor, order_item_id, kind, quantity):
+    """
+    Adds `quantity` to the item's refund or exchange counter in one conditional UPDATE,
+    and sets the item status to match. The row lock taken by the UPDATE serializes
+    concurrent requests for the same item, and the WHERE re-checks the limit against the
+    committed value, so two requests can never both claim the last units.
+    Returns the new counter value; raises QuantityExceeded when it doesn't fit.
+    """
+    column, full_status, partial_status = RETURN_KINDS[kind]
+    cursor.execute(f"""
+        UPDATE order_items
+        SET {column} = {column} + %s,
+            status = CASE WHEN {column} + %s >= quantity THEN %s ELSE %s END
+        WHERE id = %s AND {column} + %s <= quantity
+        RETURNING {column}
+    """, (quantity, quantity, full_status, partial_status, order_item_id, quantity))
+    row = cursor.fetchone()
+    if row is not None:
+        return row[column] if isinstance(row, dict) else row[0]
+
+    cursor.execute(f"SELECT {column}, quantity FROM order_items WHERE id = %s", (order_item_id,))
+    row = cursor.fetchone()
+    claimed, ordered = (row[column], row["quantity"]) if isinstance(row, dict) else row
+    raise QuantityExceeded(claimed, ordered, quantity)
+
+
+# ============================ TIMELINE ============================
+
+TIMELINE_PAGE_SIZE = 20
+TIMELINE_MAX_PAGE_SIZE = 100
+
+# One typed projection per table; columns the other table lacks are NULL
+_TIMELINE_BRANCHES = {
+    "refund": """
+        SELECT 'refund' AS type, id, order_id, order_item_id, product_name, quantity,
+               reason, description, status, amount, payment_method, NULL::text AS variant_color,
+               COALESCE(images, '[]'::jsonb) AS images, created_at
+        FROM refunds
+        WHERE customer = %(customer)s {filters}
+          AND (%(after_ts)s IS NULL OR (created_at, 'refund', id) < (%(after_ts)s, %(after_type)s, %(after_id)s))
+        ORDER BY created_at DESC, id DESC
+        LIMIT %(fetch)s
+    """,
+    "exchange": """
+        SELECT 'exchange' AS type, id, order_id, order_item_id, product_name, quantity,
+               reason, description, status, price * quantity AS amount, NULL::text AS payment_method,
+               variant_color, COALESCE(images, '[]'::jsonb) AS images, created_at
+        FROM exchanges
+        WHERE customer = %(customer)s {filters}
+          AND (%(after_ts)s IS NULL OR (created_at, 'exchange', id) < (%(after_ts)s, %(after_type)s, %(after_id)s))
+        ORDER BY created_at DESC, id DESC
+        LIMIT %(fetch)s
+    """,
+}
+
+
+def encode_cursor(row):
+    raw = json.dumps([row["created_at"].isoformat(), row["type"], row["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """(created_at, type, id) of the last row of the previous page; ValueError if malformed."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        created_at, kind, row_id = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if kind not in RETURN_KINDS:
+        raise ValueError("Invalid cursor")
+    return created_at, kind, row_id
+
+
+def fetch_timeline(cursor, customer, order_id=None, status=None, kind=None, limit=TIMELINE_PAGE_SIZE, after=None):
+    """
+    Refunds and exchanges of one customer, newest first, as one UNION ALL query.
+    Keyset pagination on (created_at, type, id): each branch reads at most a page from
+    its (customer, created_at, id) index. Returns (items, next_cursor).
+    """
+    limit = max(1, min(limit, TIMELINE_MAX_PAGE_SIZE))
+    filters = ""
+    if order_id:
+        filters += " AND order_id = %(order_id)s"
+    if status:
+        filters += " AND lower(status) = lower(%(status)s)"
+
+    kinds = [kind] if kind else list(_TIMELINE_BRANCHES)
+    after_ts, after_type, after_id = decode_cursor(after) if after else (None, None, None)
+    branches = " UNION ALL ".join(f"({_TIMELINE_BRANCHES[k].format(filters=filters)})" for k in kinds)
+
+    cursor.execute(f"""
+        SELECT *
+        FROM ({branches}) t
+        ORDER BY created_at DESC, type DESC, id DESC
+        LIMIT %(fetch)s
+    """, {
+        "customer": customer,
+        "order_id": order_id,
+        "status": status,
+        "after_ts": after_ts,
+        "after_type": after_type,
+        "after_id": after_id,
+        "fetch": limit + 1,  # one extra row tells us whether there is a next page
+    })
+    rows = cursor.fetchall()
+
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    items = []
+    for row in rows[:limit]:
+        item = dict(row)
+        item["amount"] = float(item["amount"]) if item["amount"] is not None else None
+        item["created_at"] = item["created_at"].strftime('%Y-%m-%d') if item["created_at"] else None
+        items.append(item)
+    return items, next_cursor
+
+
+# ============================ CONCURRENCY HARNESS ============================
+# Many threads claim refund quantity on one order item at once; the total claimed
+# must never exceed the item quantity:
+#   python returns.py --order-item 123 --attempts 5000 --workers 32 [--kind exchange]
+# The item's counter and status are restored afterwards.
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import threading
+    from collections import Counter
+
+    from database import get_db_connection
+
+    parser = argparse.ArgumentParser(description="Refund/exchange quantity contention test")
+    parser.add_argument("--order-item", type=int, required=True)
+    parser.add_argument("--kind", choices=sorted(RETURN_KINDS), default="refund")
+    parser.add_argument("--attempts", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--max-qty", type=int, default=2)
+    args = parser.parse_args()
+
+    column = RETURN_KINDS[args.kind][0]
+    setup = get_db_connection()
+    cur = setup.cursor()
+    cur.execute(f"SELECT quantity, {column}, status FROM order_items WHERE id = %s", (args.order_item,))
+    row = cur.fetchone()
+    if not row:
+        raise SystemExit(f"Unknown order item {args.order_item}")
+    ordered, original_claimed, original_status = row
+    cur.execute(f"UPDATE order_items SET {column} = 0 WHERE id = %s", (args.order_item,))
+    setup.commit()
+
+    claimed = Counter()
+    lock = threading.Lock()
+    remaining = iter(range(args.attempts))
+
+    def worker():
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                qty = random.randint(1, args.max_qty)
+                try:
+                    claim_quantity(cursor, args.order_item, args.kind, qty)
+                    conn.commit()
+                    with lock:
+                        claimed["units"] += qty
+                        claimed["ok"] += 1
+                except QuantityExceeded:
+                    conn.rollback()
+                    with lock:
+                        claimed["rejected"] += 1
+                except Exception as e:
+                    conn.rollback()
+                    with lock:
+                        claimed[type(e).__name__] += 1
+        finally:
+            conn.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    cur.execute(f"SELECT {column} FROM order_items WHERE id = %s", (args.order_item,))
+    final = cur.fetchone()[0]
+    ok = final == claimed["units"] and final <= ordered
+    print(f"item quantity {ordered}, claimed {claimed['units']} (counter {final}) -> {'OK' if ok else 'OVER-RETURN'}")
+    print(f"{args.attempts} attempts in {elapsed:.2f}s ({args.attempts / elapsed:.0f}/sec), results: {dict(claimed)}")
+
+    cur.execute(
+        f"UPDATE order_items SET {column} = %s, status = %s WHERE id = %s",
+        (original_claimed, original_status, args.order_item)
+    )
+    setup.commit()
+    setup.close()
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,253 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+ROUTE_CACHE_URL = os.getenv("ROUTE_CACHE_URL")  # redis://... for the shared backend, unset for in-process
+ROUTE_CACHE_MAX_ENTRIES = int(os.getenv("ROUTE_CACHE_MAX_ENTRIES", 2000))
+ROUTE_CACHE_PREFIX = "rc:"
+PRODUCT_CHANGED_CHANNEL = "product_changed"
+
+
+# ============================ BACKENDS ============================
+
+class MemoryBackend:
+    """Per-process LRU with per-entry expiry and a tag -> keys index."""
+
+    def __init__(self, max_entries=ROUTE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, body, tags)
+        self._tags = {}  # tag -> set of keys
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key, body, ttl, tags):
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + ttl, body, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    async def invalidate_tags(self, tags):
+        keys = set()
+        for tag in tags:
+            keys |= self._tags.pop(tag, set())
+        for key in keys:
+            self._drop(key)
+        return len(keys)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisBackend:
+    """
+    Shared across workers and instances; any Redis-protocol server works (Redis, Valkey,
+    KeyDB, Dragonfly). Needs the redis package, imported only when this backend is selected.
+    Tags are Redis sets of cache keys, expired a little after the longest entry in them.
+    """
+
+    def __init__(self, url=ROUTE_CACHE_URL):
+        import redis.asyncio
+
+        self.client = redis.asyncio.from_url(url)
+
+    async def get(self, key):
+        return await self.client.get(ROUTE_CACHE_PREFIX + key)
+
+    async def set(self, key, body, ttl, tags):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(ROUTE_CACHE_PREFIX + key, body, ex=max(int(ttl), 1))
+        for tag in tags:
+            tag_key = f"{ROUTE_CACHE_PREFIX}tag:{tag}"
+            pipe.sadd(tag_key, key)
+            pipe.expire(tag_key, max(int(ttl), 1) * 2)
+        await pipe.execute()
+
+    async def invalidate_tags(self, tags):
+        tag_keys = [f"{ROUTE_CACHE_PREFIX}tag:{tag}" for tag in tags]
+        keys = set()
+        for tag_key in tag_keys:
+            keys |= {k.decode() if isinstance(k, bytes) else k for k in await self.client.smembers(tag_key)}
+        if keys or tag_keys:
+            await self.client.delete(*[ROUTE_CACHE_PREFIX + k for k in keys], *tag_keys)
+        return len(keys)
+
+
+def get_route_cache_backend():
+    return RedisBackend(ROUTE_CACHE_URL) if ROUTE_CACHE_URL else MemoryBackend()
+
+
+# ============================ METRICS ============================
+
+class RouteMetrics:
+    __slots__ = ("hits", "misses", "coalesced", "errors", "hit_seconds", "miss_seconds")
+
+    def __init__(self):
+        self.hits = self.misses = self.coalesced = self.errors = 0
+        self.hit_seconds = self.miss_seconds = 0.0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else None,
+            "avg_hit_ms": round(self.hit_seconds / self.hits * 1000, 3) if self.hits else None,
+            "avg_miss_ms": round(self.miss_seconds / self.misses * 1000, 3) if self.misses else None,
+        }
+
+
+# ============================ DECORATOR ============================
+
+class RouteCache:
+    """
+    Response cache for read endpoints:
+
+        @app.get("/products")
+        @route_cache.cached(ttl=60, tags=lambda params: ["products", f"category:{params.get('category')}"])
+        async def get_products(...): ...
+
+    The key is the route path + sorted query string + the caller's tier (from `tier`,
+    a callable taking the Request). The endpoint's return value is stored as JSON bytes,
+    as is the body of a plain 200 JSON Response; other responses pass through uncached. Concurrent misses on one key
+    in this process share a single endpoint call.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or get_route_cache_backend()
+        self._inflight = {}  # key -> Future
+        self._metrics = {}  # route -> RouteMetrics
+
+    def metrics(self):
+        return {route: m.as_dict() for route, m in sorted(self._metrics.items())}
+
+    async def invalidate(self, *tags):
+        try:
+            return await self.backend.invalidate_tags(tags)
+        except Exception as e:
+            print(f"Route cache invalidation failed for {tags}: {e}")
+            return 0
+
+    def cached(self, ttl, tags=None, tier=None):
+        """
+        ttl: seconds. tags: callable(params) -> list of tags, where params are the
+        endpoint's keyword arguments. tier: callable(request) -> tier string (may be async).
+        """
+
+        def decorator(endpoint):
+            signature = inspect.signature(endpoint)
+            wants_request = any(p.annotation is Request for p in signature.parameters.values())
+            if not wants_request:
+                # FastAPI builds the dependency list from the signature; add the Request we need
+                signature = signature.replace(parameters=[
+                    *signature.parameters.values(),
+                    inspect.Parameter("_cache_request", inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+                ])
+
+            @functools.wraps(endpoint)
+            async def wrapper(*args, **kwargs):
+                request = kwargs.pop("_cache_request", None) or next(
+                    v for v in kwargs.values() if isinstance(v, Request)
+                )
+                route = request.scope.get("route")
+                route_path = getattr(route, "path", request.url.path)
+                metrics = self._metrics.setdefault(route_path, RouteMetrics())
+
+                caller_tier = tier(request) if tier else ""
+                if inspect.isawaitable(caller_tier):
+                    caller_tier = await caller_tier
+                query = "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+                raw_key = f"{request.url.path}?{query}|{caller_tier or ''}"
+                key = hashlib.sha1(raw_key.encode()).hexdigest()
+
+                started = time.perf_counter()
+                try:
+                    body = await self.backend.get(key)
+                except Exception as e:
+                    metrics.errors += 1
+                    print(f"Route cache read failed for {route_path}: {e}")
+                    body = None
+                if body is not None:
+                    metrics.hits += 1
+                    metrics.hit_seconds += time.perf_counter() - started
+                    return _json_response(body, "HIT")
+
+                while key in self._inflight:
+                    pending = self._inflight[key]
+                    try:
+                        result = await asyncio.shield(pending)
+                    except asyncio.CancelledError:
+                        if pending.cancelled():
+                            continue  # the leading request went away; take over
+                        raise
+                    metrics.coalesced += 1
+                    return _json_response(result, "HIT") if isinstance(result, bytes) else result
+
+                future = asyncio.get_running_loop().create_future()
+                self._inflight[key] = future
+                try:
+                    result = await endpoint(*args, **kwargs)
+                    if isinstance(result, Response) and result.status_code == 200 \
+                            and result.media_type == "application/json":
+                        result = bytes(result.body)  # already-serialized JSON (e.g. assembled fragments)
+                    elif not isinstance(result, Response):
+                        result = json.dumps(jsonable_encoder(result), separators=(",", ":")).encode()
+                    if isinstance(result, bytes):
+                        try:
+                            await self.backend.set(key, result, ttl, list(tags(kwargs)) if tags else [])
+                        except Exception as e:
+                            metrics.errors += 1
+                            print(f"Route cache write failed for {route_path}: {e}")
+                    future.set_result(result)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    future.set_exception(e)
+                    future.exception()  # retrieved here; waiters re-raise it themselves
+                    raise
+                finally:
+                    self._inflight.pop(key, None)
+                    metrics.misses += 1
+                    metrics.miss_seconds += time.perf_counter() - started
+
+                return _json_response(result, "MISS") if isinstance(result, bytes) else result
+
+            wrapper.__signature__ = signature
+            return wrapper
+
+        return decorator
+
+
+def _json_response(body, status):
+    return Response(content=body, media_type="application/json", headers={"X-Cache": status})
+
+
+route_cache = RouteCache()
@@ -0,0 +1,35 @@
+FLAT_PRICE_UPTO_10KG = 120   # ₹
+EXTRA_PRICE_PER_KG = 15      # ₹ per kg
+MIN_CHARGEABLE_WEIGHT = 0.5  # kg
+
+
+def calculate_mock_shipping(weight):
+    """
+    <= 10 kg  -> flat price
+    > 10 kg   -> flat + per kg extra
+    """
+    if weight <= 10:
+        return FLAT_PRICE_UPTO_10KG
+    extra_weight = weight - 10
+    return round(FLAT_PRICE_UPTO_10KG + (extra_weight * EXTRA_PRICE_PER_KG), 2)
+
+
+def chargeable_weight(items):
+    """
+    Max of dead weight and volumetric weight (L*B*H / 5000) over all items, in kg.
+    Each item is a dict with quantity, weight (kg) and length/breadth/height (cm).
+    """
+    total_weight = 0.0
+    total_vol_weight = 0.0
+
+    for item in items:
+        qty = int(item.get("quantity", 1))
+        total_weight += float(item.get("weight") or 0) * qty
+        total_vol_weight += (
+            float(item.get("length") or 0) *
+            float(item.get("breadth") or 0) *
+            float(item.get("height") or 0)
+        ) / 5000 * qty
+
+    weight = round(max(total_weight, total_vol_weight), 2)
+    return max(weight, MIN_CHARGEABLE_WEIGHT)
@@ -0,0 +1,204 @@
+import mimetypes
+import os
+import re
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+BLOB_ROOT = os.getenv("BLOB_ROOT", os.path.join("uploads", "blobs"))
+S3_BUCKET = os.getenv("S3_BUCKET", "uploads")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. a local MinIO at http://localhost:9000
+
+READ_CHUNK_SIZE = 256 * 1024
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# 'ab/cd/<sha256>.<ext>': two levels of 256-way sharding keeps every directory small
+KEY_PATTERN = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.[a-z0-9]{1,5}$")
+
+
+def blob_key(digest, extension):
+    """Storage key for a SHA-256 hex digest and an extension like '.jpg'."""
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+
+def digest_of(key):
+    """The SHA-256 part of a valid key, or None for anything else."""
+    match = KEY_PATTERN.match(key or "")
+    return match.group(1) if match else None
+
+
+def content_type_of(key):
+    return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+
+class LocalStorage:
+    """Blobs as files under BLOB_ROOT. Writes are a rename, so they are atomic and idempotent."""
+
+    def __init__(self, root=BLOB_ROOT):
+        self.root = root
+
+    def local_path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def size(self, key):
+        try:
+            return os.path.getsize(self.local_path(key))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, temp_path, content_type=None):
+        """
+        Moves temp_path into place. If the blob already exists the upload was a duplicate:
+        the temp file is dropped and False is returned.
+        """
+        path = self.local_path(key)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            os.utime(path)  # freshly referenced again: restart the GC grace period
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return True
+
+    def read_range(self, key, start, end):
+        """Yields bytes start..end (inclusive) of a blob."""
+        with open(self.local_path(key), "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def iter_keys(self):
+        """Yields (key, modified_timestamp, size) for every blob, one directory at a time."""
+        if not os.path.isdir(self.root):
+            return
+        for first in sorted(os.listdir(self.root)):
+            first_dir = os.path.join(self.root, first)
+            if not os.path.isdir(first_dir):
+                continue
+            for second in sorted(os.listdir(first_dir)):
+                second_dir = os.path.join(first_dir, second)
+                if not os.path.isdir(second_dir):
+                    continue
+                with os.scandir(second_dir) as entries:
+                    for entry in entries:
+                        key = f"{first}/{second}/{entry.name}"
+                        if entry.is_file() and digest_of(key):
+                            stat = entry.stat()
+                            yield key, stat.st_mtime, stat.st_size
+
+
+class S3Storage:
+    """
+    Same interface over an S3-compatible bucket (AWS, or MinIO/LocalStack locally via
+    S3_ENDPOINT_URL). Needs boto3, imported only when this backend is selected.
+    """
+
+    def __init__(self, bucket=S3_BUCKET, endpoint_url=S3_ENDPOINT_URL):
+        import boto3
+
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def local_path(self, key):
+        return None
+
+    def _head(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        head = self._head(key)
+        return head["ContentLength"] if head else None
+
+    def put(self, key, temp_path, content_type=None):
+        try:
+            if self.exists(key):
+                # Copy onto itself to bump LastModified, restarting the GC grace period
+                self.client.copy_object(
+                    Bucket=self.bucket, Key=key, CopySource={"Bucket": self.bucket, "Key": key},
+                    MetadataDirective="REPLACE",
+                    ContentType=content_type or content_type_of(key),
+                    CacheControl=IMMUTABLE_CACHE_CONTROL,
+                )
+                return False
+            self.client.upload_file(temp_path, self.bucket, key, ExtraArgs={
+                "ContentType": content_type or content_type_of(key),
+                "CacheControl": IMMUTABLE_CACHE_CONTROL,
+            })
+            return True
+        finally:
+            os.remove(temp_path)
+
+    def read_range(self, key, start, end):
+        body = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end}")["Body"]
+        try:
+            yield from body.iter_chunks(READ_CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def iter_keys(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket):
+            for obj in page.get("Contents", []):
+                if digest_of(obj["Key"]):
+                    yield obj["Key"], obj["LastModified"].timestamp(), obj["Size"]
+
+
+_storage = None
+
+
+def get_storage():
+    """The configured backend (STORAGE_BACKEND=local|s3), created on first use."""
+    global _storage
+    if _storage is None:
+        _storage = S3Storage() if STORAGE_BACKEND == "s3" else LocalStorage()
+    return _storage
+
+
+def parse_range(header, size):
+    """
+    (start, end) for a single 'bytes=' range, None to serve the whole file
+    (no header, or multiple ranges), or ValueError when it can't be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                raise ValueError(header)
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        raise ValueError(header)
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
@@ -0,0 +1,160 @@
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+# Warehouse state; DELHIVERY_PICKUP_PIN 600018 is in Chennai
+PICKUP_STATE = os.getenv("PICKUP_STATE", "Tamil Nadu")
+TAX_RATES_REFRESH = int(os.getenv("TAX_RATES_REFRESH", 60))  # seconds between change probes
+
+# hsn: product HSN/SAC code; taxable_value: amount GST is charged on;
+# fallback_sgst/fallback_cgst: the product's own percentages, used when the HSN isn't in the rate table;
+# rate: a fixed total GST % (the rate an order line was charged) that overrides both
+TaxLine = namedtuple("TaxLine", "hsn taxable_value fallback_sgst fallback_cgst rate", defaults=(0.0, 0.0, None))
+
+
+def normalize_state(state):
+    """'Tamil Nadu', 'tamil  nadu', 'TAMILNADU' -> 'tamilnadu'."""
+    return re.sub(r"[^a-z]", "", (state or "").lower())
+
+
+def is_interstate(customer_state, pickup_state=None):
+    """
+    Inter-state supply pays IGST, intra-state pays CGST+SGST. An unknown customer state
+    is treated as intra-state, which is what orders were charged before this engine.
+    """
+    customer = normalize_state(customer_state)
+    origin = normalize_state(pickup_state or PICKUP_STATE)
+    return bool(customer and origin and customer != origin)
+
+
+class TaxEngine:
+    """
+    In-memory HSN -> total GST rate index over hsn_tax_rates.
+    Codes are matched on the longest known prefix (8, 6, 4 then 2 digits) so a chapter-level
+    rate covers every code under it. The table is re-read when its row count or newest
+    updated_at changes, probed at most every TAX_RATES_REFRESH seconds.
+    """
+
+    def __init__(self, refresh_seconds=TAX_RATES_REFRESH):
+        self.refresh_seconds = refresh_seconds
+        self.version = None
+        self._index = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, cursor, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.refresh_seconds:
+            return
+
+        with self._lock:
+            if not force and now - self._checked_at < self.refresh_seconds:
+                return  # another thread refreshed while we waited
+            # Savepoint so a failed probe doesn't abort the caller's transaction
+            cursor.execute("SAVEPOINT tax_refresh")
+            try:
+                cursor.execute("SELECT COUNT(*), MAX(updated_at) FROM hsn_tax_rates")
+                row = cursor.fetchone()
+                version = tuple(row.values()) if isinstance(row, dict) else tuple(row)
+                if force or version != self.version:
+                    cursor.execute("SELECT hsn, gst_rate FROM hsn_tax_rates")
+                    index = {}
+                    for rate_row in cursor.fetchall():
+                        if isinstance(rate_row, dict):
+                            hsn, rate = rate_row["hsn"], rate_row["gst_rate"]
+                        else:
+                            hsn, rate = rate_row
+                        index[self._clean(hsn)] = float(rate)
+                    self._index = index
+                    self.version = version
+                cursor.execute("RELEASE SAVEPOINT tax_refresh")
+            except Exception as e:
+                # Keep serving the last good table; products' own rates cover a cold start
+                print(f"Tax rate refresh failed: {e}")
+                cursor.execute("ROLLBACK TO SAVEPOINT tax_refresh")
+            self._checked_at = now
+
+    @staticmethod
+    def _clean(hsn):
+        return re.sub(r"\D", "", str(hsn or ""))
+
+    def rate_for(self, hsn):
+        """Total GST % for an HSN code, or None when no prefix of it is in the table."""
+        code = self._clean(hsn)
+        index = self._index
+        for length in (8, 6, 4, 2):
+            if len(code) >= length and code[:length] in index:
+                return index[code[:length]]
+        return None
+
+    def compute(self, lines, customer_state, pickup_state=None):
+        """
+        One pass over the cart's lines. Returns per-line splits, an HSN summary and totals;
+        amounts are unrounded per line and rounded to paise in the summary/totals.
+        """
+        interstate = is_interstate(customer_state, pickup_state)
+        index_lookup = self.rate_for
+
+        per_line = []
+        by_hsn = {}
+        total_taxable = total_cgst = total_sgst = total_igst = 0.0
+        for line in lines:
+            taxable = float(line.taxable_value or 0)
+            rate = float(line.rate) if line.rate is not None else index_lookup(line.hsn)
+            if rate is None:
+                rate = float(line.fallback_sgst or 0) + float(line.fallback_cgst or 0)
+
+            amount = taxable * rate / 100
+            if interstate:
+                cgst = sgst = 0.0
+                igst = amount
+            else:
+                cgst = sgst = amount / 2
+                igst = 0.0
+
+            per_line.append({"hsn": line.hsn or "", "rate": rate, "taxable_value": taxable,
+                             "cgst": cgst, "sgst": sgst, "igst": igst})
+
+            bucket = by_hsn.get(line.hsn or "")
+            if bucket is None:
+                bucket = by_hsn[line.hsn or ""] = [rate, 0.0, 0.0, 0.0, 0.0]
+            bucket[1] += taxable
+            bucket[2] += cgst
+            bucket[3] += sgst
+            bucket[4] += igst
+
+            total_taxable += taxable
+            total_cgst += cgst
+            total_sgst += sgst
+            total_igst += igst
+
+        total_tax = round(total_cgst + total_sgst + total_igst, 2)
+        return {
+            "interstate": interstate,
+            "lines": per_line,
+            "summary": [
+                {"hsn": hsn, "rate": b[0], "taxable_value": round(b[1], 2),
+                 "cgst": round(b[2], 2), "sgst": round(b[3], 2), "igst": round(b[4], 2)}
+                for hsn, b in by_hsn.items()
+            ],
+            "taxable_value": round(total_taxable, 2),
+            "cgst_amount": round(total_cgst, 2),
+            "sgst_amount": round(total_sgst, 2),
+            "igst_amount": round(total_igst, 2),
+            "total_tax": total_tax,
+            # Effective percentages for the order-level columns
+            "cgst_percentage": round(total_cgst / total_taxable * 100, 2) if total_taxable else 0.0,
+            "sgst_percentage": round(total_sgst / total_taxable * 100, 2) if total_taxable else 0.0,
+            "igst_percentage": round(total_igst / total_taxable * 100, 2) if total_taxable else 0.0,
+        }
+
+
+tax_engine = TaxEngine()
+
+
+def compute_tax(cursor, lines, customer_state, pickup_state=None):
+    """Refreshes the rate index if due, then computes GST for the lines."""
+    tax_engine.refresh(cursor)
+    return tax_engine.compute(lines, customer_state, pickup_state)
@@ -0,0 +1,121 @@
+import re
+
+from account_deletion import DELETION_STEPS, run_job
+
+
+class FakeDatabase:
+    """
+    Just enough of Postgres for the deletion steps: each step's DELETE is read for its
+    table, owner column and LIMIT, and the orders step's CTE for the columns it joins on.
+    Comparing an integer column with a text one raises, as Postgres does.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.job = {"step": None, "progress": {}, "status": "running"}
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = 0
+
+    def close(self):
+        pass
+
+    def execute(self, sql, params=None):
+        if "account_deletions" in sql:
+            self._update_job(sql, params)
+        elif "WITH batch AS" in sql:
+            self._delete_orders(sql, params)
+        else:
+            self._delete_owned(sql, params)
+
+    def _update_job(self, sql, params):
+        if "status = 'done'" in sql:
+            self.db.job.update(status="done", step=None)
+        elif "progress" in sql:
+            name, _, _, deleted, _ = params
+            self.db.job["step"] = name
+            self.db.job["progress"][name] = self.db.job["progress"].get(name, 0) + deleted
+        else:
+            self.db.job["status"] = params[0]
+
+    def _owned(self, table, column, user_id, limit=None):
+        rows = [r for r in self.db.tables[table] if str(r[column]) == str(user_id)]
+        return rows[:limit] if limit else rows
+
+    def _delete_owned(self, sql, params):
+        table = re.search(r"DELETE FROM (\w+)", sql).group(1)
+        column = re.search(r"(\w+) = %\(user_id\)s", sql).group(1)
+        limited = "LIMIT" in sql
+        doomed = self._owned(table, column, params["user_id"], params["batch"] if limited else None)
+        self.db.tables[table] = [r for r in self.db.tables[table] if r not in doomed]
+        self.rowcount = len(doomed)
+
+    def _delete_orders(self, sql, params):
+        selected = re.search(r"SELECT ([\w, ]+) FROM orders", sql).group(1).split(", ")
+        item_key = re.search(r"DELETE FROM order_items WHERE (\w+) IN \(SELECT (\w+) FROM batch\)", sql).groups()
+        order_key = re.search(r"DELETE FROM orders WHERE (\w+) IN \(SELECT (\w+) FROM batch\)", sql).groups()
+        batch = [{c: r[c] for c in selected} for r in self._owned("orders", "customer", params["user_id"], params["batch"])]
+
+        for (column, batch_column), table in ((item_key, "order_items"), (order_key, "orders")):
+            keys = [row[batch_column] for row in batch]
+            for row in self.db.tables[table]:
+                if keys and type(row[column]) is not type(keys[0]):
+                    raise TypeError(f"operator does not exist: {type(row[column]).__name__} = {type(keys[0]).__name__}")
+            doomed = [r for r in self.db.tables[table] if r[column] in keys]
+            self.db.tables[table] = [r for r in self.db.tables[table] if r not in doomed]
+        self.rowcount = len(batch)
+
+
+def make_tables(user_id, orders=5, items_per_order=3):
+    return {
+        "product_reviews": [{"id": 1, "user_id": user_id}, {"id": 2, "user_id": "someone-else"}],
+        "orders": [{"id": n, "order_id": f"ORD{n}", "customer": user_id} for n in range(1, orders + 1)]
+                  + [{"id": 100, "order_id": "ORD100", "customer": "someone-else"}],
+        "order_items": [{"id": n * 10 + i, "order_id": f"ORD{n}"} for n in range(1, orders + 1)
+                        for i in range(items_per_order)] + [{"id": 1000, "order_id": "ORD100"}],
+        "carts": [{"id": 1, "user_id": user_id}],
+        "user_addresses": [{"id": 1, "user_id": user_id}],
+        "addresses": [{"id": 1, "user_id": user_id}],
+        "b2b_applications": [{"id": 1, "user_id": user_id}],
+        "b2c_applications": [],
+        "auth_users": [{"id": user_id}, {"id": "someone-else"}],
+    }
+
+
+def test_run_job_deletes_orders_with_their_items_in_batches():
+    db = FakeDatabase(make_tables("u1", orders=5))
+    run_job(db, {"id": "job", "user_id": "u1", "step": None, "attempts": 1}, batch_size=2)
+
+    assert db.job["status"] == "done"
+    assert db.job["progress"]["orders"] == 5
+    assert [o["order_id"] for o in db.tables["orders"]] == ["ORD100"]
+    assert [i["order_id"] for i in db.tables["order_items"]] == ["ORD100"]
+    assert db.tables["auth_users"] == [{"id": "someone-else"}]
+    assert len(db.tables["product_reviews"]) == 1
+
+
+def test_run_job_resumes_from_recorded_step():
+    db = FakeDatabase(make_tables("u1", orders=1))
+    run_job(db, {"id": "job", "user_id": "u1", "step": "addresses", "attempts": 2}, batch_size=2)
+
+    assert db.job["status"] == "done"
+    assert "orders" not in db.job["progress"]
+    assert len(db.tables["orders"]) == 2  # earlier steps are not re-run from a later step
+    assert db.tables["addresses"] == []
+
+
+def test_every_step_is_a_batched_or_single_row_delete():
+    for name, sql in DELETION_STEPS:
+        assert "DELETE FROM" in sql, name
@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+import pytest
+
+from batch import BATCH_MAX_REQUESTS, BatchError, run_batch
+from models import BatchItem
+
+OUTER_SCOPE = {"type": "http", "scheme": "https", "client": ("10.0.0.1", 5000)}
+
+
+async def fake_app(scope, receive, send):
+    """Echoes the request as JSON; /slow never answers, /boom raises, /text isn't JSON."""
+    await receive()
+    if scope["path"] == "/slow":
+        await asyncio.sleep(60)
+    if scope["path"] == "/boom":
+        raise RuntimeError("handler crashed")
+    headers = dict(scope["headers"])
+    if scope["path"] == "/text":
+        body, content_type = b"plain", b"text/plain"
+    else:
+        body = json.dumps({
+            "path": scope["path"], "query": scope["query_string"].decode(),
+            "authorization": headers.get(b"authorization", b"").decode(),
+        }).encode()
+        content_type = b"application/json"
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", content_type)]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def batch(items, timeout=1):
+    body = asyncio.run(run_batch(fake_app, OUTER_SCOPE, items, b"Bearer abc", timeout))
+    return json.loads(body)["responses"]
+
+
+def test_responses_come_back_in_request_order_with_ids():
+    responses = batch([
+        BatchItem(id="cart", path="/cart?x=1"),
+        BatchItem(path="/coupons/available"),
+        BatchItem(path="/text"),
+    ])
+
+    assert [r["id"] for r in responses] == ["cart", "1", "2"]
+    assert responses[0] == {"id": "cart", "status": 200,
+                            "body": {"path": "/cart", "query": "x=1", "authorization": "Bearer abc"}}
+    assert responses[2]["body"] == "plain"
+
+
+def test_rejects_writes_and_invalid_paths_without_calling_the_app():
+    responses = batch([
+        BatchItem(method="post", path="/orders"),
+        BatchItem(path="cart"),
+        BatchItem(path="/batch/"),
+        BatchItem(path="/batch?nested=1"),
+    ])
+    assert [r["status"] for r in responses] == [405, 400, 400, 400]
+    assert responses[0]["body"] == {"detail": "Only GET requests can be batched"}
+
+
+def test_slow_and_failing_sub_requests_do_not_hold_up_the_rest():
+    responses = batch([BatchItem(path="/slow"), BatchItem(path="/boom"), BatchItem(path="/fast")], timeout=0.1)
+    assert [r["status"] for r in responses] == [504, 500, 200]
+    assert responses[0]["body"] == {"detail": "Timed out"}
+
+
+@pytest.mark.parametrize("count, status", [(0, 400), (BATCH_MAX_REQUESTS + 1, 413)])
+def test_batch_size_limits(count, status):
+    with pytest.raises(BatchError) as error:
+        batch([BatchItem(path="/cart")] * count)
+    assert error.value.status_code == status
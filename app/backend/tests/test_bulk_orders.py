@@ -0,0 +1,31 @@
+import io
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from bulk_orders import iter_order_lines
+
+
+def parse(text):
+    return list(iter_order_lines(io.BytesIO(text.encode()), "order.csv"))
+
+
+def test_non_numeric_product_id_is_a_line_error():
+    lines = parse("product_id,qty\n12,2\nabc,1\n7.0,3\n")
+    assert lines == [
+        (2, "12", 2, None),
+        (3, "abc", 0, "Invalid product id 'abc'"),
+        (4, "7", 3, None),
+    ]
+
+
+def test_quantity_must_be_a_whole_number():
+    lines = parse("product_id,qty\n1,2.0\n2,1.5\n3,inf\n4,0\n5,-1\n")
+    assert [(line, qty, error) for line, _, qty, error in lines] == [
+        (2, 2, None),
+        (3, 0, "Invalid quantity '1.5'"),
+        (4, 0, "Invalid quantity 'inf'"),
+        (5, 0, "Quantity must be at least 1"),
+        (6, 0, "Invalid quantity '-1'"),
+    ]
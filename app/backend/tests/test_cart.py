@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from cart import _fingerprint
+
+
+def cart_state(**changes):
+    state = {
+        "version": 3, "user_type": "b2c", "products_updated_at": "2026-01-01", "line_stock": "5/,2/2",
+        "coupon_used_count": 10, "coupon_status": "Active", "coupon_version": "abc",
+        "customer_state": "Tamil Nadu",
+    }
+    state.update(changes)
+    return state
+
+
+@pytest.mark.parametrize("change", [
+    {"line_stock": "4/,2/2"},
+    {"coupon_used_count": 11},
+    {"coupon_status": "Inactive"},
+    {"coupon_version": "def"},
+])
+def test_stock_and_coupon_changes_invalidate_cached_price(change):
+    assert _fingerprint(cart_state(**change)) != _fingerprint(cart_state())
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+from catalog_snapshot import CatalogSnapshot, CatalogStore, write_snapshot
+
+
+def product(product_id, created, **extra):
+    row = {"id": product_id, "name": f"Product {product_id}", "status": "Published", "stock": 5,
+           "created_at": datetime(2026, 1, created), "b2c_price": 100.0, "b2b_active_offer": False}
+    row.update(extra)
+    return row
+
+
+def snapshot_of(tmp_path, rows, generation=1):
+    path = str(tmp_path / "catalog.snap")
+    write_snapshot(path, rows, generation)
+    return CatalogSnapshot(path)
+
+
+def test_round_trip_values_nulls_and_json(tmp_path):
+    snapshot = snapshot_of(tmp_path, [
+        product("10", 1, colors=["#fff", "#000"], info={"material": "steel"}, avg_rating=4.5, review_count=2),
+        product("2", 2, stock=None, b2c_price=None, name=None, b2b_active_offer=None),
+    ])
+
+    first = snapshot.get("10")
+    assert first["colors"] == ["#fff", "#000"]
+    assert first["info"] == {"material": "steel"}
+    assert first["stock"] == 5 and first["b2c_price"] == 100.0 and first["avg_rating"] == 4.5
+    assert first["b2b_active_offer"] is False
+    assert first["created_at"] == datetime(2026, 1, 1)
+
+    second = snapshot.get("2")
+    assert second["stock"] is None and second["b2c_price"] is None and second["name"] is None
+    assert second["b2b_active_offer"] is None and second["colors"] is None and second["updated_at"] is None
+
+
+def test_find_uses_sorted_string_ids(tmp_path):
+    snapshot = snapshot_of(tmp_path, [product(pid, 1) for pid in ("30", "4", "100")])
+    assert len(snapshot) == 3
+    assert [snapshot.value("id", snapshot.find(pid)) for pid in ("100", "30", "4")] == ["100", "30", "4"]
+    assert snapshot.find("5") is None
+    assert snapshot.get(4)["id"] == "4"
+
+
+def test_recent_is_newest_first_and_filters_status(tmp_path):
+    snapshot = snapshot_of(tmp_path, [
+        product("1", 1), product("2", 3, status="Draft"), product("3", 2), product("4", 4),
+    ])
+    assert [p["id"] for p in snapshot.recent(10)] == ["4", "3", "1"]
+    assert [p["id"] for p in snapshot.recent(2, status=None)] == ["4", "2"]
+
+
+def test_store_maps_new_generation(tmp_path, monkeypatch):
+    path = str(tmp_path / "catalog.snap")
+    monkeypatch.setattr("catalog_snapshot.SNAPSHOT_CHECK_INTERVAL", 0)
+    store = CatalogStore(path)
+    assert store.current() is None
+
+    write_snapshot(path, [product("1", 1)], 1)
+    assert store.current().generation == 1
+    write_snapshot(path, [product("1", 1), product("2", 2)], 2)
+    assert store.current().generation == 2 and len(store.current()) == 2
@@ -0,0 +1,105 @@
+from datetime import date
+
+import pytest
+
+from coupons import CouponError, evaluate_coupon, rank_coupons, redeem_coupon
+
+TODAY = date(2026, 5, 1)
+
+
+def coupon(**changes):
+    row = {"code": "SAVE10", "status": "Active", "expiry": date(2026, 6, 1), "min_order_value": 500,
+           "discount_type": "percentage", "discount_value": 10, "used_count": 0, "usage_limit": 100,
+           "customer_type": None, "per_user_limit": None}
+    row.update(changes)
+    return row
+
+
+def test_percentage_and_fixed_discounts():
+    assert evaluate_coupon(coupon(), 1000, TODAY) == 100.0
+    assert evaluate_coupon(coupon(discount_type="fixed", discount_value=800, min_order_value=0), 600, TODAY) == 600.0
+
+
+@pytest.mark.parametrize("changes, subtotal, message", [
+    ({"status": "Inactive"}, 1000, "Coupon is not active"),
+    ({"expiry": date(2026, 4, 30)}, 1000, "Coupon has expired"),
+    ({"used_count": 100}, 1000, "Coupon usage limit reached"),
+    ({}, 499, "Minimum purchase"),
+    ({"discount_type": "bogus"}, 1000, "Invalid discount type"),
+])
+def test_rejections(changes, subtotal, message):
+    with pytest.raises(CouponError, match=message):
+        evaluate_coupon(coupon(**changes), subtotal, TODAY)
+
+
+def test_tier_and_per_user_limit_only_checked_when_given():
+    b2b = coupon(customer_type="B2B", per_user_limit=1)
+    assert evaluate_coupon(b2b, 1000, TODAY) == 100.0
+    assert evaluate_coupon(b2b, 1000, TODAY, tier="b2b", user_uses=0) == 100.0
+    with pytest.raises(CouponError, match="only for B2B"):
+        evaluate_coupon(b2b, 1000, TODAY, tier="b2c")
+    with pytest.raises(CouponError, match="already used"):
+        evaluate_coupon(b2b, 1000, TODAY, tier="b2b", user_uses=1)
+
+
+class FakeCouponCursor:
+    """coupons and coupon_redemptions rows for redeem_coupon's statements."""
+
+    def __init__(self, coupons):
+        self.coupons = coupons
+        self.redemptions = []
+        self.row = None
+
+    def fetchone(self):
+        return self.row
+
+    def execute(self, sql, params):
+        if sql.lstrip().startswith("UPDATE coupons"):
+            c = self.coupons.get(params[0])
+            if c and c["status"] == "Active" and c["used_count"] < c["usage_limit"]:
+                c["used_count"] += 1
+                self.row = (c["used_count"], c["usage_limit"], c["per_user_limit"])
+            else:
+                self.row = None
+        elif "COUNT(*)" in sql:
+            code, user_id = params
+            self.row = (sum(1 for r in self.redemptions if r[:2] == (code, user_id)),)
+        else:
+            self.redemptions.append(params)
+
+
+def test_redeem_enforces_global_and_per_user_limits():
+    cursor = FakeCouponCursor({"ONCE": coupon(code="ONCE", usage_limit=2, per_user_limit=1)})
+
+    assert redeem_coupon(cursor, "ONCE", "A1", "u1", 10) == (1, 2)
+    with pytest.raises(CouponError, match="already used"):
+        redeem_coupon(cursor, "ONCE", "A2", "u1", 10)
+    # The caller rolls back on CouponError; undo the counter the fake kept
+    cursor.coupons["ONCE"]["used_count"] -= 1
+
+    assert redeem_coupon(cursor, "ONCE", "A3", "u2", 10) == (2, 2)
+    with pytest.raises(CouponError, match="usage limit"):
+        redeem_coupon(cursor, "ONCE", "A4", "u3", 10)
+    assert [r[1] for r in cursor.redemptions] == ["u1", "u2"]
+
+
+def test_rank_coupons_orders_by_saving_and_hides_other_tiers():
+    rules = {c["code"]: c for c in [
+        coupon(code="TEN", discount_value=10, expiry=date(2026, 9, 1)),
+        coupon(code="FLAT100", discount_type="fixed", discount_value=100, expiry=date(2026, 7, 1)),
+        coupon(code="FIVE", discount_value=5),
+        coupon(code="BIG", min_order_value=1500),
+        coupon(code="BIGGER", min_order_value=3000),
+        coupon(code="ONCE", per_user_limit=1),
+        coupon(code="TRADE", customer_type="B2B"),
+    ]}
+
+    eligible, ineligible = rank_coupons(rules, 1000, "b2c", {"ONCE": 1}, TODAY)
+
+    # Equal savings go to the coupon that expires first
+    assert [c["code"] for c in eligible] == ["FLAT100", "TEN", "FIVE"]
+    assert eligible[0]["discount_amount"] == 100.0
+    assert eligible[0]["expires_at"] == "2026-07-01"
+    assert [c["code"] for c in ineligible] == ["BIG", "BIGGER", "ONCE"]
+    assert [c.get("add_amount") for c in ineligible] == [500.0, 2000.0, None]
+    assert ineligible[2]["reason"] == "You have already used this coupon"
@@ -0,0 +1,39 @@
+import base64
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from delta_sync import SyncToken, needs_resync
+
+
+def test_token_round_trips_ids_containing_dots():
+    token = SyncToken.decode(SyncToken(seq=912, product_id="12.v2", horizon=40).encode())
+    assert (token.seq, token.product_id, token.horizon) == (912, "12.v2", 40)
+
+
+def test_empty_token_is_the_start_of_the_feed():
+    token = SyncToken.decode(SyncToken().encode())
+    assert (token.seq, token.product_id, token.horizon) == (0, "", 0)
+
+
+@pytest.mark.parametrize("raw", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"v2.1.0.5").decode(),
+    base64.urlsafe_b64encode(b"v1.abc.0.5").decode(),
+    base64.urlsafe_b64encode(b"v1.1").decode(),
+    base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+])
+def test_decode_rejects_tokens_this_server_did_not_issue(raw):
+    with pytest.raises(ValueError):
+        SyncToken.decode(raw)
+
+
+@pytest.mark.parametrize("seq, token_horizon, horizon, expected", [
+    (50, 10, 10, False),   # nothing pruned since the token was issued
+    (50, 10, 40, False),   # pruned, but only changes the client has already passed
+    (30, 10, 40, True),    # pruned tombstones the client hasn't reached
+    (30, 40, 40, False),   # no pruning since the token was issued
+])
+def test_needs_resync(seq, token_horizon, horizon, expected):
+    assert needs_resync(SyncToken(seq, "1", token_horizon), horizon) is expected
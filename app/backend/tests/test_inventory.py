@@ -0,0 +1,158 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+
+import inventory
+from inventory import InsufficientStock, commit_reservation, release_expired, release_reservation, reserve
+
+
+class FakeStockDB:
+    """
+    products, product_variants and stock_reservations in memory, answering the
+    statements inventory.py issues (matched on their distinctive text).
+    """
+
+    def __init__(self, products, variants=None):
+        self.products = dict(products)  # id -> stock
+        self.variants = dict(variants or {})  # (product_id, colour) -> stock
+        self.reservations = []
+        self.clock = 0
+        self.commits = 0
+
+    def cursor(self):
+        return FakeStockCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+class FakeStockCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+        self.rowcount = 0
+
+    def close(self):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def execute(self, sql, params=None):
+        db = self.db
+        if "FROM products WHERE id IN" in sql:
+            ids = params[0]
+            self.rows = [(pid, db.products[pid]) for pid in sorted(ids) if pid in db.products]
+        elif "FROM product_variants v" in sql and "FOR UPDATE" in sql:
+            keys = set(zip(*params))
+            self.rows = [(pid, color, stock) for (pid, color), stock in sorted(db.variants.items())
+                         if (pid, color) in keys]
+        elif "SELECT DISTINCT product_id FROM product_variants" in sql:
+            self.rows = sorted({(pid,) for pid, _ in db.variants if pid in params[0]})
+        elif sql.lstrip().startswith("UPDATE products p"):
+            sign, ids, quantities = params[0], params[1], params[2]
+            self.rowcount = 0
+            for pid, qty in zip(ids, quantities):
+                if pid in db.products and (sign > 0 or db.products[pid] >= qty):
+                    db.products[pid] += sign * qty
+                    self.rowcount += 1
+        elif sql.lstrip().startswith("UPDATE product_variants v"):
+            sign, pids, colors, quantities = params[:4]
+            self.rowcount = 0
+            for key, qty in zip(zip(pids, colors), quantities):
+                if key in db.variants and (sign > 0 or db.variants[key] >= qty):
+                    db.variants[key] += sign * qty
+                    self.rowcount += 1
+        elif "SET status = 'committed'" in sql:
+            held = self._held(params[0])
+            for r in held:
+                r["status"] = "committed"
+            self.rowcount = len(held)
+        elif "SET status = 'released'" in sql:
+            reason, order_id = params
+            held = self._held(order_id)
+            for r in held:
+                r.update(status="released", release_reason=reason)
+            self.rows = [(r["product_id"], r["color"], r["quantity"]) for r in held]
+        elif "SELECT DISTINCT order_id" in sql:
+            expired = {r["order_id"] for r in db.reservations
+                       if r["status"] == "held" and r["expires_at"] < db.clock}
+            self.rows = [(order_id,) for order_id in sorted(expired)][:params[0]]
+        else:
+            raise AssertionError(f"unexpected statement: {sql}")
+
+    def _held(self, order_id):
+        return [r for r in self.db.reservations if r["order_id"] == order_id and r["status"] == "held"]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = FakeStockDB({"1": 10, "2": 3, "3": 5}, {("3", "FF0000"): 2, ("3", "00FF00"): 3})
+
+    def fake_execute_values(cursor, sql, rows, template=None, **kwargs):
+        for order_id, pid, color, qty, status, expires_in in rows:
+            database.reservations.append({
+                "order_id": order_id, "product_id": pid, "color": color, "quantity": qty, "status": status,
+                "expires_at": None if expires_in is None else database.clock + expires_in,
+            })
+
+    monkeypatch.setattr(inventory, "execute_values", fake_execute_values)
+    return database
+
+
+def test_reserve_sums_repeated_lines_and_takes_stock(db):
+    reserve(db.cursor(), "A1", [("1", 2), ("1", 3), ("2", 1)])
+    assert db.products == {"1": 5, "2": 2, "3": 5}
+    assert {(r["product_id"], r["quantity"], r["status"]) for r in db.reservations} == {
+        ("1", 5, "committed"), ("2", 1, "committed"),
+    }
+
+
+def test_shortage_takes_nothing(db):
+    with pytest.raises(InsufficientStock) as raised:
+        reserve(db.cursor(), "A1", [("1", 2), ("2", 4)])
+    assert raised.value.shortages == {"2": (4, 3)}
+    assert db.products["1"] == 10 and db.reservations == []
+
+
+def test_unknown_and_non_numeric_ids_are_short(db):
+    with pytest.raises(InsufficientStock) as raised:
+        reserve(db.cursor(), "A1", [("99", 1), ("abc", 1)])
+    assert raised.value.shortages == {"99": (1, 0), "abc": (1, 0)}
+
+
+def test_coloured_line_takes_variant_stock(db):
+    reserve(db.cursor(), "A1", [("3", 2, "#ff0000")])
+    assert db.products["3"] == 3 and db.variants[("3", "FF0000")] == 0
+
+    with pytest.raises(InsufficientStock) as raised:
+        reserve(db.cursor(), "A2", [("3", 1, "#ff0000")])
+    assert raised.value.shortages == {"3/FF0000": (1, 0)}
+
+
+def test_held_reservation_commits_or_releases_once(db):
+    reserve(db.cursor(), "A1", [("1", 4)], expires_in=900)
+    reserve(db.cursor(), "A2", [("3", 1, "00ff00")], expires_in=900)
+    assert db.products["1"] == 6
+
+    assert commit_reservation(db.cursor(), "A1") == 1
+    assert release_reservation(db.cursor(), "A1") == 0  # committed stock stays sold
+    assert db.products["1"] == 6
+
+    assert release_reservation(db.cursor(), "A2") == 1
+    assert release_reservation(db.cursor(), "A2") == 0
+    assert db.products["3"] == 5 and db.variants[("3", "00FF00")] == 3
+
+
+def test_release_expired_gives_back_only_expired_holds(db):
+    reserve(db.cursor(), "old", [("1", 1)], expires_in=60)
+    reserve(db.cursor(), "new", [("1", 2)], expires_in=600)
+    reserve(db.cursor(), "sold", [("2", 1)])
+    db.clock = 120
+
+    assert release_expired(db) == ["old"]
+    assert db.products == {"1": 8, "2": 2, "3": 5}
+    assert release_expired(db) == []
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+pytest.importorskip("anyio")
+
+from media import DerivativeCache
+
+NOW = 1_000_000.0
+
+
+def variant(directory, name, size, used_at):
+    path = directory / name
+    path.write_bytes(b"x" * size)
+    os.utime(path, (used_at, used_at))
+    return path
+
+
+def test_sweep_evicts_least_recently_used_down_to_size(tmp_path):
+    oldest = variant(tmp_path, "a.webp", 100, NOW - 3000)
+    older = variant(tmp_path, "b.webp", 100, NOW - 2000)
+    newer = variant(tmp_path, "c.webp", 100, NOW - 1000)
+    cache = DerivativeCache(directory=str(tmp_path), max_bytes=150, grace=300)
+
+    assert cache.sweep(now=NOW) == 200
+    assert not oldest.exists() and not older.exists()
+    assert newer.exists()
+
+
+def test_sweep_keeps_recently_used_files_and_live_renders(tmp_path):
+    old = variant(tmp_path, "a.webp", 100, NOW - 3000)
+    streaming = variant(tmp_path, "b.webp", 100, NOW - 10)
+    rendering = variant(tmp_path, "c.webp.123.tmp", 100, NOW - 10)
+    crashed = variant(tmp_path, "d.webp.456.tmp", 100, NOW - 3000)
+    cache = DerivativeCache(directory=str(tmp_path), max_bytes=0, grace=300)
+
+    cache.sweep(now=NOW)
+    assert not old.exists() and not crashed.exists()
+    assert streaming.exists() and rendering.exists()
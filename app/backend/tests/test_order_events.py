@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from order_events import OrderStatusHub, stream_order_status
+
+
+async def never_disconnected():
+    return False
+
+
+async def take(stream, count):
+    return [await stream.__anext__() for _ in range(count)]
+
+
+def test_change_during_snapshot_load_is_delivered():
+    async def scenario():
+        hub = OrderStatusHub(connect=None)
+
+        async def load_snapshot():
+            # A change committed while the snapshot is read
+            hub.publish({"order_id": "A1", "status": "shipped"})
+            return {"order_id": "A1", "status": "packed"}
+
+        stream = stream_order_status(hub, "A1", load_snapshot, never_disconnected)
+        messages = await take(stream, 2)
+        await stream.aclose()
+        return messages, hub.subscriber_count
+
+    messages, subscribers = asyncio.run(scenario())
+    assert '"packed"' in messages[0]
+    assert '"shipped"' in messages[1]
+    assert subscribers == 0
+
+
+def test_resync_reloads_snapshot():
+    async def scenario():
+        hub = OrderStatusHub(connect=None)
+        states = iter(["packed", "delivered"])
+
+        async def load_snapshot():
+            return {"order_id": "A1", "status": next(states)}
+
+        stream = stream_order_status(hub, "A1", load_snapshot, never_disconnected)
+        first = await stream.__anext__()
+        hub.resync()  # as after a LISTEN reconnect, when notifications may have been missed
+        second = await stream.__anext__()
+        await stream.aclose()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert '"packed"' in first
+    assert '"delivered"' in second
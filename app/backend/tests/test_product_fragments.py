@@ -0,0 +1,55 @@
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from product_fragments import Fragment, FragmentCache, assemble_list
+
+NOW = datetime(2026, 5, 1, 12, 0)
+
+PRODUCT = {
+    "id": 7, "name": 'Steel "Tiffin" box', "stock": 3, "description": "Ünïcode, commas, {braces}",
+    "b2c_price": Decimal("199.50"), "variants": [], "updated_at": NOW,
+}
+
+
+def test_render_matches_a_full_encode_with_the_new_values():
+    fragment = Fragment(PRODUCT, ("stock", "variants"), signature=None, valid_until=None)
+
+    assert fragment.slots == ["stock", "variants"]
+    assert len(fragment.chunks) == 3
+
+    variants = [{"id": 8, "name": "Large", "stock": 0}]
+    rendered = json.loads(fragment.render({"stock": 41, "variants": variants}))
+    assert rendered == {
+        "id": 7, "name": 'Steel "Tiffin" box', "stock": 41, "description": "Ünïcode, commas, {braces}",
+        "b2c_price": 199.5, "variants": variants, "updated_at": "2026-05-01T12:00:00",
+    }
+
+
+def test_missing_slot_values_render_as_null():
+    fragment = Fragment(PRODUCT, ("stock",), signature=None, valid_until=None)
+    assert json.loads(fragment.render({}))["stock"] is None
+
+
+def test_assemble_list_is_one_json_document():
+    fragment = Fragment(PRODUCT, ("stock",), signature=None, valid_until=None)
+    body = json.loads(assemble_list([({"stock": 1}, fragment), ({"stock": 2}, fragment)]))
+    assert [p["stock"] for p in body["products"]] == [1, 2]
+    assert body["count"] == 2
+
+
+def test_cache_drops_fragments_on_signature_change_or_offer_boundary():
+    cache = FragmentCache(size=2)
+    boundary = NOW + timedelta(hours=1)
+    cache.put(7, "b2c", "card", Fragment(PRODUCT, ("stock",), signature=("v1",), valid_until=boundary))
+
+    assert cache.get("7", "b2c", "card", ("v1",), NOW) is not None
+    assert cache.get(7, "b2c", "card", ("v1",), boundary) is None
+
+    cache.put(7, "b2c", "card", Fragment(PRODUCT, ("stock",), signature=("v1",), valid_until=None))
+    assert cache.get(7, "b2c", "card", ("v2",), NOW) is None
+    assert cache.get(7, "b2c", "card", ("v1",), NOW) is None
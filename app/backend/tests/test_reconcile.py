@@ -0,0 +1,73 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+
+import reconcile
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.commits = 0
+
+    def commit(self):
+        self.commits += 1
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.statements = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+
+def discrepancy(order_id, kind, **extra):
+    return {"order_id": order_id, "razorpay_order_id": f"rzp_{order_id}", "payment_id": f"pay_{order_id}",
+            "kind": kind, **extra}
+
+
+def test_captured_with_amount_mismatch_is_flagged_not_paid(monkeypatch):
+    paid_batches = []
+
+    def fake_apply(cursor, paid, failed):
+        paid_batches.append(paid)
+        return list(paid), [], []
+
+    monkeypatch.setattr(reconcile, "apply_payment_updates", fake_apply)
+    discrepancies = [
+        discrepancy("A", "captured_not_paid", method="upi", razorpay_amount=10000, currency="INR"),
+        discrepancy("B", "captured_not_paid", method="upi", razorpay_amount=99, currency="INR"),
+        discrepancy("B", "amount_mismatch", order_amount_paise=10000, razorpay_amount=99),
+    ]
+    cursor = RecordingCursor()
+
+    corrected = reconcile.apply_corrections(RecordingConnection(), cursor, discrepancies)
+
+    assert corrected == 1
+    assert [list(batch) for batch in paid_batches] == [["A"]]
+    assert reconcile.needs_review(discrepancies) == ["B"]
+    flagged = [params for sql, params in cursor.statements if "payment_review" in sql]
+    assert flagged and flagged[0][0] == ["B"]
+
+
+class ScriptedCursor(RecordingCursor):
+    """Answers each fetchall() with the next prepared result."""
+
+    def __init__(self, *results):
+        super().__init__()
+        self.results = list(results)
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+def test_notes_hint_alone_is_an_orphan_not_a_match():
+    unmatched = {"razorpay_order_id": "order_x", "payment_id": "pay_x", "razorpay_status": "captured",
+                 "method": "upi", "razorpay_amount": 100, "currency": "INR", "order_id": None,
+                 "order_amount": None, "order_payment": None, "hinted_order_id": "A"}
+    matched, discrepancies = reconcile.find_discrepancies(ScriptedCursor([unmatched], []), 0, 1)
+
+    assert matched == 0
+    assert [(d["kind"], d["hinted_order_id"]) for d in discrepancies] == [("orphan_payment", "A")]
+    assert "orphan_payment" not in reconcile.CORRECTABLE
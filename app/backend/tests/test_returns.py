@@ -0,0 +1,102 @@
+from datetime import datetime
+
+import pytest
+
+from returns import QuantityExceeded, claim_quantity, decode_cursor, fetch_timeline
+
+
+class FakeItemsCursor:
+    """order_items rows for claim_quantity's conditional UPDATE and its follow-up SELECT."""
+
+    def __init__(self, items):
+        self.items = items
+        self.row = None
+
+    def fetchone(self):
+        return self.row
+
+    def execute(self, sql, params):
+        column = "refunded_qty" if "refunded_qty" in sql else "exchanged_qty"
+        if sql.lstrip().startswith("UPDATE"):
+            quantity, _, full_status, partial_status, item_id, _ = params
+            item = self.items[item_id]
+            if item[column] + quantity > item["quantity"]:
+                self.row = None
+                return
+            item[column] += quantity
+            item["status"] = full_status if item[column] >= item["quantity"] else partial_status
+            self.row = (item[column],)
+        else:
+            item = self.items[params[0]]
+            self.row = (item[column], item["quantity"])
+
+
+def test_claims_up_to_the_ordered_quantity():
+    items = {1: {"quantity": 3, "refunded_qty": 0, "exchanged_qty": 0, "status": "delivered"}}
+    cursor = FakeItemsCursor(items)
+
+    assert claim_quantity(cursor, 1, "refund", 2) == 2
+    assert items[1]["status"] == "partial_returned"
+    with pytest.raises(QuantityExceeded) as raised:
+        claim_quantity(cursor, 1, "refund", 2)
+    assert (raised.value.claimed, raised.value.ordered, raised.value.requested) == (2, 3, 2)
+    assert claim_quantity(cursor, 1, "refund", 1) == 3
+    assert items[1]["status"] == "returned"
+    assert claim_quantity(cursor, 1, "exchange", 3) == 3  # separate counter
+
+
+class FakeTimelineCursor:
+    """Evaluates the timeline UNION over in-memory refunds and exchanges."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = []
+
+    def fetchall(self):
+        return self.result
+
+    def execute(self, sql, params):
+        kinds = [k for k in ("refund", "exchange") if f"'{k}' AS type" in sql]
+        after = None
+        if params["after_ts"] is not None:
+            after = (datetime.fromisoformat(params["after_ts"]), params["after_type"], params["after_id"])
+        matching = [
+            r for r in self.rows
+            if r["type"] in kinds and r["customer"] == params["customer"]
+            and (after is None or (r["created_at"], r["type"], r["id"]) < after)
+        ]
+        matching.sort(key=lambda r: (r["created_at"], r["type"], r["id"]), reverse=True)
+        self.result = [dict(r, amount=10, images=[]) for r in matching[:params["fetch"]]]
+
+
+def timeline_rows():
+    same_time = datetime(2026, 3, 1, 12, 0)
+    rows = [{"type": "refund", "id": n, "customer": "u1", "created_at": datetime(2026, 1, n)} for n in range(1, 6)]
+    rows += [{"type": "exchange", "id": n, "customer": "u1", "created_at": datetime(2026, 2, n)} for n in range(1, 4)]
+    # Ties on created_at are broken by type, then id
+    rows += [{"type": "refund", "id": 9, "customer": "u1", "created_at": same_time},
+             {"type": "exchange", "id": 9, "customer": "u1", "created_at": same_time},
+             {"type": "refund", "id": 99, "customer": "someone-else", "created_at": same_time}]
+    return rows
+
+
+def test_keyset_pages_cover_every_row_once_in_order():
+    cursor = FakeTimelineCursor(timeline_rows())
+    seen, after = [], None
+    while True:
+        items, after = fetch_timeline(cursor, "u1", limit=3, after=after)
+        seen.extend((item["type"], item["id"]) for item in items)
+        if after is None:
+            break
+
+    assert seen[:2] == [("refund", 9), ("exchange", 9)]
+    assert len(seen) == len(set(seen)) == 10
+    assert ("refund", 99) not in seen
+
+
+def test_kind_filter_and_cursor_validation():
+    items, after = fetch_timeline(FakeTimelineCursor(timeline_rows()), "u1", kind="exchange", limit=10)
+    assert {item["type"] for item in items} == {"exchange"} and after is None
+
+    with pytest.raises(ValueError):
+        decode_cursor("not-a-cursor")
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+from fastapi import Request
+
+from route_cache import MemoryBackend, RouteCache
+
+
+def make_request(path="/products", query=b""):
+    return Request({"type": "http", "method": "GET", "path": path, "query_string": query, "headers": []})
+
+
+def cached_endpoint(cache, calls, gate=None, **options):
+    @cache.cached(ttl=60, **options)
+    async def endpoint(request: Request, category: str = None):
+        calls.append(category)
+        if gate is not None:
+            await gate.wait()
+        return {"category": category, "call": len(calls)}
+
+    return endpoint
+
+
+def test_concurrent_misses_share_one_endpoint_call():
+    async def scenario():
+        cache = RouteCache(MemoryBackend())
+        calls = []
+        gate = asyncio.Event()
+        endpoint = cached_endpoint(cache, calls, gate)
+
+        pending = [asyncio.ensure_future(endpoint(request=make_request(), category=None)) for _ in range(5)]
+        await asyncio.sleep(0)
+        gate.set()
+        responses = await asyncio.gather(*pending)
+
+        assert calls == [None]
+        assert {bytes(r.body) for r in responses} == {b'{"category":null,"call":1}'}
+        assert sorted(r.headers["X-Cache"] for r in responses) == ["HIT"] * 4 + ["MISS"]
+        metrics = cache.metrics()["/products"]
+        assert (metrics["misses"], metrics["coalesced"], metrics["hits"]) == (1, 4, 0)
+
+    asyncio.run(scenario())
+
+
+def test_tag_invalidation_drops_only_tagged_entries():
+    async def scenario():
+        cache = RouteCache(MemoryBackend())
+        calls = []
+        endpoint = cached_endpoint(cache, calls, tags=lambda params: ["products", f"category:{params['category']}"])
+
+        async def fetch(category):
+            response = await endpoint(request=make_request(query=f"category={category}".encode()), category=category)
+            return response.headers["X-Cache"], json.loads(response.body)["call"]
+
+        assert await fetch("rice") == ("MISS", 1)
+        assert await fetch("dal") == ("MISS", 2)
+        assert await fetch("rice") == ("HIT", 1)
+
+        assert await cache.invalidate("category:rice") == 1
+        assert await fetch("rice") == ("MISS", 3)
+        assert await fetch("dal") == ("HIT", 2)
+
+        assert await cache.invalidate("products") == 2
+        assert await fetch("dal") == ("MISS", 4)
+
+    asyncio.run(scenario())
+
+
+def test_errors_are_not_cached_and_reach_waiters():
+    async def scenario():
+        cache = RouteCache(MemoryBackend())
+        attempts = []
+
+        @cache.cached(ttl=60)
+        async def endpoint(request: Request):
+            attempts.append(1)
+            await asyncio.sleep(0)
+            raise RuntimeError("db down")
+
+        results = await asyncio.gather(*(endpoint(request=make_request()) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert len(attempts) == 1
+        assert not cache.backend._entries
+
+    asyncio.run(scenario())
@@ -0,0 +1,19 @@
+from tax import TaxEngine, TaxLine
+
+
+def make_engine(index):
+    engine = TaxEngine()
+    engine._index = index
+    return engine
+
+
+def test_unknown_hsn_falls_back_to_product_rates():
+    tax = make_engine({"85": 18.0}).compute([TaxLine("9999", 100, 2.5, 2.5)], "Tamil Nadu")
+    assert tax["lines"][0]["rate"] == 5.0
+    assert tax["sgst_amount"] == tax["cgst_amount"] == 2.5
+
+
+def test_fixed_rate_overrides_table_for_refunds():
+    tax = make_engine({"85": 18.0}).compute([TaxLine("8517", 100, 0, 0, 12)], "Karnataka")
+    assert tax["lines"][0]["rate"] == 12.0
+    assert tax["igst_amount"] == 12.0
@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("anyio")
+
+from upload_gc import extract_refs
+
+
+def test_legacy_url_with_space_keeps_whole_name():
+    assert extract_refs("http://h/uploads/business/app/gst/12_GST Certificate.pdf") == [
+        "uploads/business/app/gst/12_GST Certificate.pdf"
+    ]
+
+
+def test_encoded_and_relative_paths():
+    assert extract_refs("https://h/files/ab/cd%20e.png") == ["files/ab/cd e.png"]
+    assert extract_refs("uploads/refunds/a b.jpg") == ["uploads/refunds/a b.jpg"]
+
+
+def test_question_mark_in_legacy_name_is_kept_as_a_reference():
+    assert "uploads/x/a?b.pdf" in extract_refs("http://h/uploads/x/a?b.pdf")
+
+
+def test_json_list_of_urls():
+    assert extract_refs('["http://h/files/k1", "http://h/uploads/r/1 2.jpg"]') == [
+        "files/k1", "uploads/r/1 2.jpg"
+    ]
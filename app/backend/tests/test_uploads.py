@@ -0,0 +1,43 @@
+import asyncio
+import io
+import threading
+
+import pytest
+
+pytest.importorskip("anyio")
+
+import uploads
+from uploads import UploadBatch
+
+
+class FakeUpload:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self._data = io.BytesIO(data)
+
+    async def read(self, size=-1):
+        return self._data.read(size)
+
+
+class RecordingStorage:
+    def __init__(self):
+        self.put_threads = []
+
+    def put(self, key, path, content_type):
+        self.put_threads.append(threading.current_thread())
+        return True
+
+
+def test_commit_publishes_off_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "STAGING_DIR", str(tmp_path))
+    storage = RecordingStorage()
+
+    async def scenario():
+        batch = UploadBatch(storage=storage)
+        await batch.stage_many([FakeUpload("a.png", b"\x89PNG\r\n\x1a\n" + b"a" * 10),
+                                FakeUpload("b.pdf", b"%PDF-1.4 b")], uploads.DOCUMENT_TYPES)
+        return await batch.commit(), batch.staged
+
+    published, left = asyncio.run(scenario())
+    assert len(published) == 2 and left == []
+    assert all(thread is not threading.main_thread() for thread in storage.put_threads)
@@ -0,0 +1,34 @@
+from user_profile import ProfileCache
+
+
+def test_load_racing_an_invalidation_is_not_cached():
+    cache = ProfileCache(ttl=60, size=10)
+    generation = cache.generation("u1")
+    cache.invalidate("u1")  # the user edited their profile while the load ran
+    cache.put("u1", "b2c", False, {"name": "old"}, generation)
+    assert cache.get("u1", "b2c", False) is None
+
+    cache.put("u1", "b2c", False, {"name": "new"}, cache.generation("u1"))
+    assert cache.get("u1", "b2c", False) == {"name": "new"}
+
+
+def test_invalidation_records_stay_bounded_and_safe():
+    cache = ProfileCache(ttl=60, size=3)
+    stale = cache.generation("u0")
+    for n in range(100):
+        cache.invalidate(f"u{n}")
+    assert len(cache._invalidated) == 3
+
+    # u0's own record is long gone, but its pre-invalidation load is still turned away
+    cache.put("u0", "b2c", False, {"name": "old"}, stale)
+    assert cache.get("u0", "b2c", False) is None
+
+    cache.put("u0", "b2c", False, {"name": "new"}, cache.generation("u0"))
+    assert cache.get("u0", "b2c", False) == {"name": "new"}
+
+
+def test_expired_entry_is_dropped():
+    cache = ProfileCache(ttl=-1, size=10)
+    cache.put("u1", "b2c", True, {"name": "x"}, cache.generation("u1"))
+    assert cache.get("u1", "b2c", True) is None
+    assert cache._entries == {}
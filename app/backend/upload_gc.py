@@ -0,0 +1,269 @@
+import json
+import os
+import time
+import urllib.parse
+
+from psycopg2.extras import execute_values
+
+from storage import digest_of, get_storage
+from uploads import STAGING_DIR, UPLOAD_ROOT
+
+UPLOAD_GC_GRACE = int(os.getenv("UPLOAD_GC_GRACE", 24 * 3600))  # never touch files younger than this
+UPLOAD_GC_INTERVAL = int(os.getenv("UPLOAD_GC_INTERVAL", 24 * 3600))
+# The background sweep only reports unless deletion is switched on explicitly
+UPLOAD_GC_DELETE = os.getenv("UPLOAD_GC_DELETE", "").lower() in ("1", "true", "yes")
+UPLOAD_GC_BATCH = 1000
+REPORT_SAMPLE = 50
+
+# Every column that can point at an uploaded file. The catalogue/CMS columns are included
+# even though this service doesn't write them, so a shared upload is never collected.
+REFERENCE_SOURCES = (
+    ("refunds", "proof_image_path"),
+    ("exchanges", "proof_image_path"),
+    ("b2b_applications", "gst_certificate_url"),
+    ("b2b_applications", "business_license_url"),
+    ("products", "image"),
+    ("cms_banners", "image"),
+    ("cms_category_banners", "image_url"),
+)
+
+REF_ROOTS = ("uploads", "files")
+
+
+def extract_refs(value):
+    """
+    Normalized references in one column value: 'uploads/<path>' for legacy files,
+    'files/<key>' for content-addressed blobs. Values are a URL or a JSON list of URLs.
+    """
+    if not value:
+        return []
+    if isinstance(value, str) and value.lstrip().startswith("["):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    values = value if isinstance(value, list) else [value]
+
+    refs = []
+    for item in values:
+        refs.extend(_refs_in_url(str(item)))
+    return refs
+
+
+def _refs_in_url(url):
+    """
+    The whole path after /uploads/ or /files/, unquoted. Legacy URLs were stored
+    unencoded, so spaces belong to the name; a '?' or '#' might too, so the path
+    with them kept is referenced as well. Extra refs only ever keep more files.
+    """
+    url = url.strip()
+    if not url:
+        return []
+    parts = urllib.parse.urlsplit(url)
+    candidates = [parts.path]
+    if parts.query or parts.fragment:
+        candidates.append(url[url.find(parts.path) if parts.path else len(url):])
+
+    refs = []
+    for path in candidates:
+        path = "/" + path.lstrip("/")
+        found = [(path.find(f"/{root}/"), root) for root in REF_ROOTS if f"/{root}/" in path]
+        if not found:
+            continue
+        start, root = min(found)
+        name = urllib.parse.unquote(path[start + len(root) + 2:])
+        if name:
+            refs.append(f"{root}/{name}")
+    return list(dict.fromkeys(refs))
+
+
+def load_references(conn, batch_size=UPLOAD_GC_BATCH):
+    """
+    Streams every reference into a temp table, batch by batch through server-side
+    cursors, so memory stays flat however many rows there are. Returns the count.
+    """
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE upload_gc_refs (ref TEXT PRIMARY KEY) ON COMMIT DROP")
+    total = 0
+    for table, column in REFERENCE_SOURCES:
+        cursor.execute("SAVEPOINT upload_gc_source")
+        try:
+            source = conn.cursor(name=f"upload_gc_{table}_{column}")
+            source.itersize = batch_size
+            source.execute(f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL")
+            while True:
+                rows = source.fetchmany(batch_size)
+                if not rows:
+                    break
+                refs = {ref for row in rows for ref in extract_refs(row[0])}
+                if refs:
+                    execute_values(
+                        cursor,
+                        "INSERT INTO upload_gc_refs (ref) VALUES %s ON CONFLICT DO NOTHING",
+                        [(ref,) for ref in refs],
+                    )
+                    total += len(refs)
+            source.close()
+            cursor.execute("RELEASE SAVEPOINT upload_gc_source")
+        except Exception as e:
+            # A missing table/column only means nothing references files from there
+            cursor.execute("ROLLBACK TO SAVEPOINT upload_gc_source")
+            print(f"Upload GC: skipped {table}.{column}: {e}")
+    cursor.close()
+    return total
+
+
+def _walk_files(root, skip):
+    """Yields (path, mtime, size) under root without listing the whole tree at once."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.realpath(entry.path) not in skip:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+
+def iter_candidates():
+    """
+    (ref, mtime, size, delete) for every stored file: legacy files under UPLOAD_ROOT
+    (the blob root is skipped) and then every blob in the storage backend.
+    """
+    storage = get_storage()
+    blob_root = getattr(storage, "root", None)
+    skip = {os.path.realpath(blob_root)} if blob_root else set()
+
+    for path, mtime, size in _walk_files(UPLOAD_ROOT, skip):
+        relative = os.path.relpath(path, UPLOAD_ROOT).replace(os.sep, "/")
+        yield f"uploads/{relative}", mtime, size, lambda p=path: os.remove(p)
+
+    for key, mtime, size in storage.iter_keys():
+        yield f"files/{key}", mtime, size, lambda k=key: storage.delete(k)
+
+
+def _unreferenced(cursor, refs):
+    cursor.execute("""
+        SELECT c.ref
+        FROM unnest(%s::text[]) AS c(ref)
+        WHERE NOT EXISTS (SELECT 1 FROM upload_gc_refs r WHERE r.ref = c.ref)
+    """, (refs,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def collect_garbage(conn, dry_run=True, grace=UPLOAD_GC_GRACE, batch_size=UPLOAD_GC_BATCH, report_file=None):
+    """
+    Deletes uploaded files nothing references any more and that are older than `grace`
+    seconds. With dry_run nothing is deleted. Candidates are checked against the
+    reference table a batch at a time; the returned report keeps only a sample of paths
+    (every path is written to `report_file`, an open text file, when given).
+    """
+    now = time.time()
+    cutoff = now - grace
+    report = {
+        "dry_run": dry_run,
+        "references": 0,
+        "scanned": 0,
+        "too_recent": 0,
+        "referenced": 0,
+        "unreferenced": 0,
+        "unreferenced_bytes": 0,
+        "deleted": 0,
+        "failed": 0,
+        "stale_staging_files": 0,
+        "sample": [],
+    }
+
+    cursor = conn.cursor()
+    try:
+        report["references"] = load_references(conn, batch_size)
+
+        def flush(batch):
+            orphans = _unreferenced(cursor, [ref for ref, _, _ in batch])
+            report["referenced"] += len(batch) - len(orphans)
+            for ref, size, delete in batch:
+                if ref not in orphans:
+                    continue
+                report["unreferenced"] += 1
+                report["unreferenced_bytes"] += size
+                if len(report["sample"]) < REPORT_SAMPLE:
+                    report["sample"].append(ref)
+                if report_file is not None:
+                    report_file.write(f"{ref}\t{size}\n")
+                if dry_run:
+                    continue
+                try:
+                    delete()
+                    report["deleted"] += 1
+                except Exception as e:
+                    report["failed"] += 1
+                    print(f"Upload GC: failed to delete {ref}: {e}")
+
+        batch = []
+        for ref, mtime, size, delete in iter_candidates():
+            report["scanned"] += 1
+            if mtime > cutoff:
+                report["too_recent"] += 1
+                continue
+            if ref.startswith("files/") and not digest_of(ref[len("files/"):]):
+                continue
+            batch.append((ref, size, delete))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+        # Temp files of requests that died mid-upload
+        for path, mtime, _ in _walk_files(STAGING_DIR, set()):
+            if mtime <= cutoff:
+                report["stale_staging_files"] += 1
+                if not dry_run:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+        conn.commit()  # drops the temp table
+        return report
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from database import get_db_connection
+
+    parser = argparse.ArgumentParser(description="Delete uploads no row references any more")
+    parser.add_argument("--delete", action="store_true", help="actually delete (default is a dry run)")
+    parser.add_argument("--grace-hours", type=float, default=UPLOAD_GC_GRACE / 3600)
+    parser.add_argument("--report", help="write every unreferenced path to this file")
+    args = parser.parse_args()
+
+    connection = get_db_connection()
+    out = open(args.report, "w") if args.report else None
+    try:
+        result = collect_garbage(
+            connection,
+            dry_run=not args.delete,
+            grace=int(args.grace_hours * 3600),
+            report_file=out,
+        )
+    finally:
+        if out:
+            out.close()
+        connection.close()
+    json.dump(result, sys.stdout, indent=2)
+    print()
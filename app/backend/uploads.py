@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import os
+import uuid
+
+import anyio
+
+from storage import blob_key, get_storage
+
+UPLOAD_ROOT = "uploads"
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", 10 * 1024 * 1024))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", 40 * 1024 * 1024))
+UPLOAD_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", 10))
+
+# Staged files sit next to (not inside) the served folder, on the same filesystem,
+# so they are never reachable over /uploads and the final rename is atomic
+STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR", ".upload_staging")
+
+IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif"}
+DOCUMENT_TYPES = IMAGE_TYPES | {"application/pdf"}
+
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+    "application/pdf": ".pdf",
+}
+
+
+class UploadError(Exception):
+    """Rejected upload; `status_code` is what the endpoint should answer with."""
+
+    def __init__(self, message, status_code=400):
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def sniff_content_type(head):
+    """Content type from the file's leading bytes; None when it isn't a type we accept."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    return None
+
+
+class StagedUpload:
+    __slots__ = ("temp_path", "key", "digest", "content_type", "size", "original_name")
+
+    def __init__(self, temp_path, key, digest, content_type, size, original_name):
+        self.temp_path = temp_path
+        self.key = key  # content-addressed storage key, served at /files/<key>
+        self.digest = digest
+        self.content_type = content_type
+        self.size = size
+        self.original_name = original_name
+
+
+class UploadBatch:
+    """
+    The files of one request. Each file is streamed in chunks to a temp file under
+    STAGING_DIR, sniffed, size-checked and hashed on the way, and only handed to the
+    storage backend by commit(), which callers run after their DB transaction commits.
+    discard() removes whatever wasn't committed, so a failed request leaves nothing behind.
+
+        batch = UploadBatch()
+        try:
+            staged = await batch.stage_many(files)
+            ... insert rows, conn.commit() ...
+            await batch.commit()
+        finally:
+            batch.discard()
+    """
+
+    def __init__(self, max_request_bytes=None, max_file_bytes=None, max_files=None, storage=None):
+        self.storage = storage or get_storage()
+        self.max_request_bytes = max_request_bytes or UPLOAD_MAX_REQUEST_BYTES
+        self.max_file_bytes = max_file_bytes or UPLOAD_MAX_FILE_BYTES
+        self.max_files = max_files or UPLOAD_MAX_FILES
+        self.received = 0
+        self.staged = []
+
+    async def stage(self, file, allowed=IMAGE_TYPES):
+        """Streams one UploadFile to staging and returns its StagedUpload."""
+        if len(self.staged) >= self.max_files:
+            raise UploadError(f"At most {self.max_files} files per request", 413)
+
+        os.makedirs(STAGING_DIR, exist_ok=True)
+        temp_path = os.path.join(STAGING_DIR, f"{uuid.uuid4().hex}.part")
+        size = 0
+        content_type = None
+        sha256 = hashlib.sha256()
+        try:
+            async with await anyio.open_file(temp_path, "wb") as out:
+                while True:
+                    chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if content_type is None:
+                        content_type = sniff_content_type(chunk[:16])
+                        if content_type not in allowed:
+                            raise UploadError(f"{file.filename}: unsupported file type", 415)
+
+                    size += len(chunk)
+                    self.received += len(chunk)
+                    if size > self.max_file_bytes:
+                        raise UploadError(f"{file.filename}: file exceeds {self.max_file_bytes} bytes", 413)
+                    if self.received > self.max_request_bytes:
+                        raise UploadError(f"Upload exceeds {self.max_request_bytes} bytes in total", 413)
+                    sha256.update(chunk)
+                    await out.write(chunk)
+        except BaseException:
+            _remove(temp_path)
+            raise
+
+        if size == 0:
+            _remove(temp_path)
+            raise UploadError(f"{file.filename}: file is empty")
+
+        digest = sha256.hexdigest()
+        staged = StagedUpload(
+            temp_path,
+            blob_key(digest, EXTENSIONS[content_type]),
+            digest,
+            content_type,
+            size,
+            file.filename,
+        )
+        self.staged.append(staged)
+        return staged
+
+    async def stage_many(self, files, allowed=IMAGE_TYPES):
+        """Stages several files concurrently; parts without a filename are skipped."""
+        files = [f for f in files if f and f.filename]
+        if len(self.staged) + len(files) > self.max_files:
+            raise UploadError(f"At most {self.max_files} files per request", 413)
+        results = await asyncio.gather(
+            *(self.stage(f, allowed) for f in files),
+            return_exceptions=True
+        )
+        # Let every file finish (or clean up) before reporting, so discard() sees them all
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def commit(self):
+        """
+        Hands every staged file to the storage backend. Call only after the DB commit.
+        Returns the keys that were newly stored; duplicates of existing blobs are dropped.
+        The puts (disk copies or S3 uploads) block, so they run on a worker thread.
+        """
+        return await anyio.to_thread.run_sync(self._publish)
+
+    def _publish(self):
+        published = []
+        for staged in self.staged:
+            try:
+                if self.storage.put(staged.key, staged.temp_path, staged.content_type):
+                    published.append(staged.key)
+            except Exception as e:
+                # The rows are already committed; log loudly rather than fail the request
+                print(f"Failed to publish upload {staged.key}: {e}")
+                _remove(staged.temp_path)
+        self.staged = []
+        return published
+
+    def discard(self):
+        """Removes staged files that were never committed. Safe to call more than once."""
+        for staged in self.staged:
+            _remove(staged.temp_path)
+        self.staged = []
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PROFILE_CHANGED_CHANNEL = "profile_changed"
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", 300))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 10000))  # (user, tier, address) entries
+
+# Everything /users/me shows, in one round trip. The token's user_type picks which
+# application table applies; the default address is joined only when asked for.
+PROFILE_QUERY = """
+    SELECT
+        au.id IS NOT NULL AS has_auth,
+        -- revoked while the deletion job runs, gone once it has finished
+        (au.id IS NULL OR au.deleted_at IS NOT NULL) AS revoked,
+        au.full_name AS auth_full_name, au.email AS auth_email,
+        au.phone_number AS auth_phone_number, au.created_at AS auth_created_at,
+        b2b.user_id IS NOT NULL AS has_b2b,
+        b2b.business_name, b2b.email AS b2b_email, b2b.phone_number AS b2b_phone_number,
+        b2b.gstin, b2b.pan, b2b.created_at AS b2b_created_at,
+        b2c.id IS NOT NULL AS has_b2c,
+        b2c.full_name AS b2c_full_name, b2c.email AS b2c_email,
+        b2c.phone_number AS b2c_phone_number, b2c.created_at AS b2c_created_at,
+        da.user_address_id, da.address_name, da.is_default, da.address_id,
+        da.address, da.state, da.city, da.pincode, da.country
+    FROM (SELECT 1) me
+    LEFT JOIN auth_users au ON au.id = %(user_id)s
+    LEFT JOIN LATERAL (
+        SELECT user_id, business_name, email, phone_number, gstin, pan, created_at
+        FROM b2b_applications
+        WHERE %(is_b2b)s AND user_id = %(user_id)s
+        LIMIT 1
+    ) b2b ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT id, full_name, email, phone_number, created_at
+        FROM b2c_applications
+        WHERE NOT %(is_b2b)s AND id = %(user_id)s
+        LIMIT 1
+    ) b2c ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT
+            ua.id AS user_address_id, ua.name AS address_name, ua.is_default,
+            a.id AS address_id, a.address, a.state, a.city, a.pincode, a.country
+        FROM user_addresses ua JOIN addresses a ON ua.address_id = a.id
+        WHERE %(with_address)s AND ua.user_id = %(user_id)s AND ua.is_default
+        ORDER BY ua.created_at DESC
+        LIMIT 1
+    ) da ON TRUE
+"""
+
+
+def load_profile(cursor, user_id, email, user_type, with_address=False):
+    """
+    The /users/me body: the application row for the user's tier, with names and
+    dates preferred from auth_users, falling back to auth_users alone. None once
+    the account has been deleted or is being deleted (see account_deletion.py).
+    """
+    is_b2b = user_type == "b2b"
+    cursor.execute(PROFILE_QUERY, {"user_id": user_id, "is_b2b": is_b2b, "with_address": with_address})
+    row = cursor.fetchone()
+    if row["revoked"]:
+        return None
+
+    user_info = {
+        "user_id": user_id,
+        "email": email,
+        "user_type": user_type or "b2c"
+    }
+
+    if row["has_b2b"]:
+        user_info["full_name"] = row["auth_full_name"] or row["business_name"]
+        user_info["business_name"] = row["business_name"]
+        user_info["email"] = row["b2b_email"]
+        user_info["phone_number"] = row["b2b_phone_number"]
+        user_info["gstin"] = row["gstin"]
+        user_info["pan"] = row["pan"]
+        user_info["created_at"] = row["b2b_created_at"]
+        user_info["auth_created_at"] = row["auth_created_at"] if row["has_auth"] else row["b2b_created_at"]
+    elif row["has_b2c"]:
+        user_info["full_name"] = row["b2c_full_name"]
+        user_info["email"] = row["b2c_email"]
+        user_info["phone_number"] = row["b2c_phone_number"]
+        user_info["created_at"] = row["b2c_created_at"]
+        user_info["auth_created_at"] = row["auth_created_at"] if row["has_auth"] else row["b2c_created_at"]
+    elif row["has_auth"]:
+        user_info["full_name"] = row["auth_full_name"] or email.split('@')[0]
+        user_info["email"] = row["auth_email"]
+        user_info["phone_number"] = row["auth_phone_number"]
+        user_info["created_at"] = row["auth_created_at"]
+        user_info["auth_created_at"] = row["auth_created_at"]
+        if is_b2b:
+            user_info["gstin"] = ""
+            user_info["pan"] = ""
+            user_info["business_name"] = ""
+
+    if with_address:
+        # Same shape as an item of /users/addresses
+        user_info["default_address"] = {
+            "user_address_id": row["user_address_id"],
+            "name": row["address_name"],
+            "is_default": row["is_default"],
+            "id": row["address_id"],
+            "address": row["address"],
+            "state": row["state"],
+            "city": row["city"],
+            "pincode": row["pincode"],
+            "country": row["country"],
+        } if row["user_address_id"] is not None else None
+
+    return user_info
+
+
+class ProfileCache:
+    """
+    Per-worker cache of /users/me bodies keyed by (user_id, user_type, with_address).
+    Writers call invalidate(user_id) after committing. Other workers hear about the
+    change through the profile_changed notification (migration 014).
+    """
+
+    def __init__(self, ttl=PROFILE_CACHE_TTL, size=PROFILE_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries = {}  # key -> (expires_at, profile)
+        # So a load racing an edit isn't kept: loads take generation() before reading, and
+        # put() drops the result if the user was invalidated since. Invalidations are
+        # numbered; the newest `size` users' numbers are kept, older ones fold into _floor
+        self._sequence = 0
+        self._invalidated = OrderedDict()  # user_id -> sequence of its latest invalidation
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def generation(self, user_id):
+        return self._sequence
+
+    def get(self, user_id, user_type, with_address):
+        key = (str(user_id), user_type, with_address)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            return dict(entry[1])
+
+    def put(self, user_id, user_type, with_address, profile, generation):
+        with self._lock:
+            if generation < max(self._floor, self._invalidated.get(str(user_id), 0)):
+                return
+            if len(self._entries) >= self.size:
+                # Expired entries first; if none, the oldest inserted
+                now = time.monotonic()
+                for key in [k for k, (expires_at, _) in self._entries.items() if expires_at < now]:
+                    del self._entries[key]
+                if len(self._entries) >= self.size:
+                    del self._entries[next(iter(self._entries))]
+            self._entries[(str(user_id), user_type, with_address)] = (time.monotonic() + self.ttl, profile)
+
+    def invalidate(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            self._sequence += 1
+            self._invalidated[user_id] = self._sequence
+            self._invalidated.move_to_end(user_id)
+            while len(self._invalidated) > self.size:
+                # Only a load that started before this invalidation could be affected; the
+                # floor turns all of those away (other users' too, so they're just not cached)
+                _, sequence = self._invalidated.popitem(last=False)
+                self._floor = max(self._floor, sequence)
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def on_notify(self, payload):
+        """profile_changed NOTIFY handler: the payload is the user id."""
+        if payload:
+            self.invalidate(payload)
+
+
+profile_cache = ProfileCache()
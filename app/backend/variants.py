@@ -0,0 +1,94 @@
+import re
+
+
+def normalize_color(value):
+    """
+    Canonical colour key used by product_variants: 'RRGGBB' upper-case, '' for none.
+    Accepts '#ff0000', '0xFFFF0000' and Flutter's ARGB 'FFFF0000' (alpha is dropped).
+    """
+    code = re.sub(r"^(#|0x)", "", (value or "").strip(), flags=re.IGNORECASE).upper()
+    if len(code) == 8 and re.fullmatch(r"[0-9A-F]{8}", code):
+        code = code[2:]
+    return code
+
+
+class VariantIndex:
+    """
+    Compact lookup over the variants a cart/order touches, built from one query.
+    `variants` maps (product_id, colour) -> (stock, b2c_price, b2b_price);
+    `with_variants` is the set of product ids that have any variant rows at all.
+    Products without variants keep using product-level stock and prices.
+    """
+
+    __slots__ = ("variants", "with_variants")
+
+    def __init__(self, variants, with_variants):
+        self.variants = variants
+        self.with_variants = with_variants
+
+    @classmethod
+    def load(cls, cursor, keys):
+        """`keys` is an iterable of (product_id, colour); colours are normalized here."""
+        keys = {(str(pid), normalize_color(color)) for pid, color in keys}
+        if not keys:
+            return cls({}, frozenset())
+
+        product_ids, colors = zip(*keys)
+        cursor.execute("""
+            SELECT
+                k.product_id, k.color,
+                v.stock, v.b2c_price, v.b2b_price,
+                EXISTS (SELECT 1 FROM product_variants x WHERE x.product_id = k.product_id) AS has_variants
+            FROM unnest(%s::text[], %s::text[]) AS k(product_id, color)
+            LEFT JOIN product_variants v ON v.product_id = k.product_id AND v.color = k.color
+        """, (list(product_ids), list(colors)))
+
+        variants = {}
+        with_variants = set()
+        for row in cursor.fetchall():
+            if not isinstance(row, dict):
+                row = dict(zip(("product_id", "color", "stock", "b2c_price", "b2b_price", "has_variants"), row))
+            if row["has_variants"]:
+                with_variants.add(row["product_id"])
+            if row["stock"] is not None:
+                variants[(row["product_id"], row["color"])] = (
+                    row["stock"],
+                    float(row["b2c_price"]) if row["b2c_price"] is not None else None,
+                    float(row["b2b_price"]) if row["b2b_price"] is not None else None,
+                )
+        return cls(variants, frozenset(with_variants))
+
+    def get(self, product_id, color):
+        return self.variants.get((str(product_id), normalize_color(color)))
+
+    def check(self, product_id, color, quantity):
+        """
+        None when the line can be fulfilled at variant level, otherwise a user-facing reason.
+        Lines without a colour, or of products without variants, are checked at product level.
+        """
+        product_id = str(product_id)
+        if product_id not in self.with_variants or not normalize_color(color):
+            return None
+        variant = self.get(product_id, color)
+        if variant is None:
+            return "Selected colour is not available"
+        if variant[0] < quantity:
+            return f"Only {variant[0]} left in this colour"
+        return None
+
+    def price_override(self, product_id, color, user_type):
+        variant = self.get(product_id, color)
+        if variant is None:
+            return None
+        return variant[2] if user_type == "b2b" else variant[1]
+
+
+def list_variants(cursor, product_id):
+    """Variants of one product for the product detail endpoint."""
+    cursor.execute("""
+        SELECT color, color_name, stock, b2c_price, b2b_price
+        FROM product_variants
+        WHERE product_id = %s
+        ORDER BY color
+    """, (str(product_id),))
+    return cursor.fetchall()